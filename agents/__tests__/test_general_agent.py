@@ -29,6 +29,11 @@ class TestGeneralInstance:
         assert len(tools) > 0
         assert isinstance(tools[0], DummyTool)
 
+    def test_tools_are_built_once(self):
+        tools = agent.get_tools("Give me a dummy tool")
+        assert all(any(tool is shared_tool for shared_tool in agent.tools) for tool in tools)
+        assert agent.agent_executor.tools == agent.tools
+
     def test_define_agent(self):
         agent_obj = agent.define_agent(agent.TEMPLATE, agent.define_tools())
         assert isinstance(agent_obj, LLMSingleActionAgent)
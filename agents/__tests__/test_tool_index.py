@@ -0,0 +1,63 @@
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+
+from agents.tool_index import ToolIndex, ToolRetriever
+
+VOCABULARY = ['query', 'comment', 'dashboard', 'none']
+
+
+class KeywordEmbeddings(Embeddings):
+    """Embeds a text as the count of each word of the vocabulary and records the texts embedded"""
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded += texts
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [float(text.count(word)) + 0.01 for word in VOCABULARY]
+
+
+def test_tool_index_search():
+    index = ToolIndex(KeywordEmbeddings())
+    index.build(['run a query', 'write a comment', 'create a dashboard'])
+    assert index.search('I want a dashboard', k=1) == [2]
+    assert index.search('query the table', k=3)[0] == 0
+
+
+def test_tool_index_is_persisted(tmp_path):
+    descriptions = ['run a query', 'write a comment', 'create a dashboard']
+    embeddings = KeywordEmbeddings()
+    ToolIndex(embeddings, tmp_path, model_name='test').build(descriptions)
+    assert embeddings.embedded == descriptions
+
+    embeddings.embedded = []
+    index = ToolIndex(embeddings, tmp_path, model_name='test')
+    index.build(descriptions)
+    assert embeddings.embedded == []
+    assert isinstance(index.vectors, np.memmap)
+
+    # only the changed description is embedded again
+    index = ToolIndex(embeddings, tmp_path, model_name='test')
+    index.build(['run a query', 'write a comment about the table', 'create a dashboard'])
+    assert embeddings.embedded == ['write a comment about the table']
+    assert index.search('comment', k=1) == [1]
+
+    # a different embeddings model discards the stored vectors
+    embeddings.embedded = []
+    ToolIndex(embeddings, tmp_path, model_name='other').build(descriptions)
+    assert embeddings.embedded == descriptions
+
+
+def test_tool_retriever():
+    descriptions = ['run a query', 'write a comment', 'create a dashboard']
+    index = ToolIndex(KeywordEmbeddings())
+    index.build(descriptions)
+    documents = [Document(page_content=description, metadata={'index': i}) for i, description in enumerate(descriptions)]
+    retriever = ToolRetriever(index=index, documents=documents, k=2)
+    result = retriever.get_relevant_documents('add a comment')
+    assert len(result) == 2
+    assert result[0].metadata['index'] == 1
@@ -0,0 +1,45 @@
+from langchain.schema import Document
+
+from agents.tool_router import BM25, KeywordToolRouter, tokenize
+
+DOCUMENTS = [
+    Document(page_content='None Input Action', metadata={'index': 0, 'name': 'None needed'}),
+    Document(page_content='Retrieves the result of the question from the database', metadata={
+        'index': 1, 'name': 'query_sql_db'
+    }),
+    Document(page_content='Generates comments and documentation for a group of tables', metadata={
+        'index': 2, 'name': 'sql_comment_generator'
+    }),
+    Document(page_content='Creates a dashboard in metabase', metadata={'index': 3, 'name': 'metabase_creator'}),
+]
+
+
+def test_tokenize():
+    assert tokenize('How many rows, in sales.store?') == ['how', 'many', 'rows', 'in', 'sales', 'store']
+
+
+def test_bm25_scores():
+    scores = BM25(['a dashboard in metabase', 'documentation of the tables', 'rows of the database']).scores(
+        'create a dashboard'
+    )
+    assert scores[0] > 0
+    assert scores[1] == scores[2] == 0
+
+
+def test_keyword_tool_router():
+    router = KeywordToolRouter(documents=DOCUMENTS, keywords={'query_sql_db': ['how many']}, k=2)
+    names = [document.metadata['name'] for document in router.get_relevant_documents('How many rows are there?')]
+    assert names[0] == 'query_sql_db'
+    assert len(names) == 2
+
+    names = [document.metadata['name'] for document in router.get_relevant_documents('I want a dashboard')]
+    assert names[0] == 'metabase_creator'
+
+    names = [document.metadata['name'] for document in router.get_relevant_documents('document the sales tables')]
+    assert names[0] == 'sql_comment_generator'
+
+
+def test_keyword_tool_router_keeps_order_without_matches():
+    router = KeywordToolRouter(documents=DOCUMENTS)
+    documents = router.get_relevant_documents('xyz')
+    assert [document.metadata['index'] for document in documents] == [0, 1, 2, 3]
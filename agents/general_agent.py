@@ -1,53 +1,98 @@
 import logging
 import traceback
+from typing import List
 
 from langchain import LLMChain
 from langchain.agents import AgentExecutor, LLMSingleActionAgent
 from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.schema import Document
-from langchain.vectorstores import FAISS
-from langchain.vectorstores.base import VectorStoreRetriever
+from langchain.schema import BaseRetriever, Document
 from pydantic import BaseModel
 from sqlalchemy.engine.base import Engine
 
+from agents.tool_index import ToolIndex, ToolRetriever
+from agents.tool_router import KeywordToolRouter
 from agents.utils import CustomPromptTemplate, CustomOutputParser
 from tools.general_tools import QuerySQLDataBaseTool, SQlCommentGenerator, DummyTool, MetabaseCreator
 from utils.config_loaders import (
     get_config,
     get_secrets
 )
+from utils.embeddings import create_embeddings
 
 config = get_config()
-secrets = get_secrets(config)
 
 
-def setup_tools(tool_to_use: list) -> VectorStoreRetriever:
+def use_local_router(number_of_tools: int) -> bool:
     """
-    Set up the tools and create a vector store for retrieval.
+    Check if the tools are chosen with the local router (tool_router in the config) instead of embeddings
+    Args:
+        number_of_tools: number of tools of the agent
 
-    Returns:
-        A tuple containing the VectorStoreRetriever object and the list of all tools.
+    Returns: True if the local router is used
+    """
+    router_config = config.get('tool_router', {})
+    strategy = router_config.get('strategy', 'auto')
+    if strategy == 'auto':
+        return number_of_tools <= router_config.get('max_local_tools', 10)
+    return strategy == 'local'
+
+
+def get_tool_documents(tool_to_use: list) -> List[Document]:
+    """
+    Documents with the description of each tool, used by the tool routers
+    Args:
+        tool_to_use: tools of the agent
+
+    Returns: one document for each tool, with its index and name in the metadata
     """
-    # Vector store
-    logging.info("Setting up tools, starting vector store...")
-    docs = [Document(page_content=t.description, metadata={
-        "index": i
+    return [Document(page_content=t.description, metadata={
+        "index": i,
+        "name": t.name
     }) for i, t in enumerate(tool_to_use)]
-    vector_store = FAISS.from_documents(docs, OpenAIEmbeddings(
-        openai_api_key=secrets['openai_api']['token'],
-        openai_organization=secrets['openai_api']['organization']
-    ))
-    retriever = vector_store.as_retriever(search_type='similarity')
-    logging.info("Vector store ready.")
-    return retriever
+
+
+def build_tool_index(docs: List[Document]) -> ToolIndex:
+    """
+    Load the embeddings of the tool descriptions from the index stored in tool_index.path, only new or changed
+    descriptions are embedded
+    Args:
+        docs: documents of the tools (see get_tool_documents)
+
+    Returns: the index of the tools
+    """
+    # the embeddings of the questions are cached, so the iterations of a request and the repeated questions do not
+    # call the embeddings API again
+    embeddings = create_embeddings()
+    index = ToolIndex(embeddings, config.get('tool_index', {}).get('path'), model_name=embeddings.model_name)
+    index.build([doc.page_content for doc in docs])
+    return index
+
+
+def setup_tools(tool_to_use: list) -> BaseRetriever:
+    """
+    Set up the tools and create the retriever that chooses them. With few tools the local router (BM25 and keyword
+    rules) is used and no network call is made. Otherwise, the embeddings of the descriptions are read from the index
+    (see build_tool_index).
+
+    Returns:
+        The retriever of the tools.
+    """
+    docs = get_tool_documents(tool_to_use)
+    if use_local_router(len(tool_to_use)):
+        logging.info("Setting up tools, using the local tool router...")
+        return KeywordToolRouter(documents=docs, keywords=config.get('tool_router', {}).get('keywords') or {})
+
+    logging.info("Setting up tools, loading the tool index...")
+    return ToolRetriever(index=build_tool_index(docs), documents=docs)
 
 
 class GeneralAgent(BaseModel):
 
     engine: Engine
-    retriever: VectorStoreRetriever = None
+    retriever: BaseRetriever = None
     verbose: bool = False
+    tools: list = None
+    agent_executor: AgentExecutor = None
     TEMPLATE: str = """
     As your database assistant, I am dedicated to providing you with friendly, empathetic, and precise answers to all of 
     your questions. My goal is to offer the best possible support, whether you need help navigating the database or 
@@ -92,7 +137,11 @@ class GeneralAgent(BaseModel):
 
     def __init__(self, **data):
         super().__init__(**data)
-        self.retriever = setup_tools(self.define_tools())
+        # the tools, the model client and the executor are built once and shared by all the requests, they don't
+        # keep state between runs (the intermediate steps of a request live inside AgentExecutor.run)
+        self.tools = self.define_tools()
+        self.retriever = setup_tools(self.tools)
+        self.agent_executor = self.init_agent()
 
     def define_tools(self) -> list:
         query = QuerySQLDataBaseTool(engine=self.engine)
@@ -114,7 +163,7 @@ class GeneralAgent(BaseModel):
             A list of Tool objects that are relevant to the query.
         """
         docs = self.retriever.get_relevant_documents(query)
-        return [self.define_tools()[d.metadata["index"]] for d in docs]
+        return [self.tools[d.metadata["index"]] for d in docs]
 
     def define_agent(self, template: str, tool_to_use: list) -> LLMSingleActionAgent:
         """
@@ -135,6 +184,7 @@ class GeneralAgent(BaseModel):
 
         output_parser = CustomOutputParser()
 
+        secrets = get_secrets(config)
         llm = ChatOpenAI(
             verbose=self.verbose,
             temperature=0,
@@ -162,11 +212,10 @@ class GeneralAgent(BaseModel):
         Returns: AgentExecutor object.
         """
         logging.info("Initializing agent...")
-        ALL_TOOLS = self.define_tools()
-        agent = self.define_agent(self.TEMPLATE, tool_to_use=ALL_TOOLS)
+        agent = self.define_agent(self.TEMPLATE, tool_to_use=self.tools)
         agent_executor = AgentExecutor.from_agent_and_tools(
             agent=agent,
-            tools=ALL_TOOLS,
+            tools=self.tools,
             verbose=self.verbose,
             max_iterations=3
         )
@@ -184,8 +233,7 @@ class GeneralAgent(BaseModel):
 
         """
         try:
-            agent_executor = self.init_agent()
-            response = agent_executor.run(request)
+            response = self.agent_executor.run(request)
             return response
         except Exception as e:
             logging.error('Unexpected error occurred: %s', str(e))
@@ -194,3 +242,30 @@ class GeneralAgent(BaseModel):
                 'status': 'error',
                 'message': f'Unexpected Error: {str(e)}'
             }
+
+    async def ahandle_request(self, request):
+        """
+        Async version of handle_request, the model and the tools are awaited so the event loop keeps serving other
+        requests while this one runs.
+        Args:
+            request: User question.
+
+        Returns: Response from the agent.
+
+        """
+        try:
+            response = await self.agent_executor.arun(request)
+            return response
+        except Exception as e:
+            logging.error('Unexpected error occurred: %s', str(e))
+            logging.error('traceback: %s', traceback.format_exc())
+            return {
+                'status': 'error',
+                'message': f'Unexpected Error: {str(e)}'
+            }
+
+
+if __name__ == '__main__':
+    # build the tool index ahead of time, for example while building the image: python -m agents.general_agent. The
+    # index is built whatever the tool_router strategy is, so switching to embeddings does not embed on startup
+    build_tool_index(get_tool_documents(GeneralAgent.construct(engine=None).define_tools()))
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.embeddings.base import Embeddings
+from langchain.schema import BaseRetriever, Document
+
+
+def hash_text(text: str) -> str:
+    """
+    Hash of a text, used to know if the embedding of a description is already stored
+    Args:
+        text: text to be hashed
+
+    Returns: sha256 hex digest of the text
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ToolIndex:
+    """
+    Embeddings of the tool descriptions, persisted to disk so the process does not call the embeddings API on
+    startup. The vectors are stored as a numpy matrix (vectors.npy) next to the hash of the description of each row
+    (index.json). The matrix is loaded with a memory map, and only the descriptions whose hash is not stored yet are
+    embedded again.
+    """
+
+    def __init__(self, embeddings: Embeddings, path: Optional[str] = None, model_name: str = ''):
+        """
+        Args:
+            embeddings: embeddings model, used for the new descriptions and for the queries
+            path: directory where the index is stored, None keeps the index only in memory
+            model_name: name of the embeddings model, the stored vectors are discarded when it changes
+        """
+        self.embeddings = embeddings
+        self.path = Path(path) if path else None
+        self.model_name = model_name
+        self.hashes: List[str] = []
+        self.vectors: Optional[np.ndarray] = None
+
+    def _load(self) -> dict:
+        """
+        Load the stored vectors, indexed by the hash of their description
+        """
+        if not self.path or not (self.path / 'index.json').exists():
+            return {}
+        try:
+            with open(self.path / 'index.json', 'r') as file:
+                index = json.load(file)
+            if index.get('model_name') != self.model_name:
+                logging.info(f'The tool index was built with {index.get("model_name")}, it will be rebuilt')
+                return {}
+            vectors = np.load(self.path / 'vectors.npy', mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logging.warning(f'Failed to load the tool index from {self.path}: {e}')
+            return {}
+        return {description_hash: vectors[i] for i, description_hash in enumerate(index['hashes'])}
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            # np.save adds the .npy suffix, the temporary file keeps it so the rename is atomic
+            np.save(self.path / 'vectors.tmp.npy', self.vectors)
+            (self.path / 'vectors.tmp.npy').replace(self.path / 'vectors.npy')
+            with open(self.path / 'index.json', 'w') as file:
+                json.dump({'model_name': self.model_name, 'hashes': self.hashes}, file)
+        except OSError as e:
+            logging.warning(f'Failed to persist the tool index to {self.path}: {e}')
+
+    def build(self, descriptions: List[str]) -> None:
+        """
+        Get the vector of every description, from the stored index when the description did not change or from the
+        embeddings model otherwise. The index is saved again only when something was embedded.
+        Args:
+            descriptions: descriptions of the tools, the rows of the index follow this order
+        """
+        hashes = [hash_text(description) for description in descriptions]
+        stored = self._load()
+        missing = [i for i, description_hash in enumerate(hashes) if description_hash not in stored]
+        if missing:
+            logging.info(f'Embedding {len(missing)} of {len(descriptions)} tool descriptions')
+            new_vectors = self.embeddings.embed_documents([descriptions[i] for i in missing])
+            for i, vector in zip(missing, new_vectors):
+                vector = np.asarray(vector, dtype=np.float32)
+                stored[hashes[i]] = vector / (np.linalg.norm(vector) or 1)
+
+        self.hashes = hashes
+        if not missing and list(stored.keys()) == hashes:
+            # the stored index is exactly the current one, keep the memory map
+            self.vectors = np.load(self.path / 'vectors.npy', mmap_mode='r')
+        else:
+            self.vectors = np.stack([stored[description_hash] for description_hash in hashes])
+            self._save()
+        logging.info('Tool index ready.')
+
+    def scores(self, query_vector: List[float]) -> np.ndarray:
+        """
+        Cosine similarity between a query and every description, the stored vectors are normalized
+        Args:
+            query_vector: embedding of the query
+
+        Returns: the similarity of each description, in the order of the index
+        """
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        return self.vectors @ (query_vector / (np.linalg.norm(query_vector) or 1))
+
+    def search(self, query: str, k: int = 4) -> List[int]:
+        """
+        Get the positions of the k descriptions most similar to a query
+        Args:
+            query: text of the query
+            k: number of results
+
+        Returns: positions of the descriptions, the most similar first
+        """
+        scores = self.scores(self.embeddings.embed_query(query))
+        return [int(i) for i in np.argsort(-scores)[:k]]
+
+    async def asearch(self, query: str, k: int = 4) -> List[int]:
+        """
+        Async version of search
+        """
+        scores = self.scores(await self.embeddings.aembed_query(query))
+        return [int(i) for i in np.argsort(-scores)[:k]]
+
+
+class ToolRetriever(BaseRetriever):
+    """
+    Retriever over the documents of the tools, backed by a ToolIndex
+    """
+    index: ToolIndex
+    documents: List[Document]
+    k: int = 4
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [self.documents[i] for i in self.index.search(query, self.k)]
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [self.documents[i] for i in await self.index.asearch(query, self.k)]
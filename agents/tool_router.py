@@ -0,0 +1,127 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+# words too common to tell the tools apart
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'i', 'in', 'is', 'it', 'me', 'my', 'of', 'on',
+    'or', 'please', 'that', 'the', 'this', 'to', 'want', 'we', 'what', 'with', 'you',
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text in lowercase words
+    Args:
+        text: text to be split
+
+    Returns: the words of the text
+    """
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+def count_keywords(query: str, keywords: List[str]) -> int:
+    """
+    Count the keywords found in a query, as whole words and ignoring the case
+    Args:
+        query: user question
+        keywords: words or phrases to look for
+
+    Returns: number of keywords found
+    """
+    text = ' '.join(tokenize(query))
+    return sum(1 for keyword in keywords if re.search(rf"\b{' '.join(tokenize(keyword))}\b", text))
+
+
+class BM25:
+    """
+    Okapi BM25 scorer over a small set of documents, computed in memory
+    """
+
+    def __init__(self, documents: List[str], k1: float = 1.5, b: float = 0.75):
+        """
+        Args:
+            documents: texts to be scored
+            k1: term frequency saturation
+            b: length normalization
+        """
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [
+            Counter(term for term in tokenize(document) if term not in STOP_WORDS) for document in documents
+        ]
+        self.lengths = [sum(frequencies.values()) for frequencies in self.term_frequencies]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        document_frequencies = Counter(term for frequencies in self.term_frequencies for term in frequencies)
+        total = len(documents)
+        self.idf = {
+            term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    def scores(self, query: str) -> List[float]:
+        """
+        Score every document for a query
+        Args:
+            query: text of the query
+
+        Returns: the score of each document, in the order of the documents
+        """
+        terms = [term for term in tokenize(query) if term not in STOP_WORDS]
+        scores = []
+        for frequencies, length in zip(self.term_frequencies, self.lengths):
+            score = 0.0
+            for term in terms:
+                frequency = frequencies.get(term, 0)
+                if not frequency:
+                    continue
+                normalization = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1))
+                score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + normalization)
+            scores.append(score)
+        return scores
+
+
+class KeywordToolRouter(BaseRetriever):
+    """
+    Local tool router, it ranks the tools with BM25 over their descriptions plus keyword rules for each tool, so
+    choosing the tools does not call the embeddings API. Tools with the same score keep their original order.
+    """
+    documents: List[Document]
+    keywords: Dict[str, List[str]] = {}
+    keyword_weight: float = 2.0
+    k: int = 4
+    scorer: BM25 = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.scorer = BM25([
+            f"{document.metadata.get('name', '')} {document.page_content}" for document in self.documents
+        ])
+
+    def scores(self, query: str) -> List[float]:
+        """
+        Score every tool for a query, a keyword of a tool found in the query adds keyword_weight to its score
+        Args:
+            query: user question
+
+        Returns: the score of each tool, in the order of the documents
+        """
+        scores = self.scorer.scores(query)
+        for i, document in enumerate(self.documents):
+            keywords = self.keywords.get(document.metadata.get('name'), [])
+            scores[i] += self.keyword_weight * count_keywords(query, keywords)
+        return scores
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        scores = self.scores(query)
+        ranking = sorted(range(len(self.documents)), key=lambda i: -scores[i])
+        return [self.documents[i] for i in ranking[:self.k]]
@@ -6,8 +6,10 @@
 #  /    (_____/
 # /_____/   U
 
+import asyncio
 import logging
 import logging.config
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
@@ -24,8 +26,26 @@ from utils.config_loaders import (
 config = get_config()
 setup_logging(config)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the Slack app, the database engine and the agent when the server starts, before the first request. If
+    it fails they are created again by the first request, the health check keeps answering. The workers of the
+    Slack mentions are stopped on shutdown.
+    """
+    if config.get('startup', {}).get('warm_up', True):
+        try:
+            await asyncio.to_thread(slack.warm_up)
+        except Exception as e:
+            logging.error(f'Failed to warm up the service, it will be initialized by the first request: {e}')
+    yield
+    await slack.work_queue.close()
+
+
 api = FastAPI(
     title='Slack Bot - API',
+    lifespan=lifespan,
     docs_url="/docs",
     openapi_url="/openapi.json"
 )
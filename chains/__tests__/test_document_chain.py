@@ -3,11 +3,14 @@ from unittest.mock import patch
 from pandas import DataFrame
 
 from chains.document_tables import (
+    create_comment_chunks,
+    estimate_chunk_tokens,
     generate_sql_code,
     get_data,
     process_columns_in_chunks,
     run_sql_comment_generator
 )
+from prompts.comment_creator import CommentCreator
 from utils.config_loaders import (
     get_config
 )
@@ -84,3 +87,37 @@ def test_run_sql_comment_generator():
     assert 'COLUMN sales.currency.name' in result
     assert 'COLUMN sales.currency.modifieddate' in result
     assert 'sales.currency' in result
+
+
+def test_process_columns_in_chunks_keeps_column_order():
+    columns_info = [{'column_name': f'col{i}'} for i in range(7)]
+    pandas_info = DataFrame(columns=[column['column_name'] for column in columns_info])
+
+    def get_result(self):
+        return {
+            'table_name': self.table_name,
+            'schema_name': self.schema_name,
+            'columns': [{'column_name': column['column_name'], 'comment': 'test'} for column in self.table_info]
+        }
+
+    with patch.object(CommentCreator, 'get_result', get_result):
+        result = process_columns_in_chunks('table', 'schema', columns_info, pandas_info, chunk_size=2)
+    assert [column['column_name'] for column in result['columns']] == [f'col{i}' for i in range(7)]
+
+
+def test_create_comment_chunks_fit_the_context_window():
+    columns_info = [{
+        'column_name': f'description_{i}', 'type': 'VARCHAR(200)', 'comment': None, 'is_foreign_key': False,
+        'is_primary_key': False, 'foreign_key_tables': None
+    } for i in range(100)]
+    table_profile = {
+        column['column_name']: {
+            'null_fraction': 0.1, 'distinct': 950, 'distinct_is_estimate': True, 'min': 'A' * 40, 'max': 'Z' * 40,
+            'avg_length': 120, 'top_values': [(f'frequent value number {j}', 0.05) for j in range(5)]
+        } for column in columns_info
+    }
+    pandas_info = DataFrame(columns=[column['column_name'] for column in columns_info])
+    chunks = create_comment_chunks('table', 'schema', columns_info, pandas_info, 100, table_profile, max_tokens=4096)
+    assert len(chunks) > 1
+    assert all(estimate_chunk_tokens(comments) <= 4096 for comments in chunks)
+    assert [column for comments in chunks for column in comments.table_info] == columns_info
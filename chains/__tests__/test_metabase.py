@@ -1,18 +1,30 @@
+import asyncio
+import json
+
+import httpx
 import pytest
 import requests
+from langchain.chat_models.fake import FakeListChatModel
+from sqlalchemy import create_engine, text
 
+from chains import metabase as metabase_chain
 from chains.metabase import (
     process_metabase_queries,
     insert_card_into_dashboard,
     create_metabase_dashboard,
+    arun_graph_creator,
     run_graph_creator
 )
+from prompts.info_extractor import InfoExtractor
+from prompts.metabase_creator import MetabaseCreator
+from prompts.metabase_graphs import MetabaseGraph
 from utils.config_loaders import (
     get_config
 )
 from utils.config_loaders import (
     get_secrets
 )
+from utils import metabase as metabase_utils
 from utils.database import create_db_session
 
 config = get_config()
@@ -69,7 +81,7 @@ def test_process_metabase_queries():
         "id": config['secrets']['metabase']['collection_parent']
     }
 
-    responses = process_metabase_queries(metabase_queries, collection_info)
+    responses = process_metabase_queries(metabase_queries, collection_info)['cards']
 
     dashboard_info = create_metabase_dashboard(
         collection_id=collection_info['id'],
@@ -104,3 +116,122 @@ I want a dashboard that shows me the total profit per month, number of sales per
 You can use the tables salesorderheader, salesorderdetail, specialofferproduct, store, creditcard, customer, and salesterritory from the sales schema.
         """, engine)
         assert 'Failed to create' not in result
+
+
+def fake_model(*responses: str):
+    return lambda self: FakeListChatModel(responses=list(responses))
+
+
+def test_arun_graph_creator_with_fake_models(tmp_path, monkeypatch):
+    database = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with database.begin() as conn:
+        conn.execute(text('CREATE TABLE booking (id INTEGER PRIMARY KEY, city VARCHAR(20))'))
+        conn.execute(text("INSERT INTO booking VALUES (1, 'Bogota'), (2, 'Lima')"))
+    card = {
+        'table_name': 'booking', 'schema_name': 'main', 'title': 'Total bookings',
+        'query': 'SELECT COUNT(*) AS total FROM booking', 'classify': 'Numeric Indicator',
+        'description': 'Number of bookings'
+    }
+    monkeypatch.setattr(InfoExtractor, 'get_model', fake_model('{"schemas": {"main": ["booking"]}}'))
+    monkeypatch.setattr(MetabaseCreator, 'get_model', fake_model(json.dumps({
+        'dashboard_name': 'Bookings', 'info_json': [card]
+    })))
+    monkeypatch.setattr(MetabaseGraph, 'get_model', fake_model(json.dumps({
+        'name': 'Total bookings', 'dataset_query_native_query': card['query'], 'description': card['description'],
+        'visualization_settings_columns_name': 'total',
+        'visualization_settings_column_settings_number_style': 'normal'
+    })))
+
+    requests_sent = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests_sent.append((request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json={'id': len(requests_sent)})
+
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(
+        metabase_chain.httpx, 'AsyncClient', lambda: async_client(transport=httpx.MockTransport(handler))
+    )
+    result = asyncio.run(arun_graph_creator('a dashboard of the bookings', database, 1))
+    assert result.strip().endswith('/dashboard/3')
+    assert [path for path, _ in requests_sent] == [
+        '/api/collection/', '/api/card/', '/api/dashboard/', '/api/dashboard/3/cards'
+    ]
+    assert requests_sent[1][1]['collection_id'] == 1
+    assert requests_sent[3][1][0]['cardId'] == 2
+
+
+def metabase_cards(*titles: str):
+    return [
+        {
+            'table_name': 'booking', 'schema_name': 'main', 'title': title,
+            'query': 'SELECT COUNT(*) AS total FROM booking', 'classify': 'Numeric Indicator',
+            'description': 'Number of bookings'
+        }
+        for title in titles
+    ]
+
+
+def test_aprocess_metabase_queries_keeps_the_order_and_reports_the_failures(monkeypatch):
+    monkeypatch.setitem(metabase_chain.metabase_config, 'max_concurrent_cards', 2)
+    in_flight = []
+    max_in_flight = []
+
+    async def acreate_card(client, metabase_url, database_id, collection_id, card_info, headers):
+        in_flight.append(card_info['title'])
+        max_in_flight.append(len(in_flight))
+        # the first cards take longer, they finish after the next ones
+        await asyncio.sleep(0.01 * (4 - len(max_in_flight)))
+        in_flight.remove(card_info['title'])
+        if card_info['title'] == 'broken':
+            raise httpx.HTTPStatusError('500 Internal Server Error', request=None, response=None)
+        return {'name': card_info['title'], 'collection_id': collection_id}
+
+    monkeypatch.setattr(metabase_chain, 'acreate_card', acreate_card)
+    queries = metabase_cards('first', 'broken', 'third', 'fourth')
+    queries.append({**queries[0], 'title': 'unknown', 'classify': 'Pie Chart'})
+    result = asyncio.run(metabase_chain.aprocess_metabase_queries(None, queries, {'id': 7}))
+    assert [card['name'] for card in result['cards']] == ['first', 'third', 'fourth']
+    assert [(failure['title'], failure['classify']) for failure in result['failures']] == [
+        ('broken', 'Numeric Indicator'), ('unknown', 'Pie Chart')
+    ]
+    assert 'Unknown card type' in result['failures'][1]['error']
+    assert max(max_in_flight) == 2
+
+
+def test_process_metabase_queries_copies_the_base_structures(monkeypatch):
+    monkeypatch.setitem(metabase_chain.metabase_config, 'max_concurrent_cards', 3)
+    monkeypatch.setattr(MetabaseGraph, 'get_model', lambda self: FakeListChatModel(responses=[json.dumps({
+        'name': 'Total bookings', 'dataset_query_native_query': 'SELECT COUNT(*) AS total FROM booking',
+        'description': 'Number of bookings', 'visualization_settings_columns_name': 'total',
+        'visualization_settings_column_settings_number_style': 'normal'
+    })]))
+    base_structure = json.dumps(metabase_utils.base_numeric_indicator)
+    posted = []
+
+    class Response:
+        def __init__(self, payload):
+            self.payload = payload
+
+        def raise_for_status(self):
+            if self.payload['collection_id'] is None:
+                raise requests.exceptions.HTTPError('400 Bad Request')
+
+        def json(self):
+            return {'id': id(self.payload), **self.payload}
+
+    def post(url, headers, json):
+        posted.append(json)
+        return Response(json)
+
+    monkeypatch.setattr(metabase_utils.requests, 'post', post)
+    result = process_metabase_queries(metabase_cards('first', 'second', 'third'), {'id': 7})
+    assert len(result['cards']) == 3 and result['failures'] == []
+    assert all(card['collection_id'] == 7 for card in result['cards'])
+    # each card is built on its own copy of the base structure
+    assert len({id(card) for card in posted}) == 3
+    assert json.dumps(metabase_utils.base_numeric_indicator) == base_structure
+
+    result = process_metabase_queries(metabase_cards('first', 'second'), {'id': None})
+    assert result['cards'] == []
+    assert [failure['title'] for failure in result['failures']] == ['first', 'second']
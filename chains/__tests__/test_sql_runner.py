@@ -1,11 +1,24 @@
-from chains.sql_runner import sql_runner
+import asyncio
+
+from langchain.chat_models.fake import FakeListChatModel
+from langchain.embeddings.base import Embeddings
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from chains import sql_runner as sql_runner_chain
+from chains.sql_runner import asql_runner, sql_runner
+from prompts.column_extractor import ColumnExtractor
+from prompts.info_extractor import InfoExtractor
+from prompts.sql_runner import SQLRunner
+from utils.progress import listen_progress
+from utils.semantic_cache import SemanticCache
 from utils.config_loaders import (
     get_config
 )
 from utils.config_loaders import (
     get_secrets
 )
-from utils.database import create_db_session
+from utils.database import create_db_session, invalidate_table_info
 import pytest
 
 config = get_config()
@@ -20,3 +33,191 @@ def test_general_runner():
     assert result['sql_code'] is not None
     assert isinstance(result, dict)
     assert result['data'] is not None
+
+
+class KeywordEmbeddings(Embeddings):
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [1.0, float('yesterday' in text)]
+
+
+def test_sql_runner_reuses_cached_answer(tmp_path, monkeypatch):
+    database = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with database.begin() as conn:
+        conn.execute(text('CREATE TABLE booking (id INTEGER PRIMARY KEY)'))
+        conn.execute(text('INSERT INTO booking VALUES (1), (2)'))
+
+    cache = SemanticCache(KeywordEmbeddings)
+    monkeypatch.setattr(sql_runner_chain, 'answer_cache', cache)
+    monkeypatch.setitem(sql_runner_chain.answer_cache_config, 'enabled', True)
+    monkeypatch.setitem(sql_runner_chain.answer_cache_config, 're_execute', True)
+    sql_runner_chain.cache_answer(
+        'how many bookings yesterday', database, {'schemas': {'main': ['booking']}},
+        {'sql_code': 'SELECT COUNT(*) AS total FROM booking', 'data': None}
+    )
+
+    def get_result(self):
+        raise AssertionError('the model must not be called')
+
+    monkeypatch.setattr(InfoExtractor, 'get_result', get_result)
+    result = sql_runner('how many bookings were there yesterday', database, 10)
+    assert result['sql_code'] == 'SELECT COUNT(*) AS total FROM booking'
+    assert result['data']['total'].tolist() == [2]
+    assert cache.stats()['hits'] == 1
+
+
+def fake_model(*responses: str):
+    return lambda self: FakeListChatModel(responses=list(responses))
+
+
+def test_asql_runner_with_fake_models(tmp_path, monkeypatch):
+    database = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with database.begin() as conn:
+        conn.execute(text('CREATE TABLE booking (id INTEGER PRIMARY KEY, city VARCHAR(20))'))
+        conn.execute(text("INSERT INTO booking VALUES (1, 'Bogota'), (2, 'Lima')"))
+    monkeypatch.setitem(sql_runner_chain.answer_cache_config, 'enabled', False)
+    monkeypatch.setattr(InfoExtractor, 'get_model', fake_model('{"schemas": {"main": ["booking"]}}'))
+    monkeypatch.setattr(ColumnExtractor, 'get_model', fake_model('{"table": "main.booking", "columns": ["id"]}'))
+    monkeypatch.setattr(SQLRunner, 'get_model', fake_model('{"query": "SELECT COUNT(*) AS total FROM booking"}'))
+
+    stages = []
+    with listen_progress(stages.append):
+        result = asyncio.run(asql_runner('how many bookings are there?', database, 10))
+    assert result['sql_code'] == 'SELECT COUNT(*) AS total FROM booking'
+    assert result['data']['total'].tolist() == [2]
+    assert stages == [
+        'Finding the tables of the question', 'Reading the metadata of the tables', 'Choosing the columns',
+        'Writing the SQL query', 'Running the SQL query'
+    ]
+
+    monkeypatch.setattr(SQLRunner, 'get_model', fake_model('{"query": "SELECT missing FROM booking"}'))
+    result = asyncio.run(asql_runner('how many bookings are there?', database, 10))
+    assert 'Error' in result
+
+
+def test_sql_runner_evicts_a_cached_answer_that_fails(tmp_path, monkeypatch):
+    database = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with database.begin() as conn:
+        conn.execute(text('CREATE TABLE booking (id INTEGER PRIMARY KEY, city VARCHAR(20))'))
+        conn.execute(text("INSERT INTO booking VALUES (1, 'Bogota'), (2, 'Lima')"))
+
+    cache = SemanticCache(KeywordEmbeddings)
+    monkeypatch.setattr(sql_runner_chain, 'answer_cache', cache)
+    monkeypatch.setitem(sql_runner_chain.answer_cache_config, 'enabled', True)
+    monkeypatch.setitem(sql_runner_chain.answer_cache_config, 're_execute', True)
+    sql_runner_chain.cache_answer(
+        'how many bookings', database, {'schemas': {'main': ['booking']}},
+        {'sql_code': 'SELECT COUNT(renamed_column) AS total FROM booking', 'data': None}
+    )
+    monkeypatch.setattr(InfoExtractor, 'get_model', fake_model('{"schemas": {"main": ["booking"]}}'))
+    monkeypatch.setattr(ColumnExtractor, 'get_model', fake_model('{"table": "main.booking", "columns": ["id"]}'))
+    monkeypatch.setattr(SQLRunner, 'get_model', fake_model('{"query": "SELECT COUNT(id) AS total FROM booking"}'))
+
+    result = sql_runner('how many bookings', database, 10)
+    assert result['sql_code'] == 'SELECT COUNT(id) AS total FROM booking'
+    assert cache.lookup('how many bookings', sql_runner_chain.get_engine_key(database))['sql_code'] == \
+        'SELECT COUNT(id) AS total FROM booking'
+
+    invalidate_table_info(database, 'main', 'booking')
+    assert len(cache) == 0
+
+
+def test_run_query_stops_at_the_row_and_byte_caps(tmp_path):
+    database = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with database.begin() as conn:
+        conn.execute(text('CREATE TABLE booking (id INTEGER PRIMARY KEY, city VARCHAR(20))'))
+        conn.execute(text('INSERT INTO booking VALUES ' + ', '.join(f"({i}, 'Bogota')" for i in range(1, 101))))
+
+    data = sql_runner_chain.run_query('SELECT * FROM booking', database, max_rows=100, fetch_size=7)
+    assert len(data) == 100
+    assert not data.attrs['truncated']
+
+    data = sql_runner_chain.run_query('SELECT * FROM booking', database, max_rows=25, fetch_size=7)
+    assert data['id'].tolist() == list(range(1, 26))
+    assert data.attrs['truncated']
+
+    # each row is about 8 characters long
+    data = sql_runner_chain.run_query('SELECT * FROM booking', database, max_bytes=80, fetch_size=7)
+    assert 5 <= len(data) < 15
+    assert data.attrs['truncated']
+
+
+def test_render_result_is_bounded(tmp_path):
+    database = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with database.begin() as conn:
+        conn.execute(text('CREATE TABLE booking (id INTEGER PRIMARY KEY, city VARCHAR(20))'))
+        conn.execute(text('INSERT INTO booking VALUES ' + ', '.join(f"({i}, 'Bogota')" for i in range(1, 101))))
+    data = sql_runner_chain.run_query('SELECT * FROM booking', database, max_rows=50)
+
+    text_result = sql_runner_chain.render_result({'sql_code': 'SELECT * FROM booking', 'data': data}, max_chars=200)
+    assert text_result.startswith('sql_code: SELECT * FROM booking\ndata:\nid,city\n1,Bogota\n')
+    assert 'more rows not shown' in text_result
+    assert 'only the first 50 were read' in text_result
+    assert len(text_result) < 400
+
+    assert sql_runner_chain.render_result({'Error': 'failed'}) == "{'Error': 'failed'}"
+
+
+def test_parse_plans():
+    postgres_plan = '[{"Plan": {"Node Type": "Nested Loop", "Total Cost": 1250.5, "Plan Rows": 90000}}]'
+    assert sql_runner_chain.parse_postgres_plan(postgres_plan) == {'cost': 1250.5, 'rows': 90000.0}
+
+    mysql_plan = {'query_block': {'cost_info': {'query_cost': '812.40'}, 'nested_loop': [
+        {'table': {'table_name': 'store', 'rows_produced_per_join': 701}},
+        {'table': {'table_name': 'sale', 'rows_produced_per_join': 491401}}
+    ]}}
+    assert sql_runner_chain.parse_mysql_plan(mysql_plan) == {'cost': 812.4, 'rows': 491401.0}
+
+
+def test_check_query_cost_rejects_the_queries_that_can_not_be_explained(monkeypatch):
+    def explain_query(query, database):
+        raise OperationalError(query, {}, Exception('canceling statement due to statement timeout'))
+
+    monkeypatch.setitem(sql_runner_chain.query_guard_config, 'enabled', True)
+    monkeypatch.setattr(sql_runner_chain, 'explain_query', explain_query)
+    rejection = sql_runner_chain.check_query_cost('SELECT * FROM sale a, sale b', None)
+    assert 'could not be estimated' in rejection and 'statement timeout' in rejection
+
+    monkeypatch.setitem(sql_runner_chain.query_guard_config, 'fail_open', True)
+    assert sql_runner_chain.check_query_cost('SELECT * FROM sale a, sale b', None) is None
+
+
+def test_sql_runner_asks_for_a_cheaper_query(tmp_path, monkeypatch):
+    database = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with database.begin() as conn:
+        conn.execute(text('CREATE TABLE booking (id INTEGER PRIMARY KEY, city VARCHAR(20))'))
+        conn.execute(text("INSERT INTO booking VALUES (1, 'Bogota'), (2, 'Lima')"))
+    assert sql_runner_chain.explain_query('SELECT * FROM booking', database) is None
+
+    monkeypatch.setitem(sql_runner_chain.answer_cache_config, 'enabled', False)
+    monkeypatch.setitem(sql_runner_chain.query_guard_config, 'enabled', True)
+    monkeypatch.setitem(sql_runner_chain.query_guard_config, 'max_cost', 1000)
+    monkeypatch.setitem(sql_runner_chain.query_guard_config, 'max_rewrites', 1)
+    estimates = {
+        'SELECT a.id FROM booking a, booking b': {'cost': 50000.0, 'rows': 4.0},
+        'SELECT COUNT(*) AS total FROM booking': {'cost': 10.0, 'rows': 1.0},
+    }
+    monkeypatch.setattr(sql_runner_chain, 'explain_query', lambda query, database: estimates[query])
+    monkeypatch.setattr(InfoExtractor, 'get_model', fake_model('{"schemas": {"main": ["booking"]}}'))
+    monkeypatch.setattr(ColumnExtractor, 'get_model', fake_model('{"table": "main.booking", "columns": ["id"]}'))
+    questions = []
+
+    def get_model(self):
+        questions.append(self.input)
+        return FakeListChatModel(responses=[
+            '{"query": "SELECT a.id FROM booking a, booking b"}' if len(questions) == 1 else
+            '{"query": "SELECT COUNT(*) AS total FROM booking"}'
+        ])
+
+    monkeypatch.setattr(SQLRunner, 'get_model', get_model)
+    result = sql_runner('how many bookings are there?', database, 10)
+    assert result['sql_code'] == 'SELECT COUNT(*) AS total FROM booking'
+    assert 'was rejected because the estimated cost 50000 is above the limit of 1000' in questions[1]
+
+    monkeypatch.setitem(sql_runner_chain.query_guard_config, 'max_rewrites', 0)
+    questions.clear()
+    result = sql_runner('how many bookings are there?', database, 10)
+    assert 'too expensive' in result['Error']
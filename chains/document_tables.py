@@ -1,7 +1,6 @@
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Generator, List
 
-import tqdm
 from pandas import DataFrame
 from sqlalchemy.engine import Engine
 
@@ -11,9 +10,17 @@ from utils.config_loaders import (
     get_config
 )
 from utils.database import get_table_info, get_data
+from utils.llm import arun_llm_tasks, count_tokens, get_context_window, run_llm_tasks
+from utils.profiling import profile_tables, render_profile
+from utils.progress import report_progress
+from utils.steps import Step, arun_steps, run_steps
 
 config = get_config()
 
+# tokens of the instructions of the CommentCreator template and of the comment written for each column
+PROMPT_TOKENS = 500
+COMMENT_TOKENS = 40
+
 
 def generate_sql_code(
         gpt_comments: dict,
@@ -37,21 +44,118 @@ def generate_sql_code(
     return sql_code
 
 
-def process_columns_in_chunks(
+def create_comment_chunks(
         table_name: str,
         schema_name: str,
         columns_info: list,
         pandas_info: DataFrame,
-        chunk_size: int = 5
-) -> Dict[str, Any]:
+        chunk_size: int = 5,
+        table_profile: Dict[str, Any] = None,
+        max_tokens: int = None
+) -> List[CommentCreator]:
     """
-    Process the columns in chunks to avoid memory issues and tokens limit
+    Split the columns of a table in chunks to avoid the tokens limit, one CommentCreator for each chunk. A chunk
+    takes at most chunk_size columns and is closed earlier when its prompt plus its answer would not fit in
+    max_tokens (see estimate_chunk_tokens).
     Args:
         table_name: Table name to be processed
         schema_name: Schema name to be processed
         columns_info: Dictionary with the columns information (metadata)
         pandas_info: Pandas dataframe with the data related to the table
-        chunk_size: Size of the chunk to be processed
+        chunk_size: Maximum number of columns of each chunk
+        table_profile: Statistics of the columns (see utils.profiling), sent instead of the rows of the table
+        max_tokens: Maximum tokens of each request, the context window of the CommentCreator model by default
+
+    Returns: List of CommentCreator, one for each chunk of columns
+
+    """
+    model_name = CommentCreator.__fields__['model_name'].default
+    max_tokens = max_tokens or get_context_window(model_name)
+
+    def column_tokens(column: Dict[str, Any]) -> int:
+        name = column['column_name']
+        if table_profile:
+            data = render_profile(table_profile, [name])
+        else:
+            data = str(pandas_info[pandas_info.columns.intersection([name])])
+        return count_tokens(str(column) + data, model_name) + COMMENT_TOKENS
+
+    column_groups = []
+    group_tokens = 0
+    for column in columns_info:
+        tokens = column_tokens(column)
+        if not column_groups or len(column_groups[-1]) >= chunk_size or \
+                PROMPT_TOKENS + group_tokens + tokens > max_tokens:
+            column_groups.append([])
+            group_tokens = 0
+        column_groups[-1].append(column)
+        group_tokens += tokens
+
+    chunks = []
+    for columns_info_chunk in column_groups:
+        column_name = [column['column_name'] for column in columns_info_chunk]
+        pandas_info_chunk = pandas_info[pandas_info.columns.intersection(column_name)]
+        chunks.append(CommentCreator(
+            table_name=table_name,
+            schema_name=schema_name,
+            table_info=columns_info_chunk,
+            table_data=pandas_info_chunk,
+            table_profile=render_profile(table_profile, column_name) if table_profile else None
+        ))
+    return chunks
+
+
+def estimate_chunk_tokens(comments: CommentCreator) -> int:
+    """
+    Estimate the tokens used by a CommentCreator request, the prompt plus the comments of each column
+    Args:
+        comments: CommentCreator of one chunk of columns
+
+    Returns: Estimated number of tokens
+
+    """
+    table_data = comments.table_profile or str(comments.table_data)
+    prompt_tokens = count_tokens(str(comments.table_info) + table_data, comments.model_name)
+    return prompt_tokens + PROMPT_TOKENS + COMMENT_TOKENS * len(comments.table_info)
+
+
+def run_comment_chunks(chunks: List[CommentCreator]) -> List[Dict[str, Any]]:
+    """
+    Run the CommentCreator of every chunk concurrently, limited by the llm_concurrency settings
+    Args:
+        chunks: CommentCreator of each chunk of columns
+
+    Returns: The result of each chunk, in the same order as the chunks
+
+    """
+    return run_llm_tasks(
+        [comments.get_result for comments in chunks],
+        [estimate_chunk_tokens(comments) for comments in chunks],
+        progress=True
+    )
+
+
+async def arun_comment_chunks(chunks: List[CommentCreator]) -> List[Dict[str, Any]]:
+    """
+    Async version of run_comment_chunks
+    Args:
+        chunks: CommentCreator of each chunk of columns
+
+    Returns: The result of each chunk, in the same order as the chunks
+    """
+    return await arun_llm_tasks(
+        [comments.aget_result for comments in chunks],
+        [estimate_chunk_tokens(comments) for comments in chunks]
+    )
+
+
+def merge_chunk_results(table_name: str, schema_name: str, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge the comments of the chunks of a table
+    Args:
+        table_name: Table name
+        schema_name: Schema name
+        results: Results of the chunks of the table, in order
 
     Returns: Dictionary with the table name, schema name and columns information
 
@@ -61,67 +165,185 @@ def process_columns_in_chunks(
         'schema_name': schema_name,
         'columns': []
     }
-    logging.info(f'Processing table {table_name} and schema {schema_name}')
-    for i in tqdm.tqdm(range(0, len(columns_info), chunk_size)):
-        logging.info(f'Processing chunk {i}, table {table_name} and schema {schema_name}')
-        # Get a 'chunk' of the list of size 'chunk_size'
-        columns_info_chunk = columns_info[i:i + chunk_size]
-        column_name = [column['column_name'] for column in columns_info_chunk]
-        pandas_info_chunk = pandas_info[pandas_info.columns.intersection(column_name)]
-        comments = CommentCreator(
-            table_name=table_name,
-            schema_name=schema_name,
-            table_info=columns_info_chunk,
-            table_data=pandas_info_chunk
-        )
-        result = comments.get_result()
+    for result in results:
         final_result['columns'] += result['columns']
     return final_result
 
 
-def get_info(query: str, database: Engine):
+def process_columns_in_chunks(
+        table_name: str,
+        schema_name: str,
+        columns_info: list,
+        pandas_info: DataFrame,
+        chunk_size: int = 5,
+        table_profile: Dict[str, Any] = None
+) -> Dict[str, Any]:
+    """
+    Process the columns in chunks to avoid memory issues and tokens limit, the chunks are processed concurrently
+    Args:
+        table_name: Table name to be processed
+        schema_name: Schema name to be processed
+        columns_info: Dictionary with the columns information (metadata)
+        pandas_info: Pandas dataframe with the data related to the table
+        chunk_size: Size of the chunk to be processed
+        table_profile: Statistics of the columns (see utils.profiling), sent instead of the rows of the table
+
+    Returns: Dictionary with the table name, schema name and columns information
+
+    """
+    logging.info(f'Processing table {table_name} and schema {schema_name}')
+    chunks = create_comment_chunks(table_name, schema_name, columns_info, pandas_info, chunk_size, table_profile)
+    return merge_chunk_results(table_name, schema_name, run_comment_chunks(chunks))
+
+
+def get_table_context(info_extractor: Dict, database: Engine):
+    """
+    Get the metadata, the sampled rows and the profiles of the tables extracted from the question
+    Args:
+        info_extractor: info extractor dictionary, contains the schemas and tables to be used
+        database: Database connection object
+
+    Returns: The data, the metadata and the profiles of the tables
+    """
+    table_metadata = get_table_info(info_extractor, database)
+    table_data = get_data(info_extractor, database, 50, table_metadata=table_metadata)
+    table_profiles = {}
+    if config.get('profiling', {}).get('enabled', False):
+        table_profiles = profile_tables(info_extractor, database, table_metadata, table_data)
+    return table_data, table_metadata, table_profiles
+
+
+def get_info_steps(query: str, database: Engine) -> Generator[Step, Any, Any]:
+    """
+    Steps of get_info, shared by get_info and aget_info (see utils.steps)
+    """
     try:
-        info_extractor = InfoExtractor(query=query).get_result()
-        table_data = get_data(info_extractor, database, 50)
-        table_metadata = get_table_info(info_extractor, database)
+        report_progress('Finding the tables of the question')
+        info_extractor = yield Step.predict(InfoExtractor(query=query))
+        report_progress('Reading the metadata, sampling and profiling the tables')
+        table_data, table_metadata, table_profiles = yield Step(get_table_context, info_extractor, database)
 
-        return info_extractor, table_data, table_metadata
+        return info_extractor, table_data, table_metadata, table_profiles
     except Exception as e:
         logging.error(f"Failed to get the metadata or the dataframe: {str(e)}")
         return 'No comments were generated, failed to get the metadata or the dataframe'
 
 
-def run_sql_comment_generator(query: str, database: Engine) -> str:
+def get_info(query: str, database: Engine):
+    return run_steps(get_info_steps(query, database))
+
+
+async def aget_info(query: str, database: Engine):
     """
-    Run the SQL comment generator
+    Async version of get_info, the database work runs in a worker thread
+    """
+    return await arun_steps(get_info_steps(query, database))
+
+
+def create_all_comment_chunks(
+        info_extractor: Dict,
+        table_data: Dict[str, DataFrame],
+        table_metadata: Dict[str, Any],
+        table_profiles: Dict[str, str]
+):
+    """
+    Split the columns of every table in chunks, the chunks of all the tables are sent together so the tables are
+    documented concurrently too
     Args:
-        query: User question to be processed
-        database: Database connection object
+        info_extractor: info extractor dictionary, contains the schemas and tables to be used
+        table_data: sampled rows of each table
+        table_metadata: metadata of each table
+        table_profiles: profile of each table
+
+    Returns: The (schema, table, number of chunks) of each table and the chunks of all the tables
+
+    """
+    tables = []
+    chunks = []
+    for schema_name, table_names in info_extractor['schemas'].items():
+        for table_name in table_names:
+            # Getting table data
+            columns_info = table_metadata[f'{schema_name}.{table_name}']['columns']
+            pandas_info = table_data[f'{schema_name}.{table_name}']
+            table_profile = table_profiles.get(f'{schema_name}.{table_name}')
+            # the profiles are compact enough to send many more columns per prompt, as long as they fit in the
+            # context window of the model
+            table_chunks = create_comment_chunks(
+                table_name,
+                schema_name,
+                columns_info,
+                pandas_info,
+                chunk_size=config.get('profiling', {}).get('chunk_size', 100) if table_profile else 20,
+                table_profile=table_profile
+            )
+            tables.append((schema_name, table_name, len(table_chunks)))
+            chunks += table_chunks
+    logging.info(f'Processing {len(chunks)} chunks of {len(tables)} tables')
+    return tables, chunks
+
+
+def generate_tables_sql_code(tables: List, results: List[Dict[str, Any]]) -> str:
+    """
+    Merge the results of the chunks of each table and generate the SQL code of all the tables
+    Args:
+        tables: (schema, table, number of chunks) of each table, see create_all_comment_chunks
+        results: result of each chunk, in the same order as the chunks
 
     Returns: SQL code to be executed in the database to add comments
 
+    """
+    sql_code = ''
+    position = 0
+    for schema_name, table_name, number_of_chunks in tables:
+        result = merge_chunk_results(table_name, schema_name, results[position:position + number_of_chunks])
+        position += number_of_chunks
+        # Generating SQL code
+        sql_code += generate_sql_code(result, schema_name, table_name)
+    return sql_code
+
+
+def sql_comment_generator_steps(query: str, database: Engine) -> Generator[Step, Any, str]:
+    """
+    Steps of the SQL comment generator, shared by run_sql_comment_generator and arun_sql_comment_generator (see
+    utils.steps)
     """
     logging.info(f'Running SQL comment generator')
-    info_extractor, table_data, table_metadata = get_info(query, database)
+    info = yield from get_info_steps(query, database)
+    if isinstance(info, str):
+        return info
+    info_extractor, table_data, table_metadata, table_profiles = info
 
     try:
-        sql_code = ''
-        for schema_name, table_names in info_extractor['schemas'].items():
-            for table_name in table_names:
-                # Getting table data
-                columns_info = table_metadata[f'{schema_name}.{table_name}']['columns']
-                pandas_info = table_data[f'{schema_name}.{table_name}']
-                # Processing columns
-                result = process_columns_in_chunks(
-                    table_name,
-                    schema_name,
-                    columns_info,
-                    pandas_info,
-                    chunk_size=20
-                )
-                # Generating SQL code
-                sql_code += generate_sql_code(result, schema_name, table_name)
-        return sql_code
+        tables, chunks = create_all_comment_chunks(info_extractor, table_data, table_metadata, table_profiles)
+        report_progress(f'Writing the comments of {len(tables)} tables in {len(chunks)} requests')
+        results = yield Step(run_comment_chunks, chunks, afunction=arun_comment_chunks)
+        return generate_tables_sql_code(tables, results)
     except Exception as e:
         logging.error(f"Failed to generate the SQL comments: {str(e)}")
         return f"No comments were generated, failed to generate the SQL code, Don't try again: {str(e)}"
+
+
+def run_sql_comment_generator(query: str, database: Engine) -> str:
+    """
+    Run the SQL comment generator
+    Args:
+        query: User question to be processed
+        database: Database connection object
+
+    Returns: SQL code to be executed in the database to add comments
+
+    """
+    return run_steps(sql_comment_generator_steps(query, database))
+
+
+async def arun_sql_comment_generator(query: str, database: Engine) -> str:
+    """
+    Async version of run_sql_comment_generator
+    Args:
+        query: User question to be processed
+        database: Database connection object
+
+    Returns: SQL code to be executed in the database to add comments
+
+    """
+    return await arun_steps(sql_comment_generator_steps(query, database))
@@ -1,7 +1,12 @@
+import asyncio
+import contextvars
 import logging
 import os
-from typing import Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Any, Generator, List
 
+import httpx
 import requests
 from sqlalchemy.engine import Engine
 
@@ -12,95 +17,73 @@ from utils.config_loaders import (
     get_config
 )
 from utils.database import get_table_info
-from utils.metabase import (
-    base_numeric_indicator,
-    base_bar_chart,
-    base_line_chart,
-    base_table,
-    create_numeric_indicator,
-    create_linechart,
-    create_barchart,
-    create_table,
-)
-from utils.metabase import create_metabase_collection, create_metabase_dashboard
+from utils.metabase import create_card, create_metabase_collection, create_metabase_dashboard
+from utils.metabase import CARD_TYPES, acreate_card, acreate_metabase_collection, acreate_metabase_dashboard, apost
+from utils.progress import report_progress
+from utils.steps import Step, arun_steps, run_steps
 
 config = get_config()
+metabase_config = config.get('metabase', {})
+
+
+def card_failure(card_info: Dict[str, Any], error: Exception) -> Dict[str, Any]:
+    """
+    Describe a card that could not be created
+    Args:
+        card_info: query generated by MetabaseCreator
+        error: error raised while creating the card
+
+    Returns: the title and the type of the card and the error
+    """
+    logging.error(f'Error creating {card_info.get("classify")} "{card_info.get("title")}": {error}')
+    return {'title': card_info.get('title'), 'classify': card_info.get('classify'), 'error': str(error)}
 
 
 def process_metabase_queries(
         metabase_queries: List[Dict[str, Any]],
         collection_info: Dict[str, Any]
-) -> List[Dict[str, Any]]:
+) -> Dict[str, List[Dict[str, Any]]]:
     """
-    Process metabase queries and create the corresponding cards
+    Process metabase queries and create the corresponding cards. The cards are created concurrently, up to
+    metabase.max_concurrent_cards at a time (the MetabaseGraph call and the POST of each card), and are returned in
+    the order of the queries so the layout of the dashboard does not change.
     Args:
         metabase_queries: List of metabase queries to be processed
         collection_info: Information about the collection to which the cards will be added
-    Returns: List of responses from the metabase API
+    Returns: The responses of the metabase API for the cards created, in order, and the cards that failed
     """
-    responses = []
-    for card_info in metabase_queries:
-        headers = {
-            "Content-Type": config['secrets']['metabase']['content_type'],
-            "X-Metabase-Session": config['secrets']['metabase']['metabase_session']
-        }
-        metabase_url = config['secrets']['metabase']['metabase_url']
-        database_id = config['secrets']['metabase']['database_id']
-        collection_id = collection_info['id']
-
-        if card_info['classify'] == 'Numeric Indicator':
-            try:
-                responses.append(create_numeric_indicator(
-                    metabase_url=metabase_url,
-                    database_id=database_id,
-                    collection_id=collection_id,
-                    card_info=card_info,
-                    headers=headers,
-                    numeric_indicator_structure=base_numeric_indicator
-                ))
-            except Exception as e:
-                logging.error(f'Error creating numeric indicator: {e}')
-
-        elif card_info['classify'] == 'Bar Chart':
-            try:
-                responses.append(create_barchart(
-                    metabase_url=metabase_url,
-                    database_id=database_id,
-                    collection_id=collection_id,
-                    card_info=card_info,
-                    headers=headers,
-                    barchart_structure=base_bar_chart
-                ))
-            except Exception as e:
-                logging.error(f'Error creating bar chart: {e}')
-
-        elif card_info['classify'] == 'Line Chart':
-            try:
-                responses.append(create_linechart(
-                    metabase_url=metabase_url,
-                    database_id=database_id,
-                    collection_id=collection_id,
-                    card_info=card_info,
-                    headers=headers,
-                    linechart_structure=base_line_chart
-                ))
-            except Exception as e:
-                logging.error(f'Error creating line chart: {e}')
-
-        elif card_info['classify'] == 'Table':
-            try:
-                responses.append(create_table(
-                    metabase_url=metabase_url,
-                    database_id=database_id,
-                    collection_id=collection_id,
-                    card_info=card_info,
-                    headers=headers,
-                    table_structure=base_table
-                ))
-            except Exception as e:
-                logging.error(f'Error creating table: {e}')
+    headers = {
+        "Content-Type": config['secrets']['metabase']['content_type'],
+        "X-Metabase-Session": config['secrets']['metabase']['metabase_session']
+    }
+    created = []
 
-    return responses
+    def create(card_info: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            if card_info['classify'] not in CARD_TYPES:
+                raise ValueError(f'Unknown card type: {card_info["classify"]}')
+            card = create_card(
+                metabase_url=config['secrets']['metabase']['metabase_url'],
+                database_id=config['secrets']['metabase']['database_id'],
+                collection_id=collection_info['id'],
+                card_info=card_info,
+                headers=headers
+            )
+            created.append(card)
+            report_progress(f'Created {len(created)} of {len(metabase_queries)} cards in Metabase')
+            return {'card': card}
+        except Exception as e:
+            return {'failure': card_failure(card_info, e)}
+
+    max_workers = max(min(metabase_config.get('max_concurrent_cards', 4), len(metabase_queries)), 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # each thread reports the progress to the listener of the request (see utils.progress)
+        results = list(executor.map(lambda card_info: contextvars.copy_context().run(create, card_info),
+                                    metabase_queries))
+    return {
+        'cards': [result['card'] for result in results if 'card' in result],
+        'failures': [result['failure'] for result in results if 'failure' in result]
+    }
 
 
 def insert_card_into_dashboard(cards_response: List[Dict[str, Any]], dashboard_id: int) -> None:
@@ -155,60 +138,199 @@ def insert_card_into_dashboard(cards_response: List[Dict[str, Any]], dashboard_i
             response.raise_for_status()
             logging.info(f'Card {card_info["id"]} inserted into dashboard {dashboard_id}')
         except requests.exceptions.RequestException as err:
-            print(f"Error: {err}")
+            logging.error(f'Error inserting card {card_info.get("id")} into dashboard {dashboard_id}: {err}')
     logging.info(f'Cards inserted into dashboard {dashboard_id}')
 
 
-def run_graph_creator(query: str, database: Engine, max_queries: int = 10) -> str:
+def graph_creator_steps(
+        query: str,
+        database: Engine,
+        max_queries: int = 10,
+        client: httpx.AsyncClient = None
+) -> Generator[Step, Any, str]:
     """
-    Run the SQL comment generator and create the corresponding dashboard in Metabase
+    Steps of the graph creator chain, shared by run_graph_creator and arun_graph_creator (see utils.steps)
     Args:
-        max_queries: Maximum number of queries to be generated, the system wil try to generate this number of queries.
         query: User question to be processed.
         database: Database connection object.
+        max_queries: Maximum number of queries to be generated.
+        client: async http client used for the Metabase API by arun_steps, not used by run_steps
 
     Returns: The dashboard url where the queries are stored.
-
     """
     logging.info(f'Running graph creator for query, metabase chain')
+    headers = {
+        "Content-Type": config['secrets']['metabase']['content_type'],
+        "X-Metabase-Session": config['secrets']['metabase']['metabase_session']
+    }
     try:
-        info_extractor = InfoExtractor(query=query).get_result()
-        table_metadata = get_table_info(info_extractor, database)
-        table_data = get_data(info_extractor, database, 10)
-        metabase_queries = MetabaseCreator(
+        report_progress('Finding the tables of the question')
+        info_extractor = yield Step.predict(InfoExtractor(query=query))
+        report_progress('Reading the metadata and sampling the tables')
+        table_metadata = yield Step(get_table_info, info_extractor, database)
+        table_data = yield Step(get_data, info_extractor, database, 10, table_metadata=table_metadata)
+        report_progress('Designing the queries of the dashboard')
+        metabase_queries = yield Step.predict(MetabaseCreator(
             user_question=query,
             table_info=table_data,
             table_metadata=table_metadata,
             engine_type=database.dialect.name,
             model_name=config['default_model_name'],
             number_of_queries=max_queries
-        ).get_result()
+        ))
 
-        collection_info = create_metabase_collection(
+        report_progress(f'Creating the collection "{metabase_queries["dashboard_name"]}" in Metabase')
+        collection_info = yield Step(
+            create_metabase_collection,
+            afunction=partial(acreate_metabase_collection, client),
             parent_id=config['secrets']['metabase']['collection_parent'],
             dashboard_name=metabase_queries['dashboard_name'],
             metabase_url=config['secrets']['metabase']['metabase_url'],
-            headers={
-                "Content-Type": config['secrets']['metabase']['content_type'],
-                "X-Metabase-Session": config['secrets']['metabase']['metabase_session']
-            }
+            headers=headers
         )
 
-        responses = process_metabase_queries(metabase_queries['info_json'], collection_info)
+        report_progress(f'Creating {len(metabase_queries["info_json"])} cards in Metabase')
+        cards = yield Step(
+            process_metabase_queries,
+            metabase_queries['info_json'],
+            collection_info,
+            afunction=partial(aprocess_metabase_queries, client)
+        )
 
-        dashboard_info = create_metabase_dashboard(
+        report_progress('Creating the dashboard and adding the cards')
+        dashboard_info = yield Step(
+            create_metabase_dashboard,
+            afunction=partial(acreate_metabase_dashboard, client),
             collection_id=collection_info['id'],
             dashboard_name=metabase_queries['dashboard_name'],
             metabase_url=config['secrets']['metabase']['metabase_url'],
-            headers={
-                "Content-Type": config['secrets']['metabase']['content_type'],
-                "X-Metabase-Session": config['secrets']['metabase']['metabase_session']
-            }
+            headers=headers
         )
 
-        insert_card_into_dashboard(responses, dashboard_info['id'])
-        return f"""You can check the dashboard created: 
+        yield Step(
+            insert_card_into_dashboard,
+            cards['cards'],
+            dashboard_info['id'],
+            afunction=partial(ainsert_card_into_dashboard, client)
+        )
+        answer = f"""You can check the dashboard created: 
         {config['secrets']['metabase']['metabase_url']}/dashboard/{dashboard_info['id']}"""
+        if cards['failures']:
+            answer += f"\n{len(cards['failures'])} of {len(metabase_queries['info_json'])} cards could not be created: "
+            answer += '; '.join(f"{failure['title']} ({failure['error']})" for failure in cards['failures'])
+        return answer
     except Exception as e:
         logging.error(f"Failed to get the metadata or the dataframe: {str(e)}")
         return f"Failed to create the metabase dashboard, Don't try again: {str(e)}"
+
+
+def run_graph_creator(query: str, database: Engine, max_queries: int = 10) -> str:
+    """
+    Run the SQL comment generator and create the corresponding dashboard in Metabase
+    Args:
+        max_queries: Maximum number of queries to be generated, the system wil try to generate this number of queries.
+        query: User question to be processed.
+        database: Database connection object.
+
+    Returns: The dashboard url where the queries are stored.
+
+    """
+    return run_steps(graph_creator_steps(query, database, max_queries))
+
+
+async def aprocess_metabase_queries(
+        client: httpx.AsyncClient,
+        metabase_queries: List[Dict[str, Any]],
+        collection_info: Dict[str, Any]
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Async version of process_metabase_queries
+    Args:
+        client: async http client used for the Metabase API
+        metabase_queries: List of metabase queries to be processed
+        collection_info: Information about the collection to which the cards will be added
+    Returns: The responses of the metabase API for the cards created, in order, and the cards that failed
+    """
+    headers = {
+        "Content-Type": config['secrets']['metabase']['content_type'],
+        "X-Metabase-Session": config['secrets']['metabase']['metabase_session']
+    }
+    semaphore = asyncio.Semaphore(metabase_config.get('max_concurrent_cards', 4))
+    created = []
+
+    async def create(card_info: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            if card_info['classify'] not in CARD_TYPES:
+                raise ValueError(f'Unknown card type: {card_info["classify"]}')
+            async with semaphore:
+                card = await acreate_card(
+                    client,
+                    metabase_url=config['secrets']['metabase']['metabase_url'],
+                    database_id=config['secrets']['metabase']['database_id'],
+                    collection_id=collection_info['id'],
+                    card_info=card_info,
+                    headers=headers
+                )
+            created.append(card)
+            report_progress(f'Created {len(created)} of {len(metabase_queries)} cards in Metabase')
+            return {'card': card}
+        except Exception as e:
+            return {'failure': card_failure(card_info, e)}
+
+    results = await asyncio.gather(*[create(card_info) for card_info in metabase_queries])
+    return {
+        'cards': [result['card'] for result in results if 'card' in result],
+        'failures': [result['failure'] for result in results if 'failure' in result]
+    }
+
+
+async def ainsert_card_into_dashboard(
+        client: httpx.AsyncClient,
+        cards_response: List[Dict[str, Any]],
+        dashboard_id: int
+) -> None:
+    """
+    Async version of insert_card_into_dashboard
+    Args:
+        client: async http client used for the Metabase API
+        cards_response: List of cards to be inserted
+        dashboard_id: Dashboard id to insert the cards
+    """
+    headers = {
+        "Content-Type": config['secrets']['metabase']['content_type'],
+        "X-Metabase-Session": config['secrets']['metabase']['metabase_session']
+    }
+    url = os.path.join(config['secrets']['metabase']['metabase_url'], 'api', 'dashboard', str(dashboard_id), 'cards')
+
+    for i, card_info in enumerate(cards_response):
+        dashboard_card = {
+            "cardId": card_info['id'],
+            "col": (i % 3) * 6,
+            "row": (i // 3) * 6,
+            "size_x": 6,
+            "size_y": 6,
+            "series": [],
+            "parameter_mappings": [],
+            "visualization_settings": {},
+        }
+        try:
+            await apost(client, url, headers, [dashboard_card])
+            logging.info(f'Card {card_info["id"]} inserted into dashboard {dashboard_id}')
+        except httpx.HTTPError as err:
+            logging.error(f'Error inserting card {card_info["id"]} into dashboard {dashboard_id}: {err}')
+    logging.info(f'Cards inserted into dashboard {dashboard_id}')
+
+
+async def arun_graph_creator(query: str, database: Engine, max_queries: int = 10) -> str:
+    """
+    Async version of run_graph_creator, the model and Metabase are called without blocking the event loop and the
+    database work runs in a worker thread.
+    Args:
+        query: User question to be processed.
+        database: Database connection object.
+        max_queries: Maximum number of queries to be generated, the system wil try to generate this number of queries.
+
+    Returns: The dashboard url where the queries are stored.
+    """
+    async with httpx.AsyncClient() as client:
+        return await arun_steps(graph_creator_steps(query, database, max_queries, client))
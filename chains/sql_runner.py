@@ -1,19 +1,40 @@
 # %%
+import json
 import logging
-from typing import Any, Dict
+import re
+import threading
+from typing import Any, Dict, Generator, List, Optional
 
 import pandas as pd
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
 
 from prompts.column_extractor import ColumnExtractor
 from prompts.info_extractor import InfoExtractor
 from prompts.sql_runner import SQLRunner
-from utils.config_loaders import get_config, get_secrets
-from utils.database import get_table_info, create_db_session
+from utils.config_loaders import get_config
+from utils.database import add_invalidation_listener, connect_with_timeout, get_engine_key, get_read_engine
+from utils.database import get_table_info
+from utils.embeddings import create_embeddings
+from utils.progress import report_progress
+from utils.semantic_cache import SemanticCache
+from utils.steps import Step, arun_steps, run_steps
 
 config = get_config()
-secrets = get_secrets(config)
-engine = create_db_session(secrets['database']['url'])
+query_execution_config = config.get('query_execution', {})
+query_guard_config = config.get('query_guard', {})
+answer_cache_config = config.get('sql_answer_cache', {})
+answer_cache: Optional[SemanticCache] = None
+answer_cache_lock = threading.Lock()
+
+# queries that only read, they can run on the replica
+SELECT_PATTERN = re.compile(r'\s*\(*\s*(SELECT|WITH)\b', re.IGNORECASE)
+
+# question sent to the model when the estimates of its query are above the limits of query_guard
+REWRITE_TEMPLATE = """{input}
+
+The query {query} was rejected because {rejection}. Write a cheaper query: join the tables on their keys, filter the
+rows and aggregate or limit the result."""
 
 
 def select_columns(metadata: Dict[str, Any], selected_columns: Dict) -> Dict:
@@ -31,17 +52,306 @@ def select_columns(metadata: Dict[str, Any], selected_columns: Dict) -> Dict:
     return final_info
 
 
-def sql_runner(
+def run_query(
+        query: str,
+        database: Engine,
+        max_rows: int = None,
+        max_bytes: int = None,
+        fetch_size: int = None
+) -> pd.DataFrame:
+    """
+    Execute the query generated by the model. The rows are read in chunks of fetch_size with a server-side cursor
+    (stream_results) and the reading stops at max_rows or max_bytes, so a query without LIMIT does not load the
+    whole table into the process. DataFrame.attrs['truncated'] tells if rows were left out. The database cancels the
+    query after query_execution.statement_timeout_seconds (see connect_with_timeout).
+    Args:
+        query: SQL query
+        database: Database connection object
+        max_rows: maximum number of rows read, query_execution.max_rows by default
+        max_bytes: maximum size of the values read, measured as text, query_execution.max_bytes by default
+        fetch_size: rows read from the cursor at a time, query_execution.fetch_size by default
+
+    Returns: DataFrame with the result of the query
+    """
+    max_rows = max_rows or query_execution_config.get('max_rows', 1000)
+    max_bytes = max_bytes or query_execution_config.get('max_bytes', 5000000)
+    fetch_size = fetch_size or query_execution_config.get('fetch_size', 500)
+
+    rows = []
+    size = 0
+    truncated = False
+    # the SELECT queries run on the replica when there is one (see get_read_engine)
+    if SELECT_PATTERN.match(query):
+        database = get_read_engine(database)
+    with connect_with_timeout(database, query_execution_config.get('statement_timeout_seconds')) as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=fetch_size).exec_driver_sql(query)
+        try:
+            columns = list(result.keys())
+            while not truncated:
+                chunk = result.fetchmany(min(fetch_size, max_rows + 1 - len(rows)))
+                if not chunk:
+                    break
+                for row in chunk:
+                    size += sum(len(str(value)) for value in row)
+                    if len(rows) >= max_rows or size > max_bytes:
+                        truncated = True
+                        break
+                    rows.append(tuple(row))
+        finally:
+            result.close()
+
+    if truncated:
+        logging.warning(f'The result of the query was truncated to {len(rows)} rows')
+    data = pd.DataFrame.from_records(rows, columns=columns)
+    data.attrs['truncated'] = truncated
+    return data
+
+
+def render_result(result: Dict, max_chars: int = None) -> str:
+    """
+    Render the result of the chain for the agent. The rows are added in chunks until max_chars, so the size of the
+    answer does not depend on the size of the result.
+    Args:
+        result: result of sql_runner
+        max_chars: maximum length of the rendered rows, query_execution.max_result_chars by default
+
+    Returns: the SQL code and the rows as CSV, with a note when rows were left out
+    """
+    data = result.get('data')
+    if not isinstance(data, pd.DataFrame):
+        return str(result)
+    max_chars = max_chars or query_execution_config.get('max_result_chars', 4000)
+    chunk_rows = query_execution_config.get('render_chunk_rows', 50)
+
+    rendered = data.iloc[0:0].to_csv(index=False)
+    shown = 0
+    for start in range(0, len(data), chunk_rows):
+        chunk = data.iloc[start:start + chunk_rows].to_csv(index=False, header=False)
+        if len(rendered) + len(chunk) > max_chars:
+            for line in chunk.splitlines(keepends=True):
+                if len(rendered) + len(line) > max_chars:
+                    break
+                rendered += line
+                shown += 1
+            break
+        rendered += chunk
+        shown += min(chunk_rows, len(data) - start)
+
+    text = f"sql_code: {result['sql_code']}\ndata:\n{rendered}"
+    if shown < len(data):
+        text += f"... {len(data) - shown} more rows not shown\n"
+    if data.attrs.get('truncated'):
+        text += f"The query returned more than {len(data)} rows, only the first {len(data)} were read\n"
+    return text
+
+
+def parse_postgres_plan(plan: Any) -> Dict[str, float]:
+    """
+    Get the estimates of the root node of the plan returned by EXPLAIN (FORMAT JSON) on PostgreSQL
+    Args:
+        plan: the plan, as a JSON string or already decoded
+
+    Returns: the total cost and the rows of the plan
+    """
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    root = plan[0]['Plan']
+    return {'cost': float(root['Total Cost']), 'rows': float(root['Plan Rows'])}
+
+
+def parse_mysql_plan(plan: Any) -> Dict[str, float]:
+    """
+    Get the estimates of the plan returned by EXPLAIN FORMAT=JSON on MySQL, the rows are the largest number of rows
+    produced by a join of the plan
+    Args:
+        plan: the plan, as a JSON string or already decoded
+
+    Returns: the cost and the rows of the plan
+    """
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    def join_rows(node: Any) -> List[float]:
+        if isinstance(node, dict):
+            rows = [float(node['rows_produced_per_join'])] if 'rows_produced_per_join' in node else []
+            return rows + [value for child in node.values() for value in join_rows(child)]
+        if isinstance(node, list):
+            return [value for child in node for value in join_rows(child)]
+        return []
+
+    query_block = plan['query_block']
+    return {
+        'cost': float(query_block.get('cost_info', {}).get('query_cost', 0)),
+        'rows': max(join_rows(query_block), default=0.0)
+    }
+
+
+def explain_query(query: str, database: Engine) -> Optional[Dict[str, float]]:
+    """
+    Estimate the cost and the rows of a query with EXPLAIN, the query is not executed
+    Args:
+        query: SQL query
+        database: Database connection object
+
+    Returns: the cost and the rows estimated by the database, None when the dialect has no estimates (SQLite)
+    """
+    dialect = database.dialect.name
+    timeout_seconds = query_guard_config.get('explain_timeout_seconds', 10)
+    with connect_with_timeout(get_read_engine(database), timeout_seconds) as conn:
+        if dialect == 'postgresql':
+            return parse_postgres_plan(conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {query}').scalar())
+        if dialect == 'mysql':
+            return parse_mysql_plan(conn.exec_driver_sql(f'EXPLAIN FORMAT=JSON {query}').scalar())
+    return None
+
+
+def check_query_cost(query: str, database: Engine) -> Optional[str]:
+    """
+    Check the estimates of the query against query_guard.max_cost and query_guard.max_rows before running it, so a
+    missing join condition does not start a cross join on the database
+    Args:
+        query: SQL query
+        database: Database connection object
+
+    Returns: the reason why the query is rejected, None if it can run
+    """
+    if not query_guard_config.get('enabled', False):
+        return None
+    try:
+        estimate = explain_query(query, database)
+    except SQLAlchemyError as e:
+        # an EXPLAIN that times out is the most likely to be expensive, the query only runs unchecked with fail_open
+        logging.warning(f'The query could not be explained: {e}')
+        if query_guard_config.get('fail_open', False):
+            return None
+        return f'its cost could not be estimated ({e.__class__.__name__}: {str(e).splitlines()[0]})'
+    if estimate is None:
+        return None
+
+    max_cost = query_guard_config.get('max_cost')
+    max_rows = query_guard_config.get('max_rows')
+    if max_cost and estimate['cost'] > max_cost:
+        return f"the estimated cost {estimate['cost']:.0f} is above the limit of {max_cost}"
+    if max_rows and estimate['rows'] > max_rows:
+        return f"the estimated {estimate['rows']:.0f} rows are above the limit of {max_rows}"
+    return None
+
+
+def get_answer_cache() -> SemanticCache:
+    """
+    Get the cache of the answers (sql_answer_cache in the config), created on the first use
+    Returns: the cache shared by the process
+    """
+    global answer_cache
+    with answer_cache_lock:
+        if answer_cache is None:
+            answer_cache = SemanticCache(
+                create_embeddings,
+                similarity_threshold=answer_cache_config.get('similarity_threshold', 0.97),
+                ttl_seconds=answer_cache_config.get('ttl_seconds', 86400),
+                max_entries=answer_cache_config.get('max_entries', 512),
+                match_literals=answer_cache_config.get('match_literals', True)
+            )
+        return answer_cache
+
+
+def get_cached_answer(query: str, database: Engine) -> Optional[Dict]:
+    """
+    Reuse the SQL generated for a similar question (see SemanticCache). The query is executed again to return
+    fresh data unless sql_answer_cache.re_execute is disabled. When the cached query fails, for example after a
+    column was renamed, the answer is removed from the cache and the question is answered from scratch.
+    Args:
+        query: User question
+        database: Database connection object
+
+    Returns: The result of the chain, or None if no similar question was answered
+    """
+    if not answer_cache_config.get('enabled', False):
+        return None
+    try:
+        cached = get_answer_cache().lookup(query, get_engine_key(database))
+    except Exception as e:
+        logging.warning(f'The answer cache is not available: {e}')
+        return None
+    if cached is None:
+        return None
+    if answer_cache_config.get('re_execute', True):
+        try:
+            data = run_query(cached['sql_code'], database)
+        except Exception as e:
+            logging.warning(f'The cached query of "{cached["question"]}" failed, removing it from the cache: {e}')
+            get_answer_cache().discard(cached['question'], get_engine_key(database))
+            return None
+    else:
+        data = cached['data']
+    return {
+        "sql_code": cached['sql_code'],
+        "data": data
+    }
+
+
+def cache_answer(query: str, database: Engine, extract_tables: Dict, result: Dict) -> None:
+    """
+    Store the SQL generated for a question, so similar questions reuse it
+    Args:
+        query: User question
+        database: Database connection object
+        extract_tables: result of the InfoExtractor, the tables used by the query
+        result: result of the chain
+    """
+    if not answer_cache_config.get('enabled', False):
+        return
+    answer = {"sql_code": result['sql_code']}
+    if not answer_cache_config.get('re_execute', True):
+        answer['data'] = result['data']
+    try:
+        get_answer_cache().store(query, get_engine_key(database), extract_tables['schemas'], answer)
+    except Exception as e:
+        logging.warning(f'The answer could not be cached: {e}')
+
+
+def invalidate_answers(database: Engine = None, schema_name: str = None, table_name: str = None) -> int:
+    """
+    Remove the cached answers that use a schema or a table, for example after its structure or its data changed
+    Args:
+        database: Database connection object, None for every database
+        schema_name: Schema name, None for every schema
+        table_name: Table name, None for every table
+
+    Returns: Number of answers removed
+    """
+    if answer_cache is None:
+        return 0
+    return answer_cache.invalidate(
+        get_engine_key(database) if database is not None else None, schema_name, table_name
+    )
+
+
+# the answers built on a table are stale when its metadata changes
+add_invalidation_listener(invalidate_answers)
+
+
+def sql_runner_steps(
         query: str,
         database: Engine,
         top_k: int = 20
-) -> Dict:
+) -> Generator[Step, Any, Dict]:
+    """
+    Steps of the SQL runner chain, shared by sql_runner and asql_runner (see utils.steps)
+    """
     try:
-        extract_tables = InfoExtractor(query=query).get_result()
-        metadata_all_tables = get_table_info(extract_tables, database)
+        cached = yield Step(get_cached_answer, query, database)
+        if cached is not None:
+            return cached
+
+        report_progress('Finding the tables of the question')
+        extract_tables = yield Step.predict(InfoExtractor(query=query))
+        report_progress('Reading the metadata of the tables')
+        metadata_all_tables = yield Step(get_table_info, extract_tables, database)
 
         # for schema_table in list(metadata_all_tables.keys()):
-        select_correct_columns = ColumnExtractor(query=query, table_info=metadata_all_tables).get_result()
+        report_progress('Choosing the columns')
+        select_correct_columns = yield Step.predict(ColumnExtractor(query=query, table_info=metadata_all_tables))
         filter_metadata = select_columns(metadata_all_tables, select_correct_columns)
 
         runner = SQLRunner(
@@ -52,15 +362,30 @@ def sql_runner(
             model_name='gpt-3.5-turbo',
             temperature=0
         )
-        sql_code = runner.get_result()
+        report_progress('Writing the SQL query')
+        sql_code = yield Step.predict(runner)
 
-        with database.connect() as conn:
-            result = pd.read_sql_query(sql_code['query'], conn)
+        rewrites = 0
+        rejection = yield Step(check_query_cost, sql_code['query'], database)
+        while rejection is not None:
+            logging.warning(f'The query was rejected, {rejection}: {sql_code["query"]}')
+            if rewrites >= query_guard_config.get('max_rewrites', 1):
+                raise ValueError(f'The query is too expensive to run, {rejection}')
+            rewrites += 1
+            report_progress('Rewriting the SQL query, it was too expensive')
+            sql_code = yield Step.predict(runner.copy(update={'input': REWRITE_TEMPLATE.format(
+                input=query, query=sql_code['query'], rejection=rejection
+            )}))
+            rejection = yield Step(check_query_cost, sql_code['query'], database)
+
+        report_progress('Running the SQL query')
+        result = yield Step(run_query, sql_code['query'], database)
 
         result = {
             "sql_code": sql_code['query'],
             "data": result
         }
+        yield Step(cache_answer, query, database, extract_tables, result)
 
         return result
     except Exception as e:
@@ -68,3 +393,23 @@ def sql_runner(
         return {
             "Error": f"Error running the SQL runner chain, Don't try again: {str(e)}"
         }
+
+
+def sql_runner(
+        query: str,
+        database: Engine,
+        top_k: int = 20
+) -> Dict:
+    return run_steps(sql_runner_steps(query, database, top_k))
+
+
+async def asql_runner(
+        query: str,
+        database: Engine,
+        top_k: int = 20
+) -> Dict:
+    """
+    Async version of sql_runner, the model is called without blocking the event loop and the database work runs in
+    a worker thread
+    """
+    return await arun_steps(sql_runner_steps(query, database, top_k))
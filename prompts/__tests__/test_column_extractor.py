@@ -1,7 +1,15 @@
+import asyncio
+from unittest.mock import patch
+
+from langchain.chat_models.fake import FakeListChatModel
+
+from prompts import column_extractor as column_extractor_module
 from prompts.column_extractor import ColumnExtractor, Table
 from prompts.info_extractor import InfoExtractor
 from utils.config_loaders import get_config, get_secrets
+from utils import llm
 from utils.database import create_db_session, get_table_info
+from utils.llm import RateLimiter
 import pytest
 
 config = get_config()
@@ -16,6 +24,71 @@ class TestTable:
         assert table.columns == ['column1', 'column2']
 
 
+TABLE_INFO = {
+    'sales.store': {
+        'table': 'sales.store',
+        'columns': [{'column_name': 'store_id', 'type': 'INTEGER'}, {'column_name': 'name', 'type': 'VARCHAR'}]
+    },
+    'sales.sale': {
+        'table': 'sales.sale',
+        'columns': [{'column_name': 'sale_id', 'type': 'INTEGER'}, {'column_name': 'store_id', 'type': 'INTEGER'}]
+    },
+}
+
+
+class TestBatchColumnExtractor:
+
+    def test_batch_single_call(self):
+        model = FakeListChatModel(responses=[
+            '{"tables": [{"table": "sales.sale", "columns": ["store_id"]}, '
+            '{"table": "sales.store", "columns": ["store_id", "name"]}]}'
+        ])
+        with patch.object(ColumnExtractor, 'get_model', return_value=model):
+            result = ColumnExtractor(query='sales by store', table_info=TABLE_INFO).get_result()
+
+        assert list(result.keys()) == ['sales.store', 'sales.sale']
+        assert result['sales.store'] == {'table': 'sales.store', 'columns': ['store_id', 'name']}
+        assert result['sales.sale']['columns'] == ['store_id']
+
+    def test_batch_missing_table_falls_back(self):
+        model = FakeListChatModel(responses=[
+            '{"tables": [{"table": "sales.store", "columns": ["name"]}]}',
+            '{"table": "sales.sale", "columns": ["sale_id"]}'
+        ])
+        with patch.object(ColumnExtractor, 'get_model', return_value=model):
+            result = asyncio.run(ColumnExtractor(query='sales by store', table_info=TABLE_INFO).aget_result())
+
+        assert result['sales.store']['columns'] == ['name']
+        assert result['sales.sale']['columns'] == ['sale_id']
+
+    def test_batch_too_long_uses_one_call_per_table(self, monkeypatch):
+        monkeypatch.setattr(column_extractor_module, 'get_context_window', lambda model_name: 1100)
+        extractor = ColumnExtractor(query='sales by store', table_info=TABLE_INFO)
+        messages, _ = extractor.get_batch_messages()
+        assert messages is None
+
+        model = FakeListChatModel(responses=['{"table": "sales.store", "columns": ["name"]}'])
+        with patch.object(ColumnExtractor, 'get_model', return_value=model):
+            result = extractor.get_result()
+        assert set(result.keys()) == {'sales.store', 'sales.sale'}
+
+    def test_fallback_goes_through_the_rate_limiter(self, monkeypatch):
+        acquired = []
+
+        class RecordingRateLimiter(RateLimiter):
+            def acquire(self, tokens: int = 0) -> None:
+                acquired.append(tokens)
+
+        monkeypatch.setattr(llm, 'rate_limiter', RecordingRateLimiter())
+        extractor = ColumnExtractor(query='sales by store', table_info=TABLE_INFO, batch=False)
+        model = FakeListChatModel(responses=['{"table": "sales.store", "columns": ["name"]}'])
+        with patch.object(ColumnExtractor, 'get_model', return_value=model):
+            extractor.get_result()
+            asyncio.run(extractor.aget_result())
+        assert len(acquired) == 4 and all(tokens > 0 for tokens in acquired)
+        assert acquired[:2] == acquired[2:]
+
+
 class TestSpanishColumnExtractor:
 
     def test_column_extractor_initialization(self):
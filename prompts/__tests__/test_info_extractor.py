@@ -1,4 +1,8 @@
+import asyncio
+from unittest.mock import patch
+
 import pytest
+from langchain.chat_models.fake import FakeListChatModel
 
 from prompts.info_extractor import InfoExtractor, Schema
 
@@ -30,6 +34,15 @@ class TestExtractor:
         assert self.extractor.model_name == 'gpt-3.5-turbo'
         assert self.extractor.temperature == 0
 
+    def test_extractor_async_result(self):
+        extractor = InfoExtractor(query="I need to analyze the sales schema and products table")
+        model = FakeListChatModel(responses=['{"schemas": {"sales": ["products"]}}'])
+
+        with patch.object(InfoExtractor, 'get_model', return_value=model):
+            result = asyncio.run(extractor.aget_result())
+
+        assert result == {'schemas': {'sales': ['products']}}
+
 
 class TestSpanishExtractor:
     @pytest.mark.parametrize(
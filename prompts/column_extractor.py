@@ -1,17 +1,26 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 
 from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain.schema import BaseMessage
 from pydantic import BaseModel, Field
 import logging
 from utils.config_loaders import (
     get_config,
     get_secrets
 )
+from utils.llm import (
+    apredict_and_parse,
+    arun_llm_tasks,
+    count_messages_tokens,
+    get_context_window,
+    predict_and_parse,
+    run_llm_tasks
+)
 
 config = get_config()
-secrets = get_secrets(config)
+column_extractor_config = config.get('column_extractor', {})
 
 EXTRACTOR_TEMPLATE = """
 Your task is to extract relevant information from the table provided. You must identify the most important columns to 
@@ -40,6 +49,32 @@ remember You are strictly limited to extracting information from the provided ta
 """
 
 
+BATCH_EXTRACTOR_TEMPLATE = """
+Your task is to extract relevant information from the tables provided. For each table, you must identify the most 
+important columns to use according the User information. It is crucial that you do not seek additional information 
+beyond what the user has provided. Your primary responsibility is to extract the necessary columns of each table and 
+format them appropriately. Additionally, you should limit your selection to a maximum of 5 columns for each table, 
+ensuring that you choose the most relevant ones.
+
+Don't show any additional information.
+You must return one item for each one of the tables {tables}, with the name of the table exactly as it is written, 
+including the schema. You are strictly limited to the tables and the columns explicitly specified, you are not allowed 
+to include any additional tables or columns beyond the ones provided.
+
+###
+{table_info}
+###
+
+{format_instructions}
+
+User information: {query}
+
+remember You must return one item for each one of the tables {tables}, and you can only use the columns explicitly 
+specified for each table. Select a maximum of 5 columns for each table.
+
+"""
+
+
 class Table(BaseModel):
     table: str = Field(
         description="""
@@ -51,6 +86,10 @@ class Table(BaseModel):
     columns: List[str] = Field(description="List of columns in the table ")
 
 
+class Tables(BaseModel):
+    tables: List[Table] = Field(description="Columns selected for each one of the tables, one item for each table")
+
+
 class ColumnExtractor(BaseModel):
     """
     Column extractor model class
@@ -59,26 +98,27 @@ class ColumnExtractor(BaseModel):
     model_name: str = Field(default='gpt-3.5-turbo', description="Name of the model to use.")
     temperature: int = Field(default=0, description="Temperature of the model to use.")
     table_info: Dict[str, Any] = Field(description="Table information to be extracted")
+    batch: bool = Field(
+        default=column_extractor_config.get('batch', True),
+        description="Extract the columns of all the tables in a single call to the model"
+    )
 
-    def get_result(self) -> Dict:
+    def get_model(self) -> ChatOpenAI:
         """
-        Get the result of the column extractor, this method use the model to extract the columns from one table each
-        time
-        Returns: Dict with the columns extracted from the table for each table,
-        for example: {
-            'public.example': {
-                'table': 'public.example',
-                'columns': ['has_pregnant_traveler']
-            }
-        }
+        Get the chat model used to answer the prompt
         """
-        model = ChatOpenAI(
+        secrets = get_secrets(config)
+        return ChatOpenAI(
             model_name=self.model_name,
             temperature=self.temperature,
             openai_api_key=secrets['openai_api']['token'],
             openai_organization=secrets['openai_api']['organization']
         )
 
+    def get_prompt(self) -> Tuple[ChatPromptTemplate, PydanticOutputParser]:
+        """
+        Get the prompt template and the parser of the answer of the model
+        """
         parser = PydanticOutputParser(pydantic_object=Table)
 
         prompt = ChatPromptTemplate(
@@ -90,20 +130,137 @@ class ColumnExtractor(BaseModel):
                 "format_instructions": parser.get_format_instructions()
             }
         )
+        return prompt, parser
+
+    def get_messages(self, table_name: str) -> Tuple[List[BaseMessage], PydanticOutputParser]:
+        """
+        Get the messages of the prompt that extracts the columns of one table and the parser of the answer
+        Args:
+            table_name: name of the table with its schema
+        """
+        prompt, parser = self.get_prompt()
+        _input = prompt.format_prompt(query=self.query, table_info=self.table_info[table_name], table=table_name)
+        return _input.to_messages(), parser
+
+    def get_batch_messages(self) -> Tuple[Optional[List[BaseMessage]], PydanticOutputParser]:
+        """
+        Get the messages of the prompt that extracts the columns of all the tables at once
+        Returns: the messages, None if there is only one table or they don't fit in the context window of the model,
+        and the parser of the answer
+        """
+        parser = PydanticOutputParser(pydantic_object=Tables)
+        if not self.batch or len(self.table_info) < 2:
+            return None, parser
+
+        prompt = ChatPromptTemplate(
+            messages=[
+                HumanMessagePromptTemplate.from_template(BATCH_EXTRACTOR_TEMPLATE)
+            ],
+            input_variables=["query", "table_info", "tables"],
+            partial_variables={
+                "format_instructions": parser.get_format_instructions()
+            }
+        )
+        table_info = '\n\n'.join(f'{table_name}: {info}' for table_name, info in self.table_info.items())
+        messages = prompt.format_prompt(
+            query=self.query, table_info=table_info, tables=', '.join(self.table_info.keys())
+        ).to_messages()
+
+        # the answer needs room too, one short item for each table
+        max_prompt_tokens = get_context_window(self.model_name) - column_extractor_config.get('answer_tokens', 1000)
+        prompt_tokens = count_messages_tokens(messages, self.model_name)
+        if prompt_tokens > max_prompt_tokens:
+            logging.info(
+                f'The batch prompt has {prompt_tokens} tokens and the limit is {max_prompt_tokens}, extracting the '
+                f'columns of each table separately'
+            )
+            return None, parser
+        return messages, parser
 
+    def split_batch_result(self, result: Dict) -> Dict:
+        """
+        Map the answer of the batch prompt to the tables, the tables missing from the answer are left out
+        Args:
+            result: parsed answer of the batch prompt
+
+        Returns: Dict with the columns extracted for each table, like get_result
+        """
+        table_names = {table_name.lower(): table_name for table_name in self.table_info.keys()}
+        selected_columns = {}
+        for table in result['tables']:
+            table_name = table_names.get(table['table'].strip().lower())
+            if table_name is not None:
+                selected_columns[table_name] = {'table': table_name, 'columns': table['columns']}
+        return selected_columns
+
+    def get_result(self) -> Dict:
+        """
+        Get the result of the column extractor. The columns of all the tables are extracted in a single call to the
+        model, when the prompt is too long for the context window (or a table is missing from the answer) the model
+        is called once for each table, concurrently.
+        Returns: Dict with the columns extracted from the table for each table,
+        for example: {
+            'public.example': {
+                'table': 'public.example',
+                'columns': ['has_pregnant_traveler']
+            }
+        }
+        """
+        model = self.get_model()
         list_selected_columns = {}
 
         try:
             logging.info(f"Extracting columns from {self.table_info.keys()}")
-            for table_name in self.table_info.keys():
-                _input = prompt.format_prompt(query=self.query, table_info=self.table_info[table_name],
-                                              table=table_name)
+            batch_messages, batch_parser = self.get_batch_messages()
+            if batch_messages is not None:
+                list_selected_columns = self.split_batch_result(
+                    predict_and_parse(model, batch_messages, batch_parser)
+                )
 
-                output = model(_input.to_messages())
+            missing_tables = [table_name for table_name in self.table_info.keys()
+                              if table_name not in list_selected_columns]
+            prompts = [self.get_messages(table_name) for table_name in missing_tables]
+            results = run_llm_tasks(
+                [lambda messages=messages, parser=parser: predict_and_parse(model, messages, parser)
+                 for messages, parser in prompts],
+                tokens=[count_messages_tokens(messages, self.model_name) for messages, _ in prompts]
+            )
+            list_selected_columns.update(zip(missing_tables, results))
+
+            return {table_name: list_selected_columns[table_name] for table_name in self.table_info.keys()}
+        except Exception as e:
+            logging.error(f'Error extracting information from the table info: {e}')
+            raise e
+
+    async def aget_result(self) -> Dict:
+        """
+        Async version of get_result
+        Returns: same result as get_result
+        """
+        model = self.get_model()
+
+        list_selected_columns = {}
+
+        try:
+            logging.info(f"Extracting columns from {self.table_info.keys()}")
+            batch_messages, batch_parser = self.get_batch_messages()
+            if batch_messages is not None:
+                list_selected_columns = self.split_batch_result(
+                    await apredict_and_parse(model, batch_messages, batch_parser)
+                )
 
-                list_selected_columns[table_name] = parser.parse(output.content).dict()
+            # the remaining tables are independent, so they are sent to the model at the same time
+            missing_tables = [table_name for table_name in self.table_info.keys()
+                              if table_name not in list_selected_columns]
+            prompts = [self.get_messages(table_name) for table_name in missing_tables]
+            results = await arun_llm_tasks(
+                [lambda messages=messages, parser=parser: apredict_and_parse(model, messages, parser)
+                 for messages, parser in prompts],
+                tokens=[count_messages_tokens(messages, self.model_name) for messages, _ in prompts]
+            )
+            list_selected_columns.update(zip(missing_tables, results))
 
-            return list_selected_columns
+            return {table_name: list_selected_columns[table_name] for table_name in self.table_info.keys()}
         except Exception as e:
             logging.error(f'Error extracting information from the table info: {e}')
             raise e
@@ -1,9 +1,10 @@
 import logging
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain.schema import BaseMessage
 from pandas import DataFrame
 from pydantic import BaseModel, Field
 from pydantic import BaseModel as PydanticBaseModel
@@ -12,9 +13,9 @@ from utils.config_loaders import (
     get_config,
     get_secrets
 )
+from utils.llm import apredict_and_parse, predict_and_parse
 
 config = get_config()
-secrets = get_secrets(config)
 
 EXTRACTOR_TEMPLATE = """
 Your task is to write comments explaining the meaning of each column in the specified tables. Enhance, correct, 
@@ -76,34 +77,26 @@ class CommentCreator(BaseModel):
     schema_name: str = Field(..., description="Name of the schema of the table to create the comments")
     table_info: list = Field(..., description="Metadata information of the tables")
     table_data: DataFrame = Field(..., description="DataFrame that contains the data about the table")
+    table_profile: str = Field(None, description="Statistics of the columns, used instead of the table data")
     model_name: str = Field('gpt-3.5-turbo', description="Name of the model to use.")
     temperature: int = Field(0, description="Temperature of the model to use.")
 
-    def get_result(self) -> Dict:
+    def get_model(self) -> ChatOpenAI:
         """
-        This method is used to get the result of the model. This return the comments of the columns of one table each
-        time.
-        Returns: A dictionary with the name of the table, the schema name and the comments of the columns of the table.
-
-        {
-            'table_name': 'example',
-            'schema_name': 'public',
-            'columns': [
-                {
-                    'column_name': 'has_pregnant_traveler',
-                    'comment': 'Boolean value indicating whether the traveler has a pregnancy or not.'
-                }
-            ]
-        }
-
+        Get the chat model used to answer the prompt
         """
-        model = ChatOpenAI(
+        secrets = get_secrets(config)
+        return ChatOpenAI(
             model_name=self.model_name,
             temperature=self.temperature,
             openai_api_key=secrets['openai_api']['token'],
             openai_organization=secrets['openai_api']['organization']
         )
 
+    def get_prompt(self) -> Tuple[ChatPromptTemplate, PydanticOutputParser]:
+        """
+        Get the prompt template and the parser of the answer of the model
+        """
         parser = PydanticOutputParser(pydantic_object=Table)
 
         prompt = ChatPromptTemplate(
@@ -115,15 +108,60 @@ class CommentCreator(BaseModel):
                 "format_instructions": parser.get_format_instructions()
             }
         )
+        return prompt, parser
+
+    def get_messages(self) -> Tuple[List[BaseMessage], PydanticOutputParser]:
+        """
+        Get the messages sent to the model and the parser of its answer, the profile of the columns replaces the rows
+        of the table when it is available
+        """
+        prompt, parser = self.get_prompt()
+        table_data = self.table_data
+        if self.table_profile:
+            table_data = f'Statistics of the columns, computed from the rows of the table:\n{self.table_profile}'
+        _input = prompt.format_prompt(table_info=self.table_info, table_data=table_data,
+                                      table_name=self.table_name, schema_name=self.schema_name)
+        return _input.to_messages(), parser
 
+    def get_result(self) -> Dict:
+        """
+        This method is used to get the result of the model. This return the comments of the columns of one table each
+        time.
+        Returns: A dictionary with the name of the table, the schema name and the comments of the columns of the table.
+
+        {
+            'table_name': 'example',
+            'schema_name': 'public',
+            'columns': [
+                {
+                    'column_name': 'has_pregnant_traveler',
+                    'comment': 'Boolean value indicating whether the traveler has a pregnancy or not.'
+                }
+            ]
+        }
+
+        """
         try:
             logging.info('Trying to generate the comments of the columns of the table')
-            _input = prompt.format_prompt(table_info=self.table_info, table_data=self.table_data,
-                                          table_name=self.table_name, schema_name=self.schema_name)
+            messages, parser = self.get_messages()
+
+            result = predict_and_parse(self.get_model(), messages, parser)
+
+            return result
+        except Exception as e:
+            logging.error(f'Error generating the comments of the columns of the table: {e}')
+            raise e
 
-            output = model(_input.to_messages())
+    async def aget_result(self) -> Dict:
+        """
+        Async version of get_result, the event loop is not blocked while the model answers
+        Returns: same result as get_result
+        """
+        try:
+            logging.info('Trying to generate the comments of the columns of the table')
+            messages, parser = self.get_messages()
 
-            result = parser.parse(output.content).dict()
+            result = await apredict_and_parse(self.get_model(), messages, parser)
 
             return result
         except Exception as e:
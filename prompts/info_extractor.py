@@ -1,17 +1,18 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain.schema import BaseMessage
 from pydantic import BaseModel, Field
 import logging
 from utils.config_loaders import (
     get_config,
     get_secrets
 )
+from utils.llm import apredict_and_parse, predict_and_parse
 
 config = get_config()
-secrets = get_secrets(config)
 
 
 EXTRACTOR_TEMPLATE = """
@@ -48,19 +49,22 @@ class InfoExtractor(BaseModel):
     model_name: str = Field('gpt-3.5-turbo', description="Name of the model to use.")
     temperature: int = Field(0, description="Temperature of the model to use.")
 
-    def get_result(self) -> Dict:
+    def get_model(self) -> ChatOpenAI:
         """
-        Get result of the info extractor
-        Returns: result of the info extractor a dict that contains the schemas and tables
-        for example: {"schemas": {"schema1": ["table1", "table2"], "schema2": ["table3", "table4"]}}
+        Get the chat model used to answer the prompt
         """
-        model = ChatOpenAI(
+        secrets = get_secrets(config)
+        return ChatOpenAI(
             model_name=self.model_name,
             temperature=self.temperature,
             openai_api_key=secrets['openai_api']['token'],
             openai_organization=secrets['openai_api']['organization']
         )
 
+    def get_prompt(self) -> Tuple[ChatPromptTemplate, PydanticOutputParser]:
+        """
+        Get the prompt template and the parser of the answer of the model
+        """
         parser = PydanticOutputParser(pydantic_object=Schema)
 
         prompt = ChatPromptTemplate(
@@ -72,14 +76,42 @@ class InfoExtractor(BaseModel):
                 "format_instructions": parser.get_format_instructions()
             }
         )
+        return prompt, parser
 
+    def get_messages(self) -> Tuple[List[BaseMessage], PydanticOutputParser]:
+        """
+        Get the messages sent to the model and the parser of its answer
+        """
+        prompt, parser = self.get_prompt()
+        return prompt.format_prompt(query=self.query).to_messages(), parser
+
+    def get_result(self) -> Dict:
+        """
+        Get result of the info extractor
+        Returns: result of the info extractor a dict that contains the schemas and tables
+        for example: {"schemas": {"schema1": ["table1", "table2"], "schema2": ["table3", "table4"]}}
+        """
         try:
             logging.info('Extracting information from the user\'s question...')
-            _input = prompt.format_prompt(query=self.query)
+            messages, parser = self.get_messages()
+
+            result = predict_and_parse(self.get_model(), messages, parser)
+            logging.info(f'Successfully extracted information from the user\'s question: {result}')
+            return result
+        except Exception as e:
+            logging.error(f'Error extracting information from the user\'s question: {e}')
+            raise e
 
-            output = model(_input.to_messages())
+    async def aget_result(self) -> Dict:
+        """
+        Async version of get_result, the event loop is not blocked while the model answers
+        Returns: same result as get_result
+        """
+        try:
+            logging.info('Extracting information from the user\'s question...')
+            messages, parser = self.get_messages()
 
-            result = parser.parse(output.content).dict()
+            result = await apredict_and_parse(self.get_model(), messages, parser)
             logging.info(f'Successfully extracted information from the user\'s question: {result}')
             return result
         except Exception as e:
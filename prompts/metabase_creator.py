@@ -1,17 +1,20 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
 import logging
 from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain.schema import BaseMessage
 from pydantic import BaseModel, Field
 
 from utils.config_loaders import (
     get_config,
     get_secrets
 )
+from utils.compaction import compact_table_context
+from utils.llm import apredict_and_parse, predict_and_parse
 
 config = get_config()
-secrets = get_secrets(config)
+compaction_config = config.get('prompt_compaction', {})
 
 EXTRACTOR_TEMPLATE = """
 Your role will be that of an intelligent system designed to assist in the creation of queries aimed at crafting 
@@ -102,54 +105,103 @@ class MetabaseCreator(BaseModel):
     model_name: str = Field(default='gpt-3.5-turbo', description="Name of the model to use.")
     temperature: int = Field(default=0, description="Temperature of the model to use.")
     number_of_queries: int = Field(default=1, description="Number of queries to create")
+    token_budget: Optional[int] = Field(
+        default=compaction_config.get('metabase_creator_tokens'),
+        description="Maximum tokens of the metadata and the rows of the tables in the prompt"
+    )
 
-    def get_result(self) -> Dict:
+    def get_model(self) -> ChatOpenAI:
         """
-        Get the result of the column extractor, this method use the model to extract the columns from one table each
-        time
-        Returns: Dict with the columns extracted from the table for each table,
-        for example: [{
-                "table_name": "customer",
-                "schema_name": "sales",
-                "title": "Total Sales",
-                "query": "SELECT SUM(salesorderheader.totaldue) AS total_sales FROM sales.salesorderheader",
-                "classify": "Numeric Indicator",
-                "description": "This query calculates the total sales made by the company."
-            }
-        ]
+        Get the chat model used to answer the prompt
         """
-        model = ChatOpenAI(
+        secrets = get_secrets(config)
+        return ChatOpenAI(
             model_name=self.model_name,
             temperature=self.temperature,
             openai_api_key=secrets['openai_api']['token'],
             openai_organization=secrets['openai_api']['organization']
         )
 
+    def get_prompt(self) -> Tuple[ChatPromptTemplate, PydanticOutputParser]:
+        """
+        Get the prompt template and the parser of the answer of the model
+        """
         parser = PydanticOutputParser(pydantic_object=InfoQuery)
 
         prompt = ChatPromptTemplate(
             messages=[
                 HumanMessagePromptTemplate.from_template(EXTRACTOR_TEMPLATE)
             ],
-            input_variables=["user_question", "table_info", "table", "table_metadata", "engine_type", "number_of_queries"],
+            input_variables=["user_question", "table_info", "table_metadata", "engine_type", "number_of_queries"],
             partial_variables={
                 "format_instructions": parser.get_format_instructions()
             }
         )
+        return prompt, parser
+
+    def get_table_context(self) -> Dict[str, str]:
+        """
+        Render the metadata and the rows of the tables for the prompt within the token budget (see
+        compact_table_context)
+        Returns: dictionary with the "metadata" and the "data" text
+        """
+        if not compaction_config.get('enabled', True):
+            return {'metadata': str(self.table_metadata), 'data': str(self.table_info)}
+        return compact_table_context(
+            self.table_metadata, self.table_info, self.token_budget, self.model_name, question=self.user_question
+        )
+
+    def get_messages(self) -> Tuple[List[BaseMessage], PydanticOutputParser]:
+        """
+        Get the messages sent to the model and the parser of its answer
+        """
+        prompt, parser = self.get_prompt()
+        table_context = self.get_table_context()
+        _input = prompt.format_prompt(
+            user_question=self.user_question,
+            table_info=table_context['data'],
+            table_metadata=table_context['metadata'],
+            engine_type=self.engine_type,
+            number_of_queries=self.number_of_queries
+        )
+        return _input.to_messages(), parser
 
+    def get_result(self) -> Dict:
+        """
+        Get the result of the column extractor, this method use the model to extract the columns from one table each
+        time
+        Returns: Dict with the columns extracted from the table for each table,
+        for example: [{
+                "table_name": "customer",
+                "schema_name": "sales",
+                "title": "Total Sales",
+                "query": "SELECT SUM(salesorderheader.totaldue) AS total_sales FROM sales.salesorderheader",
+                "classify": "Numeric Indicator",
+                "description": "This query calculates the total sales made by the company."
+            }
+        ]
+        """
         try:
             logging.info("Generating the sql queries for the dashboard")
-            _input = prompt.format_prompt(
-                user_question=self.user_question,
-                table_info=self.table_info,
-                table_metadata=self.table_metadata,
-                engine_type=self.engine_type,
-                number_of_queries=self.number_of_queries
-            )
+            messages, parser = self.get_messages()
+
+            result = predict_and_parse(self.get_model(), messages, parser)
+            logging.info("SQL queries generated successfully")
+            return result
+        except Exception as e:
+            logging.error(f'Error extracting information from the user\'s question: {e}')
+            raise e
 
-            output = model(_input.to_messages())
+    async def aget_result(self) -> Dict:
+        """
+        Async version of get_result, the event loop is not blocked while the model answers
+        Returns: same result as get_result
+        """
+        try:
+            logging.info("Generating the sql queries for the dashboard")
+            messages, parser = self.get_messages()
 
-            result = parser.parse(output.content).dict()
+            result = await apredict_and_parse(self.get_model(), messages, parser)
             logging.info("SQL queries generated successfully")
             return result
         except Exception as e:
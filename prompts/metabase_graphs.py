@@ -1,16 +1,17 @@
 from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain.schema import BaseMessage
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Tuple
 import logging
 from utils.config_loaders import (
     get_config,
     get_secrets
 )
+from utils.llm import apredict_and_parse, predict_and_parse
 
 config = get_config()
-secrets = get_secrets(config)
 
 
 class NumericIndicator(BaseModel):
@@ -107,14 +108,22 @@ class MetabaseGraph(BaseModel):
     model_name: str = Field(default=config['default_model_name'], description="Name of the model to use.")
     temperature: int = Field(default=0, description="Temperature of the model to use.")
 
-    def get_result(self, pydantic_object=None, card_info: dict = None) -> object:
-        model = ChatOpenAI(
+    def get_model(self) -> ChatOpenAI:
+        """
+        Get the chat model used to answer the prompt
+        """
+        secrets = get_secrets(config)
+        return ChatOpenAI(
             model_name=self.model_name,
             temperature=self.temperature,
             openai_api_key=secrets['openai_api']['token'],
             openai_organization=secrets['openai_api']['organization']
         )
 
+    def get_prompt(self, pydantic_object) -> Tuple[ChatPromptTemplate, PydanticOutputParser]:
+        """
+        Get the prompt template and the parser of the answer of the model
+        """
         parser = PydanticOutputParser(pydantic_object=pydantic_object)
 
         prompt = ChatPromptTemplate(
@@ -126,16 +135,37 @@ class MetabaseGraph(BaseModel):
                 "format_instructions": parser.get_format_instructions()
             }
         )
+        return prompt, parser
+
+    def get_messages(self, pydantic_object, card_info: dict = None) -> Tuple[List[BaseMessage], PydanticOutputParser]:
+        """
+        Get the messages sent to the model and the parser of its answer
+        """
+        prompt, parser = self.get_prompt(pydantic_object)
+        return prompt.format_prompt(card_info=card_info).to_messages(), parser
 
+    def get_result(self, pydantic_object=None, card_info: dict = None) -> object:
         try:
             logging.info(f"trying to get result for {card_info}")
-            _input = prompt.format_prompt(
-                card_info=card_info
-            )
+            messages, parser = self.get_messages(pydantic_object, card_info)
 
-            output = model(_input.to_messages())
+            result = predict_and_parse(self.get_model(), messages, parser)
+
+            return result
+        except Exception as e:
+            logging.error(f'Error extracting information from the user\'s question: {e}')
+            raise e
+
+    async def aget_result(self, pydantic_object=None, card_info: dict = None) -> object:
+        """
+        Async version of get_result, the event loop is not blocked while the model answers
+        Returns: same result as get_result
+        """
+        try:
+            logging.info(f"trying to get result for {card_info}")
+            messages, parser = self.get_messages(pydantic_object, card_info)
 
-            result = parser.parse(output.content).dict()
+            result = await apredict_and_parse(self.get_model(), messages, parser)
 
             return result
         except Exception as e:
@@ -1,16 +1,19 @@
 from langchain.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
+from langchain.schema import BaseMessage
 from pydantic import BaseModel, Field
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 import logging
 from utils.config_loaders import (
     get_config,
     get_secrets
 )
+from utils.compaction import compact_metadata
+from utils.llm import apredict_and_parse, predict_and_parse
 
 config = get_config()
-secrets = get_secrets(config)
+compaction_config = config.get('prompt_compaction', {})
 
 EXTRACTOR_TEMPLATE = """
 Given an input question, first create a syntactically correct {dialect} query to run, 
@@ -58,20 +61,26 @@ class SQLRunner(BaseModel):
     top_k: int = Field(30, description="Number of results to return, rows of the query")
     model_name: str = Field('gpt-3.5-turbo', description="Name of the model to use.")
     temperature: int = Field(0, description="Temperature of the model to use.")
+    token_budget: Optional[int] = Field(
+        compaction_config.get('sql_runner_tokens'), description="Maximum tokens of the metadata in the prompt"
+    )
 
-    def get_result(self) -> Dict:
+    def get_model(self) -> ChatOpenAI:
         """
-        Get result of the info extractor
-        Returns: result of the info extractor a dict that contains the schemas and tables
-        for example: {"schemas": {"schema1": ["table1", "table2"], "schema2": ["table3", "table4"]}}
+        Get the chat model used to answer the prompt
         """
-        model = ChatOpenAI(
+        secrets = get_secrets(config)
+        return ChatOpenAI(
             model_name=self.model_name,
             temperature=self.temperature,
             openai_api_key=secrets['openai_api']['token'],
             openai_organization=secrets['openai_api']['organization']
         )
 
+    def get_prompt(self) -> Tuple[ChatPromptTemplate, PydanticOutputParser]:
+        """
+        Get the prompt template and the parser of the answer of the model
+        """
         parser = PydanticOutputParser(pydantic_object=Query)
 
         prompt = ChatPromptTemplate(
@@ -83,19 +92,57 @@ class SQLRunner(BaseModel):
                 "format_instructions": parser.get_format_instructions()
             }
         )
+        return prompt, parser
 
+    def get_table_info(self) -> str:
+        """
+        Render the metadata of the tables for the prompt, as compact DDL within the token budget (see compact_metadata)
+        Returns: the metadata of the tables as text
+        """
+        if not compaction_config.get('enabled', True):
+            return str(self.table_info)
+        return compact_metadata(self.table_info, self.token_budget, self.model_name, self.input)
+
+    def get_messages(self) -> Tuple[List[BaseMessage], PydanticOutputParser]:
+        """
+        Get the messages sent to the model and the parser of its answer
+        """
+        prompt, parser = self.get_prompt()
+        _input = prompt.format_prompt(
+            input=self.input,
+            table_info=self.get_table_info(),
+            dialect=self.dialect,
+            top_k=self.top_k
+        )
+        return _input.to_messages(), parser
+
+    def get_result(self) -> Dict:
+        """
+        Get result of the info extractor
+        Returns: result of the info extractor a dict that contains the schemas and tables
+        for example: {"schemas": {"schema1": ["table1", "table2"], "schema2": ["table3", "table4"]}}
+        """
         try:
             logging.info('trying to get the sql query')
-            _input = prompt.format_prompt(
-                input=self.input,
-                table_info=self.table_info,
-                dialect=self.dialect,
-                top_k=self.top_k
-            )
+            messages, parser = self.get_messages()
+
+            result = predict_and_parse(self.get_model(), messages, parser)
 
-            output = model(_input.to_messages())
+            return result
+        except Exception as e:
+            logging.error(f'Error extracting information from the user\'s question: {e}')
+            raise e
+
+    async def aget_result(self) -> Dict:
+        """
+        Async version of get_result, the event loop is not blocked while the model answers
+        Returns: same result as get_result
+        """
+        try:
+            logging.info('trying to get the sql query')
+            messages, parser = self.get_messages()
 
-            result = parser.parse(output.content).dict()
+            result = await apredict_and_parse(self.get_model(), messages, parser)
 
             return result
         except Exception as e:
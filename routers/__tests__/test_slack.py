@@ -0,0 +1,193 @@
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.authorization import AuthorizeResult
+from slack_bolt.request.async_request import AsyncBoltRequest
+from slack_sdk.signature import SignatureVerifier
+
+import app
+from routers import slack
+from utils.cache import TTLCache
+from utils.work_queue import WorkQueue
+
+# seconds to import the api in a new process, most of it is spent importing langchain
+IMPORT_BUDGET_SECONDS = 10
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start)
+from routers import slack
+from utils import database
+assert slack.agent is None and slack.handler is None
+assert not database.engines
+assert database.metadata_cache is None
+"""
+
+
+def test_import_app_is_lazy_and_within_budget(tmp_path):
+    # without a secrets file, the import must not need the credentials nor connect to anything
+    env = {'ENV': 'production', 'SECRETS_PATH': str(tmp_path), 'PATH': ''}
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT],
+        cwd=Path(__file__).parents[2],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    assert float(result.stdout.split()[0]) < IMPORT_BUDGET_SECONDS
+
+
+def test_lifespan_warms_up_the_service(monkeypatch):
+    calls = []
+
+    def warm_up():
+        calls.append('warm_up')
+        raise ValueError('no credentials')
+
+    monkeypatch.setattr(slack, 'warm_up', warm_up)
+    with TestClient(app.api) as client:
+        assert calls == ['warm_up']
+        assert client.get('/healthcheck').status_code == 200
+
+
+class FakeSlack:
+
+    def __init__(self):
+        self.messages = []
+        self.updates = []
+
+    async def say(self, text):
+        self.messages.append(text)
+        return {'channel': 'C1', 'ts': str(len(self.messages))}
+
+    async def chat_update(self, channel, ts, text):
+        self.updates.append((channel, ts, text))
+
+
+def test_handle_mentions_answers_in_the_background(monkeypatch):
+    answered = asyncio.Event()
+
+    async def execute_general_agent(text):
+        await answered.wait()
+        return f'answer to {text}'
+
+    monkeypatch.setattr(slack, 'execute_general_agent', execute_general_agent)
+    monkeypatch.setattr(slack, 'work_queue', WorkQueue(workers=1, max_size=1))
+
+    async def run():
+        fake = FakeSlack()
+        for number in range(3):
+            await slack.handle_mentions({'event': {'text': f'question {number}'}}, fake.say, fake)
+            await asyncio.sleep(0)
+        # the listener returns before the agent answers, the third mention does not fit in the queue
+        assert fake.messages == [slack.WORKING_MESSAGE] * 3
+        assert fake.updates == [('C1', '3', slack.BUSY_MESSAGE)]
+
+        answered.set()
+        await slack.work_queue.join()
+        await slack.work_queue.close()
+        assert fake.updates[1:] == [('C1', '1', 'answer to question 0'), ('C1', '2', 'answer to question 1')]
+
+        # a mention without text is answered once and not queued
+        await slack.handle_mentions({'event': {}}, fake.say, fake)
+        assert fake.messages[3:] == ["I'm sorry, there was an error processing your message."]
+        assert slack.work_queue.depth() == 0
+
+    asyncio.run(run())
+
+
+def test_agent_errors_are_answered_once(monkeypatch):
+    class FailingAgent:
+        async def ahandle_request(self, text):
+            raise ValueError('no model')
+
+    monkeypatch.setattr(slack, 'get_agent', lambda: FailingAgent())
+    monkeypatch.setitem(slack.slack_progress_config, 'enabled', False)
+    fake = FakeSlack()
+    asyncio.run(slack.answer_mention('question', fake, 'C1', '1'))
+    assert fake.messages == []
+    assert fake.updates == [('C1', '1', 'Agent error. Please try again.')]
+
+
+def signed_request(body: dict, retry_num: str = None) -> AsyncBoltRequest:
+    body = json.dumps(body)
+    timestamp = str(int(time.time()))
+    headers = {
+        'content-type': 'application/json',
+        'x-slack-request-timestamp': timestamp,
+        'x-slack-signature': SignatureVerifier('secret').generate_signature(timestamp=timestamp, body=body)
+    }
+    if retry_num:
+        headers['x-slack-retry-num'] = retry_num
+        headers['x-slack-retry-reason'] = 'http_timeout'
+    return AsyncBoltRequest(body=body, headers=headers)
+
+
+def test_deduplicate_events_drops_the_retries(monkeypatch):
+    monkeypatch.setattr(slack, 'seen_events', TTLCache())
+    received = []
+
+    async def authorize(**kwargs):
+        return AuthorizeResult(enterprise_id=None, team_id='T1', bot_user_id='U0', bot_id='B0', bot_token='xoxb')
+
+    async def listener(body):
+        received.append(body['event_id'])
+
+    app = AsyncApp(signing_secret='secret', authorize=authorize)
+    app.use(slack.deduplicate_events)
+    app.event('app_mention')(listener)
+
+    def event(event_id):
+        return {'type': 'event_callback', 'team_id': 'T1', 'event_id': event_id, 'event': {
+            'type': 'app_mention', 'text': 'hi', 'user': 'U1', 'channel': 'C1', 'ts': '1'
+        }}
+
+    async def run():
+        first = await app.async_dispatch(signed_request(event('Ev1')))
+        retry = await app.async_dispatch(signed_request(event('Ev1'), retry_num='1'))
+        other = await app.async_dispatch(signed_request(event('Ev2')))
+        await asyncio.sleep(0.1)
+        return first, retry, other
+
+    first, retry, other = asyncio.run(run())
+    assert (first.status, retry.status, other.status) == (200, 200, 200)
+    assert retry.headers['x-slack-no-retry'] == ['1']
+    assert 'x-slack-no-retry' not in first.headers
+    assert received == ['Ev1', 'Ev2']
+
+
+def test_progress_message_is_throttled():
+    async def run():
+        fake = FakeSlack()
+        progress = slack.ProgressMessage(fake, 'C1', '1', min_interval_seconds=0.05)
+        progress('Finding the tables of the question')
+        await asyncio.sleep(0.01)
+        progress('Reading the metadata of the tables')
+        progress('Writing the SQL query')
+        await asyncio.sleep(0.1)
+        progress('Running the SQL query')
+        await progress.close()
+        return fake.updates
+
+    updates = asyncio.run(run())
+    # the stages reported within the interval are merged and the last one is dropped by close
+    assert [text.split('\n')[1] for _, _, text in updates] == [
+        'Finding the tables of the question', 'Writing the SQL query'
+    ]
+
+
+def test_get_cost_class():
+    assert slack.get_cost_class('Create a dashboard with the sales charts') == 'dashboard'
+    assert slack.get_cost_class('Write the documentation of the sales tables') == 'documentation'
+    assert slack.get_cost_class('How many stores are there?') == 'query'
+    assert slack.get_cost_class('hello there') == 'query'
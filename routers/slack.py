@@ -1,61 +1,185 @@
+import asyncio
 import logging
+import threading
+import time
 import traceback
+from functools import partial
+from typing import Optional
 
 from fastapi import APIRouter, Request
-from slack_bolt import App
-from slack_bolt.adapter.fastapi import SlackRequestHandler
+from slack_bolt import BoltResponse
+from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
+from slack_bolt.async_app import AsyncApp
 
 from agents.general_agent import GeneralAgent
+from agents.tool_router import count_keywords
 from utils.config_loaders import (
     get_config
 )
+from utils.cache import create_cache
 from utils.config_loaders import get_secrets
-from utils.database import create_db_session
+from utils.database import get_engine
+from utils.progress import listen_progress
+from utils.work_queue import WorkQueue
 
 config = get_config()
-secrets = get_secrets(config)
+slack_queue_config = config.get('slack_queue', {})
+slack_dedup_config = config.get('slack_dedup', {})
+slack_progress_config = config.get('slack_progress', {})
 
-engine = create_db_session(secrets['database']['url'])
-agent = GeneralAgent(engine=engine, verbose=True)
+WORKING_MESSAGE = 'Working on it...'
+BUSY_MESSAGE = "I'm answering too many questions right now. Please try again in a few minutes."
 
-SLACK_BOT_TOKEN = secrets['slack']['slack_bot_token']
-SLACK_SIGNING_SECRET = secrets['slack']['slack_signing_secret']
-app = App(token=SLACK_BOT_TOKEN, signing_secret=SLACK_SIGNING_SECRET)
+# the agent, its engine and the Slack app are created on the first request or by warm_up (see the lifespan of the
+# api in app.py), so the module is imported without credentials or connections
+agent: Optional[GeneralAgent] = None
+handler: Optional[AsyncSlackRequestHandler] = None
+init_lock = threading.RLock()
+# event_id of the events already received, see deduplicate_events
+seen_events = None
+
+# the mentions are acknowledged at once and answered in the background by a bounded pool of workers, shared fairly
+# by the cost classes of the questions and limited for each user and channel
+work_queue = WorkQueue(
+    workers=slack_queue_config.get('workers', 4),
+    max_size=slack_queue_config.get('max_size', 100),
+    weights=slack_queue_config.get('weights'),
+    limits={
+        'user': slack_queue_config.get('max_per_user', 2),
+        'channel': slack_queue_config.get('max_per_channel', 4)
+    }
+)
 
 router = APIRouter()
-handler = SlackRequestHandler(app)
 
 
-def execute_general_agent(text, say) -> str:
+def get_agent() -> GeneralAgent:
+    """
+    Get the agent shared by the requests, created on the first use with the shared engine (see get_engine)
+
+    Returns: The agent.
+    """
+    global agent
+    with init_lock:
+        if agent is None:
+            agent = GeneralAgent(engine=get_engine(), verbose=True)
+        return agent
+
+
+def create_slack_app() -> AsyncApp:
+    """
+    Create the Slack app with the tokens of the secrets file and register its listeners
+
+    Returns: The Slack app.
+    """
+    secrets = get_secrets(config)
+    app = AsyncApp(
+        token=secrets['slack']['slack_bot_token'],
+        signing_secret=secrets['slack']['slack_signing_secret']
+    )
+    if slack_dedup_config.get('enabled', True):
+        app.use(deduplicate_events)
+    app.event("app_mention")(handle_mentions)
+    app.error(custom_error_handler)
+    return app
+
+
+def get_slack_handler() -> AsyncSlackRequestHandler:
+    """
+    Get the handler of the Slack requests, the Slack app is created on the first use
+
+    Returns: The request handler.
+    """
+    global handler
+    with init_lock:
+        if handler is None:
+            handler = AsyncSlackRequestHandler(create_slack_app())
+        return handler
+
+
+def get_seen_events():
+    """
+    Get the store of the event_id already received (slack_dedup in the config), created on the first use. The
+    sqlite and redis backends are shared by the processes and the instances of the service.
+
+    Returns: The cache of the seen events.
+    """
+    global seen_events
+    with init_lock:
+        if seen_events is None:
+            seen_events = create_cache(
+                backend=slack_dedup_config.get('backend', 'memory'),
+                ttl_seconds=slack_dedup_config.get('ttl_seconds', 3600),
+                max_entries=slack_dedup_config.get('max_entries', 10000),
+                path=slack_dedup_config.get('path'),
+                url=slack_dedup_config.get('url'),
+                namespace='slack_events'
+            )
+        return seen_events
+
+
+async def deduplicate_events(body, request, next):
+    """
+    Middleware of the Slack app that drops the events already received. Slack delivers an event again, with the
+    X-Slack-Retry-Num header, when the first delivery is not acknowledged in time, and the same event can reach
+    two instances at once. Only the first delivery of each event_id reaches the listeners, the duplicates are
+    acknowledged and Slack is asked not to retry them. The middleware runs after the verification of the signature.
+
+    Args:
+        body: The body of the request.
+        request: The Bolt request, with the headers.
+        next: coroutine function that runs the next middleware and the listeners.
+
+    Returns: The response to Slack for the duplicates, None otherwise.
+    """
+    event_id = body.get('event_id')
+    if event_id is None:
+        return await next()
+    retry_num = (request.headers.get('x-slack-retry-num') or [None])[0]
+    if await asyncio.to_thread(get_seen_events().add, event_id, retry_num):
+        return await next()
+
+    retry_reason = (request.headers.get('x-slack-retry-reason') or [None])[0]
+    logging.info(f'Dropping the duplicate of the Slack event {event_id}, retry {retry_num} ({retry_reason})')
+    return BoltResponse(status=200, body='', headers={'x-slack-no-retry': '1'})
+
+
+def warm_up() -> None:
+    """
+    Create the Slack app, the engine and the agent before the first request arrives
+    """
+    get_slack_handler()
+    get_agent()
+
+
+async def execute_general_agent(text) -> str:
     """
     Custom function to process the text and return a response.
     In this example, the function converts the input text to uppercase.
 
     Args:
-        say: function to send a response to the channel.
         text (str): The input text to process.
 
     Returns:
-        str: The processed text.
+        str: The processed text, or the error message to show in the placeholder message.
     """
     try:
-        response = agent.handle_request(text)
+        general_agent = await asyncio.to_thread(get_agent)
+        response = await general_agent.ahandle_request(text)
         return response
     except Exception as e:
         logging.error('Error occurred when executing the general agent: %s', str(e))
         logging.error('traceback: %s', traceback.format_exc())
-        say("Agent error. Please try again.")
         return 'Agent error. Please try again.'
 
 
-def get_body_question(body, say) -> str:
+def get_body_question(body) -> Optional[str]:
     """
     Function to get the text from the body of the request.
     Args:
         body: The body of the request.
-        say: function to send a response to the channel.
 
-    Returns: The text from the body of the request.
+    Returns: The text from the body of the request, None if there is no text.
     """
     try:
         text = body["event"]["text"]
@@ -63,40 +187,138 @@ def get_body_question(body, say) -> str:
     except KeyError as e:
         logging.error('KeyError occurred when processing the body: %s', str(e))
         logging.error('traceback: %s', traceback.format_exc())
-        say("I'm sorry, there was an error processing your message.")
-        return 'There was an error processing your message. no text found in body'
+        return None
 
 
-@app.event("app_mention")
-def handle_mentions(body, say):
+class ProgressMessage:
+    """
+    Shows the progress of the chains (see utils.progress) in the placeholder message of a mention. The message is
+    edited in place with chat_update, at most once every min_interval_seconds, and only the last stage reported in
+    the meantime is shown. The stages can be reported from worker threads.
+    """
+
+    def __init__(self, client, channel: str, ts: str, min_interval_seconds: float = 2):
+        """
+        Args:
+            client: Slack web client
+            channel: channel of the placeholder message
+            ts: timestamp of the placeholder message
+            min_interval_seconds: minimum time between two updates of the message
+        """
+        self.client = client
+        self.channel = channel
+        self.ts = ts
+        self.min_interval_seconds = min_interval_seconds
+        self.loop = asyncio.get_running_loop()
+        self.last_update = 0.0
+        self.stage: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def __call__(self, stage: str) -> None:
+        self.loop.call_soon_threadsafe(self._schedule, stage)
+
+    def _schedule(self, stage: str) -> None:
+        self.stage = stage
+        if self.task is None or self.task.done():
+            self.task = self.loop.create_task(self._update())
+
+    async def _update(self) -> None:
+        await asyncio.sleep(max(self.last_update + self.min_interval_seconds - time.monotonic(), 0))
+        self.last_update = time.monotonic()
+        try:
+            await self.client.chat_update(channel=self.channel, ts=self.ts, text=f'{WORKING_MESSAGE}\n{self.stage}')
+        except Exception as e:
+            logging.warning(f'Error updating the progress message: {e}')
+
+    async def close(self) -> None:
+        """
+        Drop the pending update, so it does not overwrite the answer
+        """
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+async def answer_mention(text: str, client, channel: str, ts: str) -> None:
+    """
+    Run the agent for a mention and replace the placeholder message with the answer, the message shows the stage
+    of the chains in the meantime (see ProgressMessage). Called by the workers of work_queue.
+
+    Args:
+        text: The question of the mention.
+        client: Slack web client.
+        channel: Channel of the placeholder message.
+        ts: Timestamp of the placeholder message.
+    """
+    if slack_progress_config.get('enabled', True):
+        progress = ProgressMessage(client, channel, ts, slack_progress_config.get('min_interval_seconds', 2))
+        with listen_progress(progress):
+            response = await execute_general_agent(text)
+        await progress.close()
+    else:
+        response = await execute_general_agent(text)
+    logging.info(f"Response Agent: {response}")
+    await client.chat_update(channel=channel, ts=ts, text=str(response))
+
+
+def get_cost_class(text: str) -> str:
+    """
+    Guess the cost class of a question from the keywords of the tools (tool_router.keywords in the config), the
+    class of the tool with the most keywords in the question (slack_queue.cost_classes)
+
+    Args:
+        text: The question.
+
+    Returns: The cost class, slack_queue.default_class when no keyword is found.
+    """
+    keywords = config.get('tool_router', {}).get('keywords') or {}
+    cost_classes = slack_queue_config.get('cost_classes') or {}
+    matches = {tool: count_keywords(text, keywords.get(tool, [])) for tool in cost_classes}
+    tool = max(matches, key=matches.get, default=None)
+    if tool is None or not matches[tool]:
+        return slack_queue_config.get('default_class', 'query')
+    return cost_classes[tool]
+
+
+async def handle_mentions(body, say, client):
     """
     Event listener for mentions in Slack.
-    When the bot is mentioned, this function processes the text and sends a response.
+    When the bot is mentioned, this function posts a placeholder message and queues the question, the listener
+    returns right away so the event is acknowledged within the deadline of Slack and is not delivered again. The
+    placeholder is replaced with the answer when it is ready (see answer_mention).
 
     Args:
         body (dict): The event data received from Slack.
-        say (callable): A function for sending a response to the channel.
+        say (callable): A coroutine function for sending a response to the channel.
+        client: Slack web client, used to update the placeholder message.
     """
-    text = get_body_question(body, say)
+    text = get_body_question(body)
+    if text is None:
+        await say("I'm sorry, there was an error processing your message.")
+        return
     logging.info(f"Received message: {text}")
-    response = execute_general_agent(text, say)
-    logging.info(f"Response Agent: {response}")
-    say(response)
+    placeholder = await say(WORKING_MESSAGE)
+    channel, ts = placeholder['channel'], placeholder['ts']
+    cost_class = get_cost_class(text)
+    owners = {'user': body['event'].get('user'), 'channel': body['event'].get('channel', channel)}
+    if not work_queue.submit(partial(answer_mention, text, client, channel, ts), cost_class, owners):
+        await client.chat_update(channel=channel, ts=ts, text=BUSY_MESSAGE)
+        return
+    logging.info(f'Queued a {cost_class} question, {work_queue.depth()} questions waiting')
 
 
 @router.post("/events")
 async def slack_events(req: Request):
     """
     Route for handling Slack events.
-    This function passes the incoming HTTP request to the SlackRequestHandler for processing.
+    This function passes the incoming HTTP request to the AsyncSlackRequestHandler for processing.
 
     Returns:
         Response: The result of handling the request.
     """
-    return await handler.handle(req)
+    return await get_slack_handler().handle(req)
 
 
-@app.error
-def custom_error_handler(error, body, logger):
+async def custom_error_handler(error, body, logger):
     logger.exception(f"Error: {error}")
     logger.info(f"Request body: {body}")
@@ -1,9 +1,9 @@
 from langchain.tools.base import BaseTool
 from sqlalchemy.engine import Engine
 
-from chains.document_tables import run_sql_comment_generator
-from chains.metabase import run_graph_creator
-from chains.sql_runner import sql_runner
+from chains.document_tables import arun_sql_comment_generator, run_sql_comment_generator
+from chains.metabase import arun_graph_creator, run_graph_creator
+from chains.sql_runner import asql_runner, render_result, sql_runner
 
 
 class QuerySQLDataBaseTool(BaseTool):
@@ -21,10 +21,12 @@ If an error is returned, rewrite the user's input question, check the result, an
     def _run(self, question: str) -> str:
         """Execute the query, return the results or an error message."""
         result = sql_runner(question.lower(), self.engine, 10)
-        return str(result)
+        return render_result(result)
 
-    async def _arun(self, query: str) -> str:
-        raise NotImplementedError("QuerySqlDbTool does not support async")
+    async def _arun(self, question: str) -> str:
+        """Execute the query without blocking the event loop, return the results or an error message."""
+        result = await asql_runner(question.lower(), self.engine, 10)
+        return render_result(result)
 
 
 class SQlCommentGenerator(BaseTool):
@@ -43,8 +45,10 @@ user's question, verify the result, and try again. It is expected that all resul
         sql_code = run_sql_comment_generator(question.lower(), self.engine)
         return sql_code
 
-    async def _arun(self, query: str) -> str:
-        raise NotImplementedError("SQlCommentGenerator does not support async")
+    async def _arun(self, question: str) -> str:
+        """Execute the query without blocking the event loop, return the results or an error message."""
+        sql_code = await arun_sql_comment_generator(question.lower(), self.engine)
+        return sql_code
 
 
 class DummyTool(BaseTool):
@@ -57,8 +61,8 @@ None Input Action
     def _run(self, question: str) -> str:
         return "Pass to the final answer\n"
 
-    async def _arun(self, query: str) -> str:
-        raise NotImplementedError("DummyTool does not support async")
+    async def _arun(self, question: str) -> str:
+        return "Pass to the final answer\n"
 
 
 class MetabaseCreator(BaseTool):
@@ -76,5 +80,7 @@ This tools creates a dashboard in metabase with the user input question, and ret
         url_dashboard = run_graph_creator(question.lower(), self.engine, self.max_queries)
         return url_dashboard
 
-    async def _arun(self, query: str) -> str:
-        raise NotImplementedError("SQlCommentGenerator does not support async")
+    async def _arun(self, question: str) -> str:
+        """Execute the query without blocking the event loop, return the results or an error message."""
+        url_dashboard = await arun_graph_creator(question.lower(), self.engine, self.max_queries)
+        return url_dashboard
@@ -0,0 +1,18 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from utils.database import invalidate_table_info
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    sqlite_engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with sqlite_engine.begin() as conn:
+        conn.execute(text('CREATE TABLE store (id INTEGER PRIMARY KEY, name VARCHAR(50))'))
+        conn.execute(text('CREATE TABLE sale (id INTEGER PRIMARY KEY, store_id INTEGER REFERENCES store(id))'))
+        conn.execute(text('CREATE TABLE customer (id INTEGER PRIMARY KEY, country VARCHAR(2), notes TEXT)'))
+        conn.execute(text('INSERT INTO customer (id, country, notes) VALUES (:id, :country, :notes)'), [
+            {'id': i, 'country': 'CO' if i % 4 else 'US', 'notes': None if i % 2 else 'vip'} for i in range(1, 101)
+        ])
+    invalidate_table_info()
+    return sqlite_engine
@@ -0,0 +1,134 @@
+import time
+
+from utils.cache import RedisCache, SQLiteCache, TTLCache, create_cache
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(ttl_seconds=None, max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_ttl_cache_expiration(monkeypatch):
+    cache = TTLCache(ttl_seconds=10)
+    cache.set('a', 1)
+    now = time.time()
+    monkeypatch.setattr('utils.cache.time.time', lambda: now + 11)
+    assert cache.get('a') is None
+    assert cache.misses == 1
+
+
+def test_ttl_cache_invalidate():
+    cache = TTLCache()
+    cache.set(('db', 'sales', 'store'), 1)
+    cache.set(('db', 'sales', 'customer'), 2)
+    cache.set(('db', 'person', 'person'), 3)
+    assert cache.invalidate(lambda key: key[1] == 'sales') == 2
+    assert cache.get(('db', 'person', 'person')) == 3
+    assert cache.invalidate() == 1
+    assert len(cache) == 0
+
+
+def test_ttl_cache_persistence(tmp_path):
+    persist_path = tmp_path / 'cache.json'
+    cache = TTLCache(persist_path=str(persist_path))
+    cache.set(('db', 'sales', 'store'), [{'column_name': 'id'}])
+    cache.save()
+
+    restored = TTLCache(persist_path=str(persist_path))
+    assert restored.get(('db', 'sales', 'store')) == [{'column_name': 'id'}]
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    cache = SQLiteCache(tmp_path / 'cache.sqlite', ttl_seconds=None)
+    cache.set(('model', 'how many sales'), [0.1, 0.2])
+    other = SQLiteCache(tmp_path / 'cache.sqlite', ttl_seconds=None)
+    assert other.get(('model', 'how many sales')) == [0.1, 0.2]
+    assert other.hits == 1
+    assert other.get(('model', 'other')) is None
+    assert other.misses == 1
+    assert len(other) == 1
+
+
+def test_sqlite_cache_expiration_and_invalidate(tmp_path, monkeypatch):
+    cache = SQLiteCache(tmp_path / 'cache.sqlite', ttl_seconds=10)
+    cache.set(('db', 'sales', 'store'), 1)
+    cache.set(('db', 'sales', 'customer'), 2)
+    cache.set(('db', 'hr', 'employee'), 3)
+    assert cache.invalidate(lambda key: key[1] == 'sales') == 2
+    assert ('db', 'hr', 'employee') in cache
+
+    now = time.time()
+    monkeypatch.setattr('utils.cache.time.time', lambda: now + 11)
+    assert cache.get(('db', 'hr', 'employee')) is None
+    assert len(cache) == 0
+
+
+def test_add_stores_only_new_or_expired_keys(tmp_path, monkeypatch):
+    now = time.time()
+    for cache in (TTLCache(ttl_seconds=10), SQLiteCache(tmp_path / 'cache.sqlite', ttl_seconds=10)):
+        monkeypatch.setattr('utils.cache.time.time', lambda: now)
+        assert cache.add('event', 1)
+        assert not cache.add('event', 2)
+        assert cache.get('event') == 1
+        monkeypatch.setattr('utils.cache.time.time', lambda: now + 11)
+        assert cache.add('event', 3)
+        assert cache.get('event') == 3
+
+    # two processes that share the file, only one of them adds the key
+    other = SQLiteCache(tmp_path / 'cache.sqlite', ttl_seconds=10)
+    assert not other.add('event', 4)
+    assert other.add('other event', 4)
+
+
+class FakeRedis:
+    """Minimal stand-in of the redis client, without expiration"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value.encode()
+        return True
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key.decode() if isinstance(key, bytes) else key, None)
+
+    def scan_iter(self, match):
+        return [key.encode() for key in list(self.data) if key.startswith(match.rstrip('*'))]
+
+
+def test_redis_cache():
+    cache = RedisCache(ttl_seconds=60, namespace='test', client=FakeRedis())
+    cache.set(('model', 0, 'hash'), {'query': 'SELECT 1'})
+    assert cache.get(('model', 0, 'hash')) == {'query': 'SELECT 1'}
+    assert ('model', 0, 'other') not in cache
+    assert cache.get(('model', 0, 'other')) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.invalidate(lambda key: key[0] == 'model') == 1
+    assert len(cache) == 0
+    assert cache.add('event', 1)
+    assert not cache.add('event', 2)
+    assert cache.get('event') == 1
+
+
+def test_create_cache(tmp_path):
+    assert isinstance(create_cache('memory'), TTLCache)
+    assert isinstance(create_cache('sqlite', path=tmp_path / 'cache.sqlite'), SQLiteCache)
+    # a redis server that does not answer falls back to the memory cache
+    assert isinstance(create_cache('redis', url='redis://127.0.0.1:1/0'), TTLCache)
@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+
+from utils.compaction import compact_metadata, compact_table_context, render_metadata, render_table_ddl
+from utils.llm import count_tokens
+
+COLUMNS = [
+    {
+        'column_name': 'id', 'type': 'INTEGER', 'comment': None, 'is_foreign_key': False, 'is_primary_key': True,
+        'foreign_key_tables': None
+    },
+    {
+        'column_name': 'store_id', 'type': 'INTEGER', 'comment': 'Store of the sale', 'is_foreign_key': True,
+        'is_primary_key': False, 'foreign_key_tables': ['sales.store.id', 'sales.store.id']
+    },
+]
+METADATA = {'sales.sale': {'table': 'sales.sale', 'columns': COLUMNS}}
+
+
+def test_render_table_ddl():
+    assert render_table_ddl('sales.sale', COLUMNS) == (
+        'TABLE sales.sale (\n'
+        '  id INTEGER PRIMARY KEY,\n'
+        '  store_id INTEGER REFERENCES sales.store.id -- Store of the sale\n'
+        ')'
+    )
+    assert 'None' not in render_metadata(METADATA)
+    assert '--' not in render_metadata(METADATA, include_comments=False)
+
+
+def test_compact_metadata_drops_comments_over_budget():
+    assert 'Store of the sale' in compact_metadata(METADATA)
+    budget = count_tokens(render_metadata(METADATA, include_comments=False), 'gpt-3.5-turbo')
+    assert 'Store of the sale' not in compact_metadata(METADATA, budget)
+
+
+def wide_table(table_name: str, columns: int):
+    return {'table': table_name, 'columns': [
+        {'column_name': f'{table_name.split(".")[-1]}_column_{i}', 'type': 'VARCHAR(255)', 'is_primary_key': i == 0}
+        for i in range(columns)
+    ]}
+
+
+def test_compact_metadata_trims_columns_and_tables_over_budget():
+    metadata = {'sales.store': wide_table('sales.store', 40), 'sales.sale': wide_table('sales.sale', 40)}
+    question = 'total of sale column 33 by month'
+    budget = count_tokens(render_metadata(metadata, include_comments=False), 'gpt-3.5-turbo') // 3
+    compacted = compact_metadata(metadata, budget, question=question)
+    assert count_tokens(compacted, 'gpt-3.5-turbo') <= budget
+    # the keys and the columns named in the question are kept, in their order
+    assert 'sale_column_0 VARCHAR(255) PRIMARY KEY' in compacted
+    assert 'sale_column_33 VARCHAR(255)\n)' in compacted
+    assert 'sale_column_39' not in compacted
+
+    budget = count_tokens(render_metadata({'sales.sale': wide_table('sales.sale', 1)}), 'gpt-3.5-turbo')
+    compacted = compact_metadata(metadata, budget, question=question)
+    # one column of the table named in the question, the column named in the question goes before the key
+    assert compacted == 'TABLE sales.sale (\n  sale_column_33 VARCHAR(255)\n)'
+
+    with pytest.raises(ValueError, match='does not fit'):
+        compact_metadata(metadata, 1)
+
+
+def test_compact_table_context_trims_rows():
+    data = {'sales.sale': pd.DataFrame({'id': range(10), 'store_id': ['x' * 100] * 10})}
+    context = compact_table_context(METADATA, data, max_rows=10, max_value_length=5)
+    assert context['data'].count('xxxxx...') == 10
+
+    budget = count_tokens(context['metadata'], 'gpt-3.5-turbo') + count_tokens(context['data'], 'gpt-3.5-turbo') // 2
+    trimmed = compact_table_context(METADATA, data, budget, max_rows=10, max_value_length=5)
+    assert 0 < trimmed['data'].count('xxxxx...') < 10
+    assert count_tokens(trimmed['metadata'] + trimmed['data'], 'gpt-3.5-turbo') <= budget
+
+    metadata_budget = count_tokens(context['metadata'], 'gpt-3.5-turbo')
+    assert compact_table_context(METADATA, data, metadata_budget)['data'] == ''
+
+
+def test_compact_table_context_renders_missing_values_as_null():
+    data = {'sales.sale': pd.DataFrame({'id': [1.0, float('nan')], 'sold_at': pd.to_datetime(['2023-01-01', None])})}
+    context = compact_table_context(METADATA, data)
+    assert 'nan' not in context['data'] and 'NaT' not in context['data']
+    assert context['data'].splitlines()[-1] == 'NULL | NULL'
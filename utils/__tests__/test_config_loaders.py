@@ -1,4 +1,6 @@
 import logging
+import os
+import time
 from pathlib import Path
 
 import pytest
@@ -93,3 +95,35 @@ def test_setup_logging():
     }
     setup_logging(config)
     assert logging.getLogger().level == logging.INFO
+
+
+def test_load_yaml_file_is_parsed_once_per_modification(monkeypatch, tmp_path):
+    yaml_file_path = tmp_path / 'test.yaml'
+    with open(yaml_file_path, 'w') as file:
+        yaml.dump({'section': {'key': 'value'}}, file)
+    calls = []
+    safe_load = yaml.safe_load
+    monkeypatch.setattr(yaml, 'safe_load', lambda stream: calls.append(stream) or safe_load(stream))
+
+    content = load_yaml_file(yaml_file_path)
+    content['section']['key'] = 'changed'
+    assert load_yaml_file(yaml_file_path) == {'section': {'key': 'value'}}
+    assert len(calls) == 1
+
+    with open(yaml_file_path, 'w') as file:
+        yaml.dump({'section': {'key': 'new value'}}, file)
+    os.utime(yaml_file_path, (time.time() + 10, time.time() + 10))
+    assert load_yaml_file(yaml_file_path) == {'section': {'key': 'new value'}}
+    assert len(calls) == 2
+
+
+def test_load_yaml_file_logs_a_missing_file_once(tmp_path, caplog):
+    yaml_file_path = tmp_path / 'production.yaml'
+    with caplog.at_level(logging.ERROR):
+        assert load_yaml_file(yaml_file_path) == {}
+        assert load_yaml_file(yaml_file_path) == {}
+    assert len([record for record in caplog.records if 'not found' in record.message]) == 1
+
+    with open(yaml_file_path, 'w') as file:
+        yaml.dump({'section': {'key': 'value'}}, file)
+    assert load_yaml_file(yaml_file_path) == {'section': {'key': 'value'}}
@@ -1,7 +1,21 @@
+from contextlib import contextmanager
+
 import pytest
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
 
+from utils import database
 from utils.config_loaders import get_secrets, get_config
-from utils.database import create_db_session, get_table_info
+from utils.database import (
+    choose_sampling_strategy,
+    create_db_session,
+    get_column_kind,
+    get_data,
+    get_table_info,
+    invalidate_table_info,
+    sample_table,
+    sample_tables
+)
 
 config = get_config()
 secrets = get_secrets(config)
@@ -31,3 +45,240 @@ def test_get_table_info():
 
     with pytest.raises(Exception):
         get_table_info({}, engine)
+
+
+def test_get_table_info_uses_cache(sqlite_engine, mocker):
+    schema = {
+        'schemas': {
+            'main': ['store', 'sale']
+        }
+    }
+    reflect = mocker.spy(database, 'reflect_schema_tables')
+
+    result = get_table_info(schema, sqlite_engine)
+    assert reflect.call_count == 1
+    assert [column['column_name'] for column in result['main.store']['columns']] == ['id', 'name']
+    assert result['main.sale']['columns'][1]['is_foreign_key']
+
+    cached_result = get_table_info(schema, sqlite_engine)
+    assert reflect.call_count == 1
+    assert cached_result == result
+
+    assert invalidate_table_info(sqlite_engine, schema_name='main', table_name='store') == 1
+    get_table_info(schema, sqlite_engine)
+    assert reflect.call_count == 2
+    assert reflect.call_args.args[1] == ['store']
+
+
+def test_get_table_info_bulk_matches_table_reflection(sqlite_engine):
+    schema = {
+        'schemas': {
+            'main': ['store', 'sale']
+        }
+    }
+    bulk_result = get_table_info(schema, sqlite_engine, use_cache=False)
+    table_result = get_table_info(schema, sqlite_engine, use_cache=False, bulk=False)
+    assert bulk_result == table_result
+
+    with pytest.raises(Exception):
+        get_table_info({'schemas': {'main': ['missing_table']}}, sqlite_engine, use_cache=False)
+
+
+class FakeResult:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def mappings(self):
+        return self
+
+    def all(self):
+        return self.rows
+
+
+class FakePostgresEngine:
+    """
+    Engine that answers the catalog queries of reflect_schema_tables_postgres with fixed rows
+    """
+
+    def __init__(self, results):
+        self.dialect = postgresql.dialect()
+        self.results = results
+
+    @contextmanager
+    def connect(self):
+        yield self
+
+    def execute(self, query, params=None):
+        return FakeResult(self.results[query])
+
+
+def test_reflect_schema_tables_postgres_reports_the_types_like_the_inspector():
+    columns = [
+        ('id', 'integer', True), ('total', 'numeric(10,2)', False), ('sold_at', 'timestamp with time zone', False),
+        ('code', 'character varying(20)', False), ('status', 'sale_status', False), ('amount', 'money_amount', False),
+        ('tags', 'text[]', False), ('ratio', 'double precision', False), ('country', 'character(2)', False)
+    ]
+    engine_object = FakePostgresEngine({
+        database.POSTGRES_COLUMNS_QUERY: [
+            {'table_name': 'sale', 'column_name': name, 'format_type': format_type, 'comment': None,
+             'is_primary_key': is_primary_key}
+            for name, format_type, is_primary_key in columns
+        ],
+        database.POSTGRES_FOREIGN_KEYS_QUERY: [],
+        database.POSTGRES_USER_TYPES_QUERY: [
+            {'kind': 'e', 'name': 'sale_status', 'schema': 'sales', 'visible': True, 'attype': None,
+             'nullable': True, 'default': None, 'labels': ['open', 'closed']},
+            {'kind': 'd', 'name': 'money_amount', 'schema': 'sales', 'visible': True, 'attype': 'numeric(12,2)',
+             'nullable': True, 'default': None, 'labels': []},
+        ],
+    })
+    tables = database.reflect_schema_tables_postgres('sales', ['sale'], engine_object)
+    # the types reported by the Inspector of SQLAlchemy for the same columns, see reflect_table_columns
+    assert [column['type'] for column in tables['sale']] == [
+        'INTEGER', 'NUMERIC(10, 2)', 'TIMESTAMP', 'VARCHAR(20)', 'VARCHAR(6)', 'NUMERIC', 'ARRAY', 'DOUBLE_PRECISION',
+        'CHAR(2)'
+    ]
+    assert tables['sale'][0]['is_primary_key']
+
+
+@pytest.mark.skipif(True, reason='should be ran only manually with AdventureWorks Database')
+def test_get_table_info_bulk_matches_table_reflection_postgres():
+    schema = {
+        'schemas': {
+            'sales': ['store', 'salesorderheader', 'creditcard']
+        }
+    }
+    bulk_result = get_table_info(schema, engine, use_cache=False)
+    table_result = get_table_info(schema, engine, use_cache=False, bulk=False)
+    assert bulk_result == table_result
+
+
+def test_sample_tables_reports_partial_results(sqlite_engine):
+    with sqlite_engine.begin() as conn:
+        conn.execute(text("INSERT INTO store (id, name) VALUES (1, 'a'), (2, 'b'), (3, 'c')"))
+    info_extractor = {
+        'schemas': {
+            'main': ['store', 'sale', 'missing_table']
+        }
+    }
+    table_data, failed_tables = sample_tables(info_extractor, sqlite_engine, top_k=2, max_workers=3)
+    assert list(table_data.keys()) == ['main.store', 'main.sale']
+    assert len(table_data['main.store']) == 2
+    assert list(failed_tables.keys()) == ['main.missing_table']
+
+    result = get_data(info_extractor, sqlite_engine, top_k=2)
+    assert list(result.keys()) == ['main.store', 'main.sale', 'main.missing_table']
+    assert result['main.missing_table'].empty
+
+    with pytest.raises(Exception):
+        get_data({'schemas': {'main': ['missing_table']}}, sqlite_engine)
+
+
+def test_sample_tables_deadline_grows_with_queued_tables(sqlite_engine, mocker):
+    wait = mocker.spy(database, 'wait')
+    info_extractor = {
+        'schemas': {
+            'main': ['store', 'sale', 'store', 'sale', 'store']
+        }
+    }
+    sample_tables(info_extractor, sqlite_engine, max_workers=2, timeout_seconds=1)
+    assert wait.call_args.kwargs['timeout'] == 3 * (1 + 5)
+
+
+def test_get_column_kind():
+    assert get_column_kind('BYTEA') == 'binary'
+    assert get_column_kind('VARBINARY(16)') == 'binary'
+    assert get_column_kind('JSONB') == 'text'
+    assert get_column_kind('TEXT') == 'text'
+    assert get_column_kind('VARCHAR(50)', max_text_length=200) == 'scalar'
+    assert get_column_kind('VARCHAR(500)', max_text_length=200) == 'text'
+    assert get_column_kind('INTEGER') == 'scalar'
+
+
+def test_get_data_projects_and_truncates_columns(sqlite_engine):
+    with sqlite_engine.begin() as conn:
+        conn.execute(text('CREATE TABLE document (id INTEGER PRIMARY KEY, body TEXT, content BLOB)'))
+        conn.execute(text("INSERT INTO document (id, body, content) VALUES (1, :body, :content)"), {
+            'body': 'x' * 1000,
+            'content': b'0123456789'
+        })
+    info_extractor = {
+        'schemas': {
+            'main': ['document']
+        }
+    }
+    table_metadata = get_table_info(info_extractor, sqlite_engine)
+    result = get_data(info_extractor, sqlite_engine, table_metadata=table_metadata)['main.document']
+    assert list(result.columns) == ['id', 'body', 'content']
+    assert len(result['body'][0]) == 200
+    assert result['content'][0] == '<binary 10 bytes>'
+
+    result = get_data(
+        info_extractor, sqlite_engine, table_metadata=table_metadata, columns={'main.document': ['id']}
+    )['main.document']
+    assert list(result.columns) == ['id']
+
+
+def test_choose_sampling_strategy():
+    integer_key = [{'column_name': 'id', 'type': 'INTEGER', 'is_primary_key': True}]
+    text_key = [{'column_name': 'code', 'type': 'VARCHAR(3)', 'is_primary_key': True}]
+    assert choose_sampling_strategy('postgresql', integer_key) == 'tablesample'
+    assert choose_sampling_strategy('postgresql', integer_key, 'keyset') == 'keyset'
+    assert choose_sampling_strategy('mysql', integer_key) == 'keyset'
+    assert choose_sampling_strategy('mysql', text_key) == 'limit'
+    assert choose_sampling_strategy('sqlite', None, 'tablesample') == 'limit'
+    assert choose_sampling_strategy('postgresql', integer_key, 'limit') == 'limit'
+    with pytest.raises(ValueError):
+        choose_sampling_strategy('postgresql', integer_key, 'random')
+
+
+def test_sample_table_keyset(sqlite_engine):
+    with sqlite_engine.begin() as conn:
+        conn.execute(text("INSERT INTO store (id, name) VALUES (:id, :name)"), [
+            {'id': i, 'name': f'store {i}'} for i in range(1, 1001)
+        ])
+    columns_info = get_table_info({'schemas': {'main': ['store']}}, sqlite_engine)['main.store']['columns']
+
+    result = sample_table('main', 'store', sqlite_engine, top_k=10, columns_info=columns_info, strategy='keyset')
+    assert len(result) == 10
+    assert result['id'].is_unique
+
+    result = sample_table('main', 'store', sqlite_engine, top_k=10, columns_info=columns_info, strategy='limit')
+    assert list(result['id']) == list(range(1, 11))
+
+
+def test_get_engine_routes_the_reads_to_the_replica(tmp_path, monkeypatch):
+    primary_url = f"sqlite:///{tmp_path / 'primary.db'}"
+    replica_url = f"sqlite:///{tmp_path / 'replica.db'}"
+    for url, name in ((primary_url, 'primary'), (replica_url, 'replica')):
+        with create_db_session(url).begin() as conn:
+            conn.execute(text('CREATE TABLE store (id INTEGER PRIMARY KEY, name VARCHAR(50))'))
+            conn.execute(text(f"INSERT INTO store VALUES (1, '{name}')"))
+    monkeypatch.setattr(database, 'engines', {})
+    monkeypatch.setattr(database, 'get_secrets', lambda config: {'database': {'url': primary_url}})
+
+    primary = database.get_engine()
+    assert database.get_engine() is primary
+    assert primary.pool._pre_ping
+    # without replica_url the reads use the primary engine
+    assert database.get_engine('replica') is primary
+    assert database.get_read_engine(primary) is primary
+
+    monkeypatch.setattr(database, 'engines', {'primary': primary})
+    monkeypatch.setattr(database, 'get_secrets', lambda config: {
+        'database': {'url': primary_url, 'replica_url': replica_url}
+    })
+    replica = database.get_read_engine(primary)
+    assert str(replica.url) == replica_url
+    assert database.get_read_engine(replica) is replica
+    assert sample_table('main', 'store', primary, 10, strategy='limit')['name'].tolist() == ['replica']
+
+    monkeypatch.setitem(database.database_pool_config, 'route_reads_to_replica', False)
+    assert database.get_read_engine(primary) is primary
+
+
+def test_get_pool_options():
+    assert database.get_pool_options('sqlite:///test.db') == {'pool_pre_ping': True, 'pool_recycle': 1800}
+    options = database.get_pool_options('postgresql://user@localhost/db')
+    assert options['pool_size'] == 5 and options['max_overflow'] == 10
@@ -0,0 +1,55 @@
+import asyncio
+
+from langchain.embeddings.base import Embeddings
+
+from utils.cache import SQLiteCache, TTLCache
+from utils.embeddings import CachedEmbeddings, normalize_query
+
+
+class CountingEmbeddings(Embeddings):
+    """Embeds a text as its length and counts the queries embedded"""
+
+    def __init__(self):
+        self.queries = 0
+
+    def embed_documents(self, texts):
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        self.queries += 1
+        return [float(len(text))]
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+def test_normalize_query():
+    assert normalize_query('  How many   Sales?\n') == 'how many sales?'
+
+
+def test_cached_embeddings():
+    counting = CountingEmbeddings()
+    embeddings = CachedEmbeddings(counting, 'test-model', cache=TTLCache())
+    assert embeddings.embed_query('How many sales?') == [15.0]
+    assert embeddings.embed_query('how many  sales?') == [15.0]
+    assert asyncio.run(embeddings.aembed_query('HOW MANY SALES?')) == [15.0]
+    assert counting.queries == 1
+
+    # the model name is part of the key
+    CachedEmbeddings(counting, 'other-model', cache=embeddings.cache).embed_query('How many sales?')
+    assert counting.queries == 2
+
+
+def test_cached_embeddings_disk_cache(tmp_path):
+    counting = CountingEmbeddings()
+    CachedEmbeddings(
+        counting, 'test-model', cache=TTLCache(), disk_cache=SQLiteCache(tmp_path / 'cache.sqlite')
+    ).embed_query('How many sales?')
+
+    # a new process starts with an empty memory cache and reads the shared file
+    embeddings = CachedEmbeddings(
+        counting, 'test-model', cache=TTLCache(), disk_cache=SQLiteCache(tmp_path / 'cache.sqlite')
+    )
+    assert embeddings.embed_query('How many sales?') == [15.0]
+    assert counting.queries == 1
+    assert ('test-model', 'how many sales?') in embeddings.cache
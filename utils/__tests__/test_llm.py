@@ -0,0 +1,237 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pytest
+
+from utils import llm
+from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.fake import FakeListChatModel
+from langchain.output_parsers import PydanticOutputParser
+from langchain.schema import HumanMessage
+from pydantic import BaseModel
+
+from utils.cache import TTLCache
+from utils.progress import listen_progress, report_progress
+
+from utils.llm import (
+    RateLimiter,
+    acall_with_retry,
+    apredict_and_parse,
+    apredict_messages,
+    arun_llm_tasks,
+    call_with_retry,
+    count_tokens,
+    predict_and_parse,
+    predict_messages,
+    run_llm_tasks,
+    without_client_retries
+)
+
+
+def test_count_tokens():
+    assert count_tokens('') <= 1
+    assert count_tokens('select the total of sales by month') > 1
+
+
+def test_rate_limiter_requests_per_minute(monkeypatch):
+    now = [1000.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr('utils.llm.time.monotonic', lambda: now[0])
+    monkeypatch.setattr('utils.llm.time.sleep', sleep)
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=1000)
+    limiter.acquire(100)
+    limiter.acquire(100)
+    assert sleeps == []
+    limiter.acquire(100)
+    assert sum(sleeps) == pytest.approx(60)
+
+
+def test_rate_limiter_tokens_per_minute(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('utils.llm.time.monotonic', lambda: now[0])
+    monkeypatch.setattr('utils.llm.time.sleep', lambda seconds: now.__setitem__(0, now[0] + seconds))
+    limiter = RateLimiter(tokens_per_minute=1000)
+    limiter.acquire(800)
+    limiter.acquire(300)
+    assert now[0] == pytest.approx(1060)
+
+
+def test_call_with_retry(monkeypatch):
+    monkeypatch.setattr('utils.llm.time.sleep', lambda seconds: None)
+    calls = []
+
+    def request():
+        calls.append(1)
+        if len(calls) < 3:
+            raise openai.error.RateLimitError('Rate limit reached')
+        return 'ok'
+
+    assert call_with_retry(request, max_retries=5, limiter=RateLimiter()) == 'ok'
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(openai.error.RateLimitError):
+        call_with_retry(request, max_retries=1, limiter=RateLimiter())
+
+
+def test_call_with_retry_disables_client_retries():
+    model = ChatOpenAI(openai_api_key='test', max_retries=6)
+    assert without_client_retries(model) is model
+    assert call_with_retry(lambda: without_client_retries(model).max_retries, limiter=RateLimiter()) == 0
+    assert asyncio.run(acall_with_retry(
+        lambda: asyncio.sleep(0, without_client_retries(model).max_retries), limiter=RateLimiter()
+    )) == 0
+    assert model.max_retries == 6
+
+
+class RetryingFakeModel(FakeListChatModel):
+    max_retries: int = 6
+    attempts: list = []
+
+    def _call(self, *args, **kwargs) -> str:
+        self.attempts.append(self.max_retries)
+        return super()._call(*args, **kwargs)
+
+
+def test_call_with_retry_calls_the_model_without_client_retries():
+    model = RetryingFakeModel(responses=['first', 'second'], tags=['comments'], attempts=[])
+    messages = [HumanMessage(content='hello')]
+    assert call_with_retry(lambda: predict_messages(model, messages), limiter=RateLimiter()) == 'first'
+    assert asyncio.run(acall_with_retry(lambda: apredict_messages(model, messages), limiter=RateLimiter())) == 'first'
+    assert model.attempts == [0, 0]
+    assert without_client_retries(model).tags == ['comments']
+    assert predict_messages(model, messages) == 'first'
+    assert model.attempts == [0, 0, 6]
+
+
+def test_run_llm_tasks_keeps_order(monkeypatch):
+    monkeypatch.setattr(llm, 'rate_limiter', RateLimiter())
+
+    def task(i):
+        def run():
+            time.sleep(0.01 * (5 - i))
+            return i
+        return run
+
+    assert run_llm_tasks([task(i) for i in range(5)], max_in_flight=5) == [0, 1, 2, 3, 4]
+
+
+def test_run_llm_tasks_report_progress(monkeypatch):
+    monkeypatch.setattr(llm, 'rate_limiter', RateLimiter())
+    stages = []
+    with listen_progress(stages.append):
+        run_llm_tasks([lambda i=i: report_progress(f'chunk {i}') for i in range(3)], max_in_flight=3)
+    assert sorted(stages) == ['chunk 0', 'chunk 1', 'chunk 2']
+
+
+def test_predict_messages():
+    model = FakeListChatModel(responses=['first', 'second'])
+    messages = [HumanMessage(content='hello')]
+    assert predict_messages(model, messages) == 'first'
+    assert asyncio.run(apredict_messages(model, messages)) == 'second'
+
+
+def test_acall_with_retry(monkeypatch):
+    async def sleep(seconds):
+        pass
+
+    monkeypatch.setattr('utils.llm.asyncio.sleep', sleep)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        if len(calls) < 3:
+            raise openai.error.RateLimitError('Rate limit reached')
+        return 'ok'
+
+    assert asyncio.run(acall_with_retry(request, max_retries=5, limiter=RateLimiter())) == 'ok'
+    assert len(calls) == 3
+
+
+def test_arun_llm_tasks_keeps_order(monkeypatch):
+    monkeypatch.setattr(llm, 'rate_limiter', RateLimiter())
+    running = [0, 0]
+
+    def task(i):
+        async def run():
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.01 * (5 - i))
+            running[0] -= 1
+            return i
+        return run
+
+    assert asyncio.run(arun_llm_tasks([task(i) for i in range(5)], max_in_flight=2)) == [0, 1, 2, 3, 4]
+    assert running[1] == 2
+
+
+class Answer(BaseModel):
+    query: str
+
+
+class FakeModel(FakeListChatModel):
+    model_name: str = 'fake-model'
+    temperature: float = 0
+
+
+def test_predict_and_parse_uses_cache(monkeypatch):
+    monkeypatch.setattr(llm, 'llm_cache', TTLCache())
+    monkeypatch.setitem(llm.llm_cache_config, 'enabled', True)
+    parser = PydanticOutputParser(pydantic_object=Answer)
+    model = FakeModel(responses=['{"query": "SELECT 1"}', '{"query": "SELECT 2"}', '{"query": "SELECT 3"}'])
+
+    assert predict_and_parse(model, [HumanMessage(content='first')], parser) == {'query': 'SELECT 1'}
+    assert predict_and_parse(model, [HumanMessage(content='first')], parser) == {'query': 'SELECT 1'}
+    assert asyncio.run(apredict_and_parse(model, [HumanMessage(content='first')], parser)) == {'query': 'SELECT 1'}
+    assert predict_and_parse(model, [HumanMessage(content='second')], parser) == {'query': 'SELECT 2'}
+
+    # the answers of a model with a higher temperature are not deterministic, they are not cached
+    model.temperature = 0.7
+    assert predict_and_parse(model, [HumanMessage(content='first')], parser) == {'query': 'SELECT 3'}
+
+
+def test_predict_and_parse_returns_copies_of_the_cached_answers(monkeypatch):
+    monkeypatch.setattr(llm, 'llm_cache', TTLCache())
+    monkeypatch.setitem(llm.llm_cache_config, 'enabled', True)
+    parser = PydanticOutputParser(pydantic_object=Answer)
+    model = FakeModel(responses=['{"query": "SELECT 1"}'])
+
+    predict_and_parse(model, [HumanMessage(content='first')], parser)['query'] = 'changed'
+    predict_and_parse(model, [HumanMessage(content='first')], parser)['query'] = 'changed'
+    asyncio.run(apredict_and_parse(model, [HumanMessage(content='first')], parser))['query'] = 'changed'
+    assert predict_and_parse(model, [HumanMessage(content='first')], parser) == {'query': 'SELECT 1'}
+
+
+def test_predict_and_parse_does_not_cache_invalid_answers(monkeypatch):
+    monkeypatch.setattr(llm, 'llm_cache', TTLCache())
+    monkeypatch.setitem(llm.llm_cache_config, 'enabled', True)
+    parser = PydanticOutputParser(pydantic_object=Answer)
+    model = FakeModel(responses=['not json', '{"query": "SELECT 1"}'])
+
+    with pytest.raises(Exception):
+        predict_and_parse(model, [HumanMessage(content='first')], parser)
+    assert predict_and_parse(model, [HumanMessage(content='first')], parser) == {'query': 'SELECT 1'}
+
+
+def test_get_llm_cache_is_created_once(monkeypatch):
+    created = []
+
+    def create_cache(**kwargs):
+        time.sleep(0.01)
+        created.append(kwargs)
+        return TTLCache()
+
+    monkeypatch.setattr(llm, 'llm_cache', None)
+    monkeypatch.setattr(llm, 'create_cache', create_cache)
+    monkeypatch.setitem(llm.llm_cache_config, 'enabled', True)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        caches = list(executor.map(lambda _: llm.get_llm_cache(), range(8)))
+    assert len(created) == 1
+    assert all(cache is caches[0] for cache in caches)
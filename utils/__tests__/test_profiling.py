@@ -0,0 +1,49 @@
+from utils.database import get_data, get_table_info
+from utils.profiling import is_orderable, profile_table, profile_table_scan, profile_tables, render_profile
+
+
+def test_profile_table(sqlite_engine):
+    info_extractor = {'schemas': {'main': ['customer']}}
+    columns_info = get_table_info(info_extractor, sqlite_engine, use_cache=False)['main.customer']['columns']
+    table_metadata = {'main.customer': {'columns': columns_info}}
+    table_data = get_data(info_extractor, sqlite_engine, 50, table_metadata=table_metadata)
+
+    profile = profile_table('main', 'customer', columns_info, sqlite_engine, table_data['main.customer'])
+    assert profile['id']['null_fraction'] == 0
+    assert profile['id']['distinct'] == 100
+    assert (profile['id']['min'], profile['id']['max']) == ('1', '100')
+    assert profile['id']['top_values'] is None
+    assert profile['notes']['null_fraction'] == 0.5
+    assert profile['notes']['min'] is None
+    assert profile['country']['distinct'] == 2
+    assert profile['country']['top_values'][0][0] == 'CO'
+
+    rendered = render_profile(profile, ['country'])
+    assert rendered.startswith('country: nulls 0%; 2 distinct')
+    assert 'id:' not in rendered
+
+
+def test_profile_tables_skips_failed_tables(sqlite_engine):
+    info_extractor = {'schemas': {'main': ['customer', 'missing_table']}}
+    table_metadata = {
+        'main.customer': get_table_info({'schemas': {'main': ['customer']}}, sqlite_engine)['main.customer'],
+        'main.missing_table': {'columns': [{'column_name': 'id', 'type': 'INTEGER'}]}
+    }
+    profiles = profile_tables(info_extractor, sqlite_engine, table_metadata)
+    assert list(profiles.keys()) == ['main.customer']
+
+
+def test_is_orderable():
+    assert is_orderable('INTEGER') and is_orderable('NUMERIC(10, 2)') and is_orderable('VARCHAR(50)')
+    assert is_orderable('TIMESTAMP WITH TIME ZONE') and is_orderable('DATE')
+    assert not any(is_orderable(column_type) for column_type in (
+        'UUID', 'HSTORE', 'POINT', 'GEOMETRY', 'INTERVAL', 'BOOLEAN', 'JSONB', 'INTEGER[]', 'BYTEA', 'TEXT'
+    ))
+
+
+def test_profile_table_scan_spreads_the_rows(sqlite_engine):
+    columns_info = get_table_info({'schemas': {'main': ['customer']}}, sqlite_engine)['main.customer']['columns']
+    profile = profile_table_scan('main', 'customer', columns_info, sqlite_engine, sample_rows=20)
+    # the keys are read in slices of the whole table, not only the first 20 rows
+    assert int(profile['id']['max']) > 80
+    assert profile['id']['distinct'] == 20
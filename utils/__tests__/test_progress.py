@@ -0,0 +1,24 @@
+import asyncio
+
+from utils.progress import listen_progress, report_progress
+
+
+def test_report_progress_reaches_the_listener_of_the_block():
+    stages = []
+    report_progress('nobody listens')
+    with listen_progress(stages.append):
+        report_progress('first')
+
+        async def run():
+            await asyncio.to_thread(report_progress, 'in a worker thread')
+
+        asyncio.run(run())
+
+        def failing_listener(stage):
+            raise ValueError('the listener failed')
+
+        with listen_progress(failing_listener):
+            report_progress('lost')
+        report_progress('second')
+    report_progress('after the block')
+    assert stages == ['first', 'in a worker thread', 'second']
@@ -0,0 +1,77 @@
+import time
+
+from langchain.embeddings.base import Embeddings
+
+from utils.semantic_cache import SemanticCache, extract_literals
+
+VOCABULARY = ['bookings', 'customers', 'yesterday', 'month', 'top']
+
+
+class KeywordEmbeddings(Embeddings):
+    """Embeds a text as the count of each word of the vocabulary"""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [float(text.lower().count(word)) for word in VOCABULARY] + [0.01]
+
+
+def test_semantic_cache_lookup():
+    cache = SemanticCache(KeywordEmbeddings, similarity_threshold=0.95)
+    cache.store('how many bookings yesterday', 'db', {'sales': ['booking']}, {'sql_code': 'SELECT 1'})
+
+    answer = cache.lookup('How many bookings were made yesterday?', 'db')
+    assert answer['sql_code'] == 'SELECT 1'
+    assert answer['similarity'] > 0.95
+    assert cache.lookup('top customers this month', 'db') is None
+    # the answers of other databases are not reused
+    assert cache.lookup('how many bookings yesterday', 'other_db') is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3, 'entries': 1}
+
+
+def test_semantic_cache_expiration(monkeypatch):
+    cache = SemanticCache(KeywordEmbeddings, ttl_seconds=10)
+    cache.store('how many bookings yesterday', 'db', {'sales': ['booking']}, {'sql_code': 'SELECT 1'})
+    now = time.time()
+    monkeypatch.setattr('utils.semantic_cache.time.time', lambda: now + 11)
+    assert cache.lookup('how many bookings yesterday', 'db') is None
+    assert len(cache) == 0
+
+
+def test_semantic_cache_invalidate():
+    cache = SemanticCache(KeywordEmbeddings)
+    cache.store('how many bookings yesterday', 'db', {'sales': ['booking']}, {'sql_code': 'SELECT 1'})
+    cache.store('top customers this month', 'db', {'sales': ['customer']}, {'sql_code': 'SELECT 2'})
+    cache.store('top customers', 'db', {'crm': ['customer']}, {'sql_code': 'SELECT 3'})
+
+    assert cache.invalidate(schema_name='sales', table_name='booking') == 1
+    assert cache.invalidate(table_name='customer') == 2
+    assert len(cache) == 0
+
+
+def test_extract_literals():
+    assert extract_literals('Top 5 customers of "Lima" last month') == ('5', 'last', 'lima', 'month', 'top')
+    assert extract_literals('how many bookings') == ()
+
+
+def test_semantic_cache_requires_the_same_literals():
+    cache = SemanticCache(KeywordEmbeddings, similarity_threshold=0.9)
+    cache.store('top 5 customers', 'db', {'sales': ['customer']}, {'sql_code': 'SELECT 5'})
+    cache.store('bookings yesterday', 'db', {'sales': ['booking']}, {'sql_code': 'SELECT 1'})
+
+    assert cache.lookup('top 10 customers', 'db') is None
+    assert cache.lookup('bookings today', 'db') is None
+    assert cache.lookup('the top 5 customers', 'db')['sql_code'] == 'SELECT 5'
+
+    lenient = SemanticCache(KeywordEmbeddings, similarity_threshold=0.9, match_literals=False)
+    lenient.store('top 5 customers', 'db', {'sales': ['customer']}, {'sql_code': 'SELECT 5'})
+    assert lenient.lookup('top 10 customers', 'db')['sql_code'] == 'SELECT 5'
+
+
+def test_semantic_cache_discard():
+    cache = SemanticCache(KeywordEmbeddings)
+    cache.store('how many bookings yesterday', 'db', {'sales': ['booking']}, {'sql_code': 'SELECT 1'})
+    assert cache.discard('how many bookings yesterday', 'other_db') == 0
+    assert cache.discard('how many bookings yesterday', 'db') == 1
+    assert len(cache) == 0
@@ -0,0 +1,27 @@
+import asyncio
+
+from utils.steps import Step, arun_steps, run_steps
+
+
+def fail():
+    raise ValueError('failed')
+
+
+async def adouble(value: int) -> int:
+    return value * 20
+
+
+def chain_steps():
+    value = yield Step(lambda number: number * 2, 1, afunction=adouble)
+    try:
+        yield Step(fail)
+    except ValueError as e:
+        return value, str(e)
+
+
+def test_run_steps():
+    assert run_steps(chain_steps()) == (2, 'failed')
+
+
+def test_arun_steps():
+    assert asyncio.run(arun_steps(chain_steps())) == (20, 'failed')
@@ -0,0 +1,95 @@
+import asyncio
+
+from utils.work_queue import WorkQueue
+
+
+def test_work_queue_runs_the_jobs_with_bounded_workers():
+    async def run():
+        queue = WorkQueue(workers=2, max_size=3)
+        running = []
+        max_running = []
+        done = []
+        release = asyncio.Event()
+
+        async def job(number):
+            running.append(number)
+            max_running.append(len(running))
+            await release.wait()
+            running.remove(number)
+            if number == 0:
+                raise ValueError('a failed job does not stop the worker')
+            done.append(number)
+
+        assert all(queue.submit(lambda number=number: job(number)) for number in range(3))
+        await asyncio.sleep(0)
+        # two jobs run and one waits, so there is room for two more
+        assert queue.depth() == 1
+        assert queue.submit(lambda: job(3))
+        assert queue.submit(lambda: job(4))
+        assert not queue.submit(lambda: job(5))
+
+        release.set()
+        await queue.join()
+        await queue.close()
+        assert sorted(done) == [1, 2, 3, 4]
+        assert max(max_running) == 2
+        assert queue.depth() == 0
+
+    asyncio.run(run())
+
+
+def test_work_queue_shares_the_workers_by_weight_and_owner():
+    async def run():
+        queue = WorkQueue(workers=1, max_size=20, weights={'query': 3, 'documentation': 1}, limits={'user': 1})
+        order = []
+        release = asyncio.Event()
+
+        async def job(name):
+            order.append(name)
+            await release.wait()
+
+        # the first job takes the only worker, the rest wait
+        queue.submit(lambda: job('blocker'), 'documentation', {'user': 'U0'})
+        await asyncio.sleep(0)
+        for number in range(4):
+            queue.submit(lambda number=number: job(f'documentation {number}'), 'documentation', {'user': 'U1'})
+        for number in range(4):
+            queue.submit(lambda number=number: job(f'query {number}'), 'query', {'user': 'U2'})
+        stats = queue.stats()
+        assert stats['waiting'] == {'documentation': 4, 'query': 4}
+        assert (stats['depth'], stats['running']) == (8, 1)
+
+        release.set()
+        await queue.join()
+        await queue.close()
+        return order
+
+    order = asyncio.run(run())
+    # three queries for each documentation job, instead of the order of arrival
+    assert order[:6] == ['blocker', 'query 0', 'query 1', 'query 2', 'documentation 0', 'query 3']
+
+
+def test_work_queue_limits_the_running_jobs_of_an_owner():
+    async def run():
+        queue = WorkQueue(workers=3, limits={'user': 1})
+        running = []
+        release = asyncio.Event()
+
+        async def job(name):
+            running.append(name)
+            await release.wait()
+
+        queue.submit(lambda: job('U1 first'), owners={'user': 'U1'})
+        queue.submit(lambda: job('U1 second'), owners={'user': 'U1'})
+        queue.submit(lambda: job('U2 first'), owners={'user': 'U2'})
+        await asyncio.sleep(0.01)
+        started = list(running)
+        release.set()
+        await queue.join()
+        await queue.close()
+        return started, running
+
+    started, running = asyncio.run(run())
+    # the second question of U1 waits for the first one, although a worker is free
+    assert started == ['U1 first', 'U2 first']
+    assert running[-1] == 'U1 second'
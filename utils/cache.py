@@ -0,0 +1,441 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache with LRU eviction and a time to live for each entry.
+
+    Entries are evicted when they are older than ``ttl_seconds`` or when the cache holds more than
+    ``max_entries`` items (the least recently used entry goes first). The cache can be persisted to a JSON file,
+    so the values stored must be JSON serializable when ``persist_path`` is used.
+    """
+
+    def __init__(self, ttl_seconds: Optional[float] = 3600, max_entries: int = 512, persist_path: str = None):
+        """
+        Args:
+            ttl_seconds: Seconds an entry stays valid, None means the entries never expire.
+            max_entries: Maximum number of entries kept in memory.
+            persist_path: Optional path to a JSON file used to persist the cache between restarts.
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.persist_path = Path(persist_path) if persist_path else None
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        if self.persist_path:
+            self.load()
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get the value stored for a key, expired entries are removed and count as a miss.
+        Args:
+            key: Key of the entry.
+            default: Value returned when the key is not cached.
+
+        Returns: The cached value or the default value.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._is_expired(entry[0]):
+                self._data.pop(key, None)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Store a value, evicting the least recently used entries when the cache is full.
+        Args:
+            key: Key of the entry.
+            value: Value to be stored.
+        """
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key: Hashable, value: Any) -> bool:
+        """
+        Store a value only if the key is not cached (or its entry expired), the check and the write are atomic.
+        Args:
+            key: Key of the entry.
+            value: Value to be stored.
+
+        Returns: True if the value was stored, False if the key was already cached.
+        """
+        with self._lock:
+            if key in self:
+                return False
+            self.set(key, value)
+            return True
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Get the value for a key, or build it with the factory and store it when it is not cached.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, predicate: Callable[[Hashable], bool] = None) -> int:
+        """
+        Remove the entries whose key matches the predicate, or every entry when no predicate is given.
+        Args:
+            predicate: Function that receives a key and returns True if the entry must be removed.
+
+        Returns: Number of entries removed.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate is None or predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and not self._is_expired(entry[0])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def save(self) -> None:
+        """
+        Persist the non expired entries to ``persist_path``. Tuple keys are stored as lists.
+        """
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = [
+                [list(key) if isinstance(key, tuple) else key, stored_at, value]
+                for key, (stored_at, value) in self._data.items() if not self._is_expired(stored_at)
+            ]
+        try:
+            self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.persist_path.with_suffix(self.persist_path.suffix + '.tmp')
+            with open(tmp_path, 'w') as file:
+                json.dump(entries, file)
+            tmp_path.replace(self.persist_path)
+        except (OSError, TypeError) as e:
+            logging.warning(f'Failed to persist cache to {self.persist_path}: {e}')
+
+    def load(self) -> None:
+        """
+        Load the entries stored in ``persist_path``, skipping the expired ones.
+        """
+        if not self.persist_path or not self.persist_path.exists():
+            return
+        try:
+            with open(self.persist_path, 'r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Failed to load cache from {self.persist_path}: {e}')
+            return
+        with self._lock:
+            for key, stored_at, value in entries:
+                if not self._is_expired(stored_at):
+                    self._data[tuple(key) if isinstance(key, list) else key] = (stored_at, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        logging.info(f'Loaded {len(self._data)} cache entries from {self.persist_path}')
+
+
+class SQLiteCache:
+    """
+    Cache stored in a SQLite file, shared by all the processes that use the same file.
+
+    It has the same interface as ``TTLCache``, keys and values must be JSON serializable (tuple keys are stored as
+    lists and returned as tuples). Expired entries are removed when they are read and when the cache is opened.
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = 3600, table: str = 'cache'):
+        """
+        Args:
+            path: Path to the SQLite file, created when it does not exist.
+            ttl_seconds: Seconds an entry stays valid, None means the entries never expire.
+            table: Name of the table, several caches can share the same file with different tables.
+        """
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', table):
+            raise ValueError(f'Invalid table name for the cache: {table}')
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, stored_at REAL NOT NULL, value TEXT NOT NULL)'
+        )
+        if ttl_seconds is not None:
+            self._conn.execute(f'DELETE FROM {table} WHERE stored_at < ?', (time.time() - ttl_seconds,))
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _encode_key(key: Hashable) -> str:
+        return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+    @staticmethod
+    def _decode_key(key: str) -> Hashable:
+        key = json.loads(key)
+        return tuple(key) if isinstance(key, list) else key
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get the value stored for a key, expired entries are removed and count as a miss.
+        Args:
+            key: Key of the entry.
+            default: Value returned when the key is not cached.
+
+        Returns: The cached value or the default value.
+        """
+        encoded_key = self._encode_key(key)
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT stored_at, value FROM {self.table} WHERE key = ?', (encoded_key,)
+            ).fetchone()
+            if row is None or self._is_expired(row[0]):
+                if row is not None:
+                    self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (encoded_key,))
+                self.misses += 1
+                return default
+            self.hits += 1
+        return json.loads(row[1])
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Store a value, replacing the previous value of the key.
+        Args:
+            key: Key of the entry.
+            value: Value to be stored.
+        """
+        with self._lock:
+            self._conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, stored_at, value) VALUES (?, ?, ?)',
+                (self._encode_key(key), time.time(), json.dumps(value))
+            )
+
+    def add(self, key: Hashable, value: Any) -> bool:
+        """
+        Store a value only if the key is not cached (or its entry expired). A single statement checks and writes the
+        entry, so it is atomic for all the processes that share the file.
+        Args:
+            key: Key of the entry.
+            value: Value to be stored.
+
+        Returns: True if the value was stored, False if the key was already cached.
+        """
+        now = time.time()
+        expired_before = now - self.ttl_seconds if self.ttl_seconds is not None else float('-inf')
+        with self._lock:
+            return self._conn.execute(
+                f'INSERT INTO {self.table} (key, stored_at, value) VALUES (?, ?, ?) '
+                f'ON CONFLICT (key) DO UPDATE SET stored_at = excluded.stored_at, value = excluded.value '
+                f'WHERE {self.table}.stored_at < ?',
+                (self._encode_key(key), now, json.dumps(value), expired_before)
+            ).rowcount == 1
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Get the value for a key, or build it with the factory and store it when it is not cached.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, predicate: Callable[[Hashable], bool] = None) -> int:
+        """
+        Remove the entries whose key matches the predicate, or every entry when no predicate is given.
+        Args:
+            predicate: Function that receives a key and returns True if the entry must be removed.
+
+        Returns: Number of entries removed.
+        """
+        with self._lock:
+            if predicate is None:
+                return self._conn.execute(f'DELETE FROM {self.table}').rowcount
+            keys = [
+                (key,) for key, in self._conn.execute(f'SELECT key FROM {self.table}').fetchall()
+                if predicate(self._decode_key(key))
+            ]
+            self._conn.executemany(f'DELETE FROM {self.table} WHERE key = ?', keys)
+            return len(keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT stored_at FROM {self.table} WHERE key = ?', (self._encode_key(key),)
+            ).fetchone()
+        return row is not None and not self._is_expired(row[0])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+
+class RedisCache:
+    """
+    Cache stored in Redis, shared by all the instances of the service. It has the same interface as ``TTLCache``,
+    keys and values must be JSON serializable. The expiration is handled by Redis.
+
+    The ``redis`` package is an optional dependency, it is only imported when this backend is used.
+    """
+
+    def __init__(self, url: str = None, ttl_seconds: Optional[float] = 3600, namespace: str = 'cache', client=None):
+        """
+        Args:
+            url: Url of the Redis server, for example redis://localhost:6379/0.
+            ttl_seconds: Seconds an entry stays valid, None means the entries never expire.
+            namespace: Prefix of the keys, several caches can share the same server with different namespaces.
+            client: Redis client to use instead of connecting to the url.
+        """
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+            client.ping()
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    def _encode_key(self, key: Hashable) -> str:
+        return f'{self.namespace}:{json.dumps(list(key) if isinstance(key, tuple) else key)}'
+
+    def _decode_key(self, key) -> Hashable:
+        key = json.loads((key.decode() if isinstance(key, bytes) else key)[len(self.namespace) + 1:])
+        return tuple(key) if isinstance(key, list) else key
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get the value stored for a key.
+        Args:
+            key: Key of the entry.
+            default: Value returned when the key is not cached.
+
+        Returns: The cached value or the default value.
+        """
+        value = self.client.get(self._encode_key(key))
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Store a value, replacing the previous value of the key.
+        Args:
+            key: Key of the entry.
+            value: Value to be stored.
+        """
+        self.client.set(
+            self._encode_key(key), json.dumps(value), ex=int(self.ttl_seconds) if self.ttl_seconds else None
+        )
+
+    def add(self, key: Hashable, value: Any) -> bool:
+        """
+        Store a value only if the key is not cached, with SET NX so it is atomic for all the instances.
+        Args:
+            key: Key of the entry.
+            value: Value to be stored.
+
+        Returns: True if the value was stored, False if the key was already cached.
+        """
+        return bool(self.client.set(
+            self._encode_key(key), json.dumps(value), ex=int(self.ttl_seconds) if self.ttl_seconds else None, nx=True
+        ))
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Get the value for a key, or build it with the factory and store it when it is not cached.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, predicate: Callable[[Hashable], bool] = None) -> int:
+        """
+        Remove the entries whose key matches the predicate, or every entry of the namespace when no predicate is
+        given.
+        Args:
+            predicate: Function that receives a key and returns True if the entry must be removed.
+
+        Returns: Number of entries removed.
+        """
+        keys = [
+            key for key in self.client.scan_iter(match=f'{self.namespace}:*')
+            if predicate is None or predicate(self._decode_key(key))
+        ]
+        if keys:
+            self.client.delete(*keys)
+        return len(keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return bool(self.client.exists(self._encode_key(key)))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.client.scan_iter(match=f'{self.namespace}:*'))
+
+
+def create_cache(
+        backend: str = 'memory',
+        ttl_seconds: Optional[float] = 3600,
+        max_entries: int = 512,
+        path: str = None,
+        url: str = None,
+        namespace: str = 'cache'
+):
+    """
+    Create a cache with the given backend. When Redis can not be used (the package is not installed or the server
+    does not answer) an in-memory cache is used instead, so a missing Redis never stops the service.
+    Args:
+        backend: memory, sqlite or redis
+        ttl_seconds: Seconds an entry stays valid, None means the entries never expire.
+        max_entries: Maximum number of entries of the memory backend.
+        path: File of the sqlite backend.
+        url: Url of the redis backend.
+        namespace: Table of the sqlite backend or key prefix of the redis backend.
+
+    Returns: The cache, TTLCache, SQLiteCache or RedisCache
+    """
+    if backend == 'sqlite':
+        return SQLiteCache(path, ttl_seconds=ttl_seconds, table=namespace)
+    if backend == 'redis':
+        try:
+            return RedisCache(url, ttl_seconds=ttl_seconds, namespace=namespace)
+        except Exception as e:
+            logging.warning(f'Redis is not available ({e}), using an in-memory cache instead')
+    elif backend != 'memory':
+        raise ValueError(f'Unknown cache backend: {backend}')
+    return TTLCache(ttl_seconds=ttl_seconds, max_entries=max_entries)
@@ -0,0 +1,238 @@
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+from pandas import DataFrame
+
+from utils.config_loaders import get_config
+from utils.llm import count_tokens
+
+config = get_config()
+compaction_config = config.get('prompt_compaction', {})
+
+
+def short_value(value: Any, max_value_length: int) -> str:
+    """
+    Render a value of a sample row, long values are truncated
+    Args:
+        value: value of the cell
+        max_value_length: maximum number of characters
+
+    Returns: the value as text
+    """
+    value = str(value).replace('\n', ' ')
+    return value if len(value) <= max_value_length else value[:max_value_length] + '...'
+
+
+def render_table_ddl(table_name: str, columns: List[Dict[str, Any]], include_comments: bool = True) -> str:
+    """
+    Render the metadata of a table as compact DDL-like text. The empty fields are left out and the targets of the
+    foreign keys are listed once.
+    Args:
+        table_name: name of the table with its schema
+        columns: metadata of the columns of the table (see get_table_info)
+        include_comments: add the comments of the columns
+
+    Returns: text like "TABLE sales.sale (id INTEGER PRIMARY KEY, store_id INTEGER REFERENCES sales.store.id)", with a
+        column on each line
+    """
+    lines = []
+    for i, column in enumerate(columns):
+        line = f"{column['column_name']} {column['type']}"
+        if column.get('is_primary_key'):
+            line += ' PRIMARY KEY'
+        targets = list(dict.fromkeys(column.get('foreign_key_tables') or []))
+        if targets:
+            line += f" REFERENCES {', '.join(targets)}"
+        if i < len(columns) - 1:
+            line += ','
+        # the comment goes after the comma, so it does not hide it
+        if include_comments and column.get('comment'):
+            line += f" -- {short_value(column['comment'], 200)}"
+        lines.append(line)
+    return f'TABLE {table_name} (\n  ' + '\n  '.join(lines) + '\n)'
+
+
+def render_metadata(table_metadata: Dict[str, Any], include_comments: bool = True) -> str:
+    """
+    Render the metadata of several tables as DDL-like text (see render_table_ddl)
+    Args:
+        table_metadata: result of get_table_info, or the tables filtered by the ColumnExtractor
+        include_comments: add the comments of the columns
+
+    Returns: the DDL of the tables separated by blank lines
+    """
+    return '\n\n'.join(
+        render_table_ddl(table['table'] if 'table' in table else table_name, table['columns'], include_comments)
+        for table_name, table in table_metadata.items()
+    )
+
+
+def render_sample_rows(table_name: str, table_data: DataFrame, rows: int, max_value_length: int) -> str:
+    """
+    Render the first rows of a table as pipe separated text
+    Args:
+        table_name: name of the table with its schema
+        table_data: rows sampled from the table
+        rows: number of rows to render
+        max_value_length: values longer than this are truncated
+
+    Returns: the header and the rows of the table, empty if there are no rows
+    """
+    if table_data is None or table_data.empty or rows <= 0:
+        return ''
+    sample = table_data.head(rows)
+    lines = [f'Rows of {table_name}:', ' | '.join(str(column) for column in sample.columns)]
+    for row in sample.itertuples(index=False):
+        lines.append(' | '.join(
+            'NULL' if not isinstance(value, (list, dict)) and pd.isna(value) else short_value(value, max_value_length)
+            for value in row
+        ))
+    return '\n'.join(lines)
+
+
+def is_mentioned(name: str, question: Optional[str]) -> bool:
+    """
+    Check if the question names a table or a column, as a whole word, with spaces or underscores
+    Args:
+        name: name of the table or the column, the schema is ignored
+        question: question of the user
+
+    Returns: True if the name is in the question
+    """
+    if not question:
+        return False
+    name = name.split('.')[-1].lower()
+    question = question.lower()
+    return any(
+        re.search(rf'\b{re.escape(variant)}\b', question) for variant in {name, name.replace('_', ' ')}
+    )
+
+
+def rank_columns(columns: List[Dict[str, Any]], question: Optional[str]) -> List[int]:
+    """
+    Order the columns of a table by relevance: the columns named in the question, then the keys, then the rest
+    Args:
+        columns: metadata of the columns of the table (see get_table_info)
+        question: question of the user
+
+    Returns: the positions of the columns, the most relevant first
+    """
+    return sorted(range(len(columns)), key=lambda i: (
+        not is_mentioned(columns[i]['column_name'], question),
+        not (columns[i].get('is_primary_key') or columns[i].get('is_foreign_key')),
+        i
+    ))
+
+
+def trim_metadata(table_metadata: Dict[str, Any], max_columns: int, max_tables: int, question: Optional[str]) -> Dict[str, Any]:
+    """
+    Keep the most relevant tables and columns (see rank_columns), the tables named in the question go first. The
+    columns that are kept stay in their order.
+    Args:
+        table_metadata: result of get_table_info, or the tables filtered by the ColumnExtractor
+        max_columns: maximum columns of each table
+        max_tables: maximum number of tables
+        question: question of the user
+
+    Returns: the metadata of the tables that are kept
+    """
+    table_names = sorted(table_metadata, key=lambda table_name: not is_mentioned(table_name, question))
+    trimmed = {}
+    for table_name in table_names[:max_tables]:
+        table = table_metadata[table_name]
+        kept = sorted(rank_columns(table['columns'], question)[:max_columns])
+        trimmed[table_name] = {**table, 'columns': [table['columns'][i] for i in kept]}
+    return {table_name: trimmed[table_name] for table_name in table_metadata if table_name in trimmed}
+
+
+def compact_metadata(
+        table_metadata: Dict[str, Any],
+        token_budget: int = None,
+        model_name: str = 'gpt-3.5-turbo',
+        question: str = None
+) -> str:
+    """
+    Render the metadata of the tables within a token budget. The comments of the columns are dropped when the
+    metadata does not fit, then the columns of each table are halved and at last the tables are dropped, keeping
+    the tables and the columns named in the question and the keys (see trim_metadata).
+    Args:
+        table_metadata: result of get_table_info, or the tables filtered by the ColumnExtractor
+        token_budget: maximum tokens of the text, None for no limit
+        model_name: model that will receive the text, used to count the tokens
+        question: question of the user, its tables and columns are the last ones dropped
+
+    Returns: the DDL of the tables
+
+    Raises:
+        ValueError: if not even one column of one table fits in the budget
+    """
+    metadata = render_metadata(table_metadata)
+    if token_budget is None or count_tokens(metadata, model_name) <= token_budget:
+        return metadata
+    metadata = render_metadata(table_metadata, include_comments=False)
+    if count_tokens(metadata, model_name) <= token_budget:
+        return metadata
+
+    max_columns = max((len(table['columns']) for table in table_metadata.values()), default=0)
+    max_tables = len(table_metadata)
+    while max_tables > 0:
+        max_columns = max(max_columns // 2, 1)
+        metadata = render_metadata(
+            trim_metadata(table_metadata, max_columns, max_tables, question), include_comments=False
+        )
+        if count_tokens(metadata, model_name) <= token_budget:
+            logging.warning(
+                f'The metadata of the tables does not fit in {token_budget} tokens, it is trimmed to {max_tables} '
+                f'tables of up to {max_columns} columns'
+            )
+            return metadata
+        if max_columns == 1:
+            max_tables -= 1
+    raise ValueError(f'The metadata of the tables does not fit in the budget of {token_budget} tokens')
+
+
+def compact_table_context(
+        table_metadata: Dict[str, Any],
+        table_data: Optional[Dict[str, DataFrame]] = None,
+        token_budget: int = None,
+        model_name: str = 'gpt-3.5-turbo',
+        max_rows: int = None,
+        max_value_length: int = None,
+        question: str = None
+) -> Dict[str, str]:
+    """
+    Render the metadata and the sample rows of the tables within a token budget. The metadata goes first (see
+    compact_metadata) and the sample rows take the rest of the budget, the number of rows of every table is halved
+    until they fit.
+    Args:
+        table_metadata: result of get_table_info
+        table_data: rows sampled from each table (see get_data)
+        token_budget: maximum tokens of the metadata plus the rows (prompt_compaction in the config)
+        model_name: model that will receive the text, used to count the tokens
+        max_rows: maximum rows of each table
+        max_value_length: values longer than this are truncated
+        question: question of the user, its tables and columns are the last ones dropped from the metadata
+
+    Returns: dictionary with the "metadata" and the "data" text
+    """
+    max_rows = max_rows or compaction_config.get('max_sample_rows', 10)
+    max_value_length = max_value_length or compaction_config.get('max_value_length', 50)
+    metadata = compact_metadata(table_metadata, token_budget, model_name, question)
+    remaining = None if token_budget is None else token_budget - count_tokens(metadata, model_name)
+
+    data = ''
+    rows = max_rows
+    while table_data and rows > 0:
+        data = '\n\n'.join(filter(None, [
+            render_sample_rows(table_name, table_rows, rows, max_value_length)
+            for table_name, table_rows in table_data.items()
+        ]))
+        if remaining is None or count_tokens(data, model_name) <= remaining:
+            break
+        rows //= 2
+        data = ''
+    if table_data and not data:
+        logging.info('The sample rows of the tables do not fit in the token budget, they are left out')
+    return {'metadata': metadata, 'data': data}
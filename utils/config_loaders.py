@@ -1,11 +1,18 @@
+import copy
 import logging
 import logging.config
 import os
+import threading
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 
 import yaml
 
+# modification time and content of the YAML files already loaded, by path (None for a missing file), see
+# load_yaml_file
+yaml_files: Dict[str, Tuple[Optional[float], Dict[str, Any]]] = {}
+yaml_files_lock = threading.Lock()
+
 
 def get_current_path() -> Path:
     """
@@ -57,17 +64,30 @@ def get_env_variable(environment_variable: str) -> str:
 
 def load_yaml_file(file_path: Path) -> Dict[str, Any]:
     """
-    Loads the content of a YAML file.
+    Loads the content of a YAML file. The file is parsed again only when its modification time changes, every module
+    reads the config and the later calls get a copy of the parsed content. A missing file is logged once, until it
+    is created.
 
     :param file_path: A Path object to the YAML file.
     :return: A dictionary with the content of the YAML file.
     """
+    path = str(file_path)
     try:
-        with open(file_path, 'r') as file:
-            return yaml.safe_load(file) or {}
-    except FileNotFoundError:
-        logging.error(f"File {file_path} not found.")
-        return {}
+        try:
+            mtime = os.stat(file_path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        with yaml_files_lock:
+            loaded = yaml_files.get(path)
+            if loaded is None or loaded[0] != mtime:
+                if mtime is None:
+                    logging.error(f"File {file_path} not found.")
+                    content = {}
+                else:
+                    with open(file_path, 'r') as file:
+                        content = yaml.safe_load(file) or {}
+                yaml_files[path] = loaded = (mtime, content)
+            return copy.deepcopy(loaded[1])
     except Exception as e:
         logging.error(f"An error occurred while loading the file {file_path}: {e}")
         return {}
@@ -94,13 +114,13 @@ def get_secrets(config: Dict[str, Any]) -> Dict[str, Any]:
     """
     environment = get_current_environment()
     if environment == 'development':
-        logging.info('Initializing service with the development API tokens')
+        logging.debug('Initializing service with the development API tokens')
         secrets = config.get('secrets')
         if secrets is None:
             logging.warning("'secrets' not found in configuration.")
         return secrets
     else:
-        logging.info(f'Initializing service with the {environment} API tokens')
+        logging.debug(f'Initializing service with the {environment} API tokens')
         secrets_path = Path(get_env_variable('SECRETS_PATH')) / 'credentials.yaml'
         return load_yaml_file(secrets_path)
 
@@ -1,27 +1,134 @@
+import copy
 import logging
+import math
+import random
+import re
+import threading
 import traceback
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import pandas as pd
 from pandas import DataFrame
-from sqlalchemy import MetaData, Table
-from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import MetaData, String, Table
+from sqlalchemy import cast, column as sql_column, create_engine, func, inspect, literal, literal_column, select
+from sqlalchemy import table as sql_table, tablesample
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import NoSuchTableError, SQLAlchemyError
 from sqlalchemy import text
 
+from utils.cache import TTLCache
+from utils.config_loaders import get_config, get_secrets
 
-def create_db_session(database_url: str) -> Engine:
+config = get_config()
+
+metadata_cache_config = config.get('metadata_cache', {})
+# created on the first use, loading persist_path at import would slow down the start of the service
+metadata_cache: Optional[TTLCache] = None
+metadata_cache_lock = threading.Lock()
+
+sampling_config = config.get('sampling', {})
+database_pool_config = config.get('database_pool', {})
+
+# engines shared by the whole process, by role (primary or replica), see get_engine
+engines: Dict[str, Engine] = {}
+engines_lock = threading.Lock()
+
+POSTGRES_COLUMNS_QUERY = text("""
+SELECT
+    c.relname AS table_name,
+    a.attname AS column_name,
+    format_type(a.atttypid, a.atttypmod) AS format_type,
+    col_description(c.oid, a.attnum) AS comment,
+    COALESCE(a.attnum = ANY(pk.conkey), false) AS is_primary_key
+FROM pg_catalog.pg_attribute a
+JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_catalog.pg_constraint pk ON pk.conrelid = c.oid AND pk.contype = 'p'
+WHERE n.nspname = :schema_name
+    AND c.relname = ANY(:table_names)
+    AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+    AND a.attnum > 0
+    AND NOT a.attisdropped
+ORDER BY c.relname, a.attnum
+""")
+
+POSTGRES_FOREIGN_KEYS_QUERY = text("""
+SELECT
+    c.relname AS table_name,
+    a.attname AS column_name,
+    rn.nspname || '.' || rc.relname || '.' || ra.attname AS target_fullname
+FROM pg_catalog.pg_constraint con
+JOIN pg_catalog.pg_class c ON c.oid = con.conrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_class rc ON rc.oid = con.confrelid
+JOIN pg_catalog.pg_namespace rn ON rn.oid = rc.relnamespace
+CROSS JOIN LATERAL unnest(con.conkey, con.confkey) AS k(attnum, ref_attnum)
+JOIN pg_catalog.pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+JOIN pg_catalog.pg_attribute ra ON ra.attrelid = con.confrelid AND ra.attnum = k.ref_attnum
+WHERE con.contype = 'f'
+    AND n.nspname = :schema_name
+    AND c.relname = ANY(:table_names)
+ORDER BY c.relname, con.conname
+""")
+
+# enums and domains, the types of the columns are resolved with them like the Inspector of SQLAlchemy does
+POSTGRES_USER_TYPES_QUERY = text("""
+SELECT
+    t.typtype AS kind,
+    t.typname AS name,
+    n.nspname AS schema,
+    pg_catalog.pg_type_is_visible(t.oid) AS visible,
+    format_type(t.typbasetype, t.typtypmod) AS attype,
+    NOT t.typnotnull AS nullable,
+    t.typdefault AS default,
+    array_remove(array_agg(e.enumlabel::text ORDER BY e.enumsortorder), NULL) AS labels
+FROM pg_catalog.pg_type t
+JOIN pg_catalog.pg_namespace n ON n.oid = t.typnamespace
+LEFT JOIN pg_catalog.pg_enum e ON e.enumtypid = t.oid
+WHERE t.typtype IN ('e', 'd')
+GROUP BY t.oid, t.typtype, t.typname, n.nspname, t.typbasetype, t.typtypmod, t.typnotnull, t.typdefault
+""")
+
+# keywords used to classify the column types reported by get_table_info, binary types are checked first
+BINARY_TYPE_KEYWORDS = ('BYTEA', 'BLOB', 'BINARY', 'IMAGE', 'RAW')
+TEXT_TYPE_KEYWORDS = ('TEXT', 'CHAR', 'JSON', 'XML', 'CLOB', 'STRING', 'TSVECTOR', '[]')
+
+# sampling strategies supported by sample_table, 'auto' picks the best one for the dialect and the table
+SAMPLING_STRATEGIES = ('auto', 'limit', 'tablesample', 'keyset')
+TABLESAMPLE_DIALECTS = ('postgresql',)
+
+
+def get_metadata_cache() -> TTLCache:
+    """
+    Gets the cache of the reflected metadata (metadata_cache in the config), created on the first use.
+
+    :return: The cache shared by the process.
+    """
+    global metadata_cache
+    with metadata_cache_lock:
+        if metadata_cache is None:
+            metadata_cache = TTLCache(
+                ttl_seconds=metadata_cache_config.get('ttl_seconds', 3600),
+                max_entries=metadata_cache_config.get('max_entries', 1024),
+                persist_path=metadata_cache_config.get('persist_path')
+            )
+        return metadata_cache
+
+
+def create_db_session(database_url: str, **engine_options) -> Engine:
     """
     Creates a SQLAlchemy session for the specified database URL.
 
     :param database_url: The URL of the database to connect to.
+    :param engine_options: Options of create_engine, for example the pool settings (see get_pool_options).
     :return: A tuple containing an instance of SQLAlchemy Session and an Engine object.
     """
     try:
         logging.info('trying to connect to database')
         # Create a new SQLAlchemy engine instance with the given database URL.
-        engine_obj = create_engine(database_url)
+        engine_obj = create_engine(database_url, **engine_options)
 
         # Emit a simple select query to check the connection
         with engine_obj.connect() as connection:
@@ -34,13 +141,270 @@ def create_db_session(database_url: str) -> Engine:
         raise e
 
 
-def get_table_info(table_names_by_schema: Dict, engine_object: Engine) -> Dict[str, Any]:
+def get_pool_options(database_url: str) -> Dict[str, Any]:
+    """
+    Gets the pool settings of create_engine from the database_pool section of the config. SQLite does not use a
+    queue of connections, so it only gets the settings that every pool supports.
+
+    :param database_url: The URL of the database.
+    :return: A dictionary with the options of create_engine.
+    """
+    options = {
+        'pool_pre_ping': database_pool_config.get('pre_ping', True),
+        'pool_recycle': database_pool_config.get('recycle_seconds', 1800),
+    }
+    if not database_url.startswith('sqlite'):
+        options['pool_size'] = database_pool_config.get('size', 5)
+        options['max_overflow'] = database_pool_config.get('max_overflow', 10)
+        options['pool_timeout'] = database_pool_config.get('timeout_seconds', 30)
+    return options
+
+
+def get_engine(role: str = 'primary') -> Engine:
+    """
+    Gets the engine shared by the whole process, created on the first call with the URL of the secrets file and the
+    pool settings of the config. The replica uses database.replica_url and falls back to the primary engine when
+    it is not set.
+
+    :param role: primary, or replica for the read-only work.
+    :return: A SQLAlchemy engine object.
+    """
+    with engines_lock:
+        if role not in engines:
+            database_secrets = get_secrets(config)['database']
+            database_url = database_secrets['url']
+            if role == 'replica' and database_secrets.get('replica_url'):
+                database_url = database_secrets['replica_url']
+            same_engine = [engine_obj for engine_obj in engines.values() if str(engine_obj.url) == database_url]
+            if same_engine:
+                engines[role] = same_engine[0]
+            else:
+                engines[role] = create_db_session(database_url, **get_pool_options(database_url))
+        return engines[role]
+
+
+def get_read_engine(engine_object: Engine) -> Engine:
+    """
+    Gets the engine of the read-only work (reflection, sampling, profiling and the generated SELECT queries). The
+    primary engine of get_engine is replaced by the replica when database_pool.route_reads_to_replica is enabled,
+    any other engine is used as it is.
+
+    :param engine_object: A SQLAlchemy engine object.
+    :return: The engine that runs the read-only queries.
+    """
+    if not database_pool_config.get('route_reads_to_replica', True) or engines.get('primary') is not engine_object:
+        return engine_object
+    return get_engine('replica')
+
+
+def get_engine_key(engine_object: Engine) -> str:
+    """
+    Get a key that identifies the database of an engine, the password is never included.
+
+    :param engine_object: A SQLAlchemy engine object.
+    :return: The URL of the engine without the password.
+    """
+    return engine_object.url.render_as_string(hide_password=True)
+
+
+def reflect_table_columns(schema_name: str, table_name: str, engine_object: Engine) -> List[Dict[str, Any]]:
+    """
+    Reflects one table and returns the information of its columns.
+
+    :param schema_name: The schema of the table.
+    :param table_name: The name of the table.
+    :param engine_object: A SQLAlchemy engine object.
+    :return: A list of dictionaries, one for each column of the table.
+    """
+    information_columns = []
+    table = Table(table_name, MetaData(), autoload_with=get_read_engine(engine_object), schema=schema_name)
+    for column in table.columns.values():
+
+        table_dict = {
+            "column_name": str(column.name),
+            "type": str(column.type),
+            # "default": column.default,
+            # "nullable": column.nullable,
+            # "autoincrement": column.autoincrement,
+            "comment": column.comment,
+            "is_foreign_key": bool(column.foreign_keys),
+            "is_primary_key": bool(column.primary_key),
+            "foreign_key_tables": [
+                fk.target_fullname for fk in column.foreign_keys
+            ] if column.foreign_keys else None
+        }
+
+        information_columns.append(table_dict)
+    return information_columns
+
+
+def postgres_column_type(
+        dialect,
+        column_name: str,
+        format_type: str,
+        schema_name: str,
+        enums: Dict[tuple, Dict[str, Any]],
+        domains: Dict[tuple, Dict[str, Any]]
+) -> str:
+    """
+    Gets the type of a PostgreSQL column as the Inspector of SQLAlchemy reports it, the output of format_type is
+    parsed by the dialect, so the bulk reflection returns the same types as reflect_table_columns (for example
+    NUMERIC(10, 2) and TIMESTAMP).
+
+    :param dialect: The PostgreSQL dialect of the engine.
+    :param column_name: The name of the column.
+    :param format_type: The type of the column returned by format_type.
+    :param schema_name: The schema of the table.
+    :param enums: The enums of the database, see POSTGRES_USER_TYPES_QUERY.
+    :param domains: The domains of the database, see POSTGRES_USER_TYPES_QUERY.
+    :return: The type of the column as text.
+    """
+    column_info = dialect._get_column_info(
+        column_name, format_type, None, False, domains, enums, schema_name, None, None, None
+    )
+    return str(column_info['type'])
+
+
+def reflect_schema_tables_postgres(
+        schema_name: str,
+        table_names: List[str],
+        engine_object: Engine
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Reflects several tables of a PostgreSQL schema with three catalog queries, one for the columns (types, comments
+    and primary keys), one for the foreign keys and one for the enums and domains. The types are parsed by the
+    dialect of SQLAlchemy (see postgres_column_type).
+
+    :param schema_name: The schema of the tables.
+    :param table_names: The names of the tables.
+    :param engine_object: A SQLAlchemy engine object.
+    :return: A dictionary with the table name as key and the information of its columns as value.
+    """
+    params = {'schema_name': schema_name, 'table_names': list(table_names)}
+    with get_read_engine(engine_object).connect() as conn:
+        columns = conn.execute(POSTGRES_COLUMNS_QUERY, params).mappings().all()
+        foreign_keys = conn.execute(POSTGRES_FOREIGN_KEYS_QUERY, params).mappings().all()
+        user_types = conn.execute(POSTGRES_USER_TYPES_QUERY).mappings().all()
+
+    # keyed like the Inspector does, by name when the type is in the search path and by schema and name otherwise
+    enums, domains = {}, {}
+    for row in user_types:
+        key = (row['name'],) if row['visible'] else (row['schema'], row['name'])
+        if row['kind'] == 'e':
+            enums[key] = {
+                'name': row['name'], 'schema': row['schema'], 'visible': row['visible'], 'labels': list(row['labels'])
+            }
+        else:
+            # the Inspector drops the arguments of the base type, character varying(30) is reported as VARCHAR
+            attype = row['attype'].split('(')[0]
+            domains[key] = {'attype': attype, 'nullable': row['nullable'], 'default': row['default']}
+
+    foreign_key_tables = {}
+    for row in foreign_keys:
+        targets = foreign_key_tables.setdefault((row['table_name'], row['column_name']), [])
+        if row['target_fullname'] not in targets:
+            targets.append(row['target_fullname'])
+
+    tables = {}
+    for row in columns:
+        targets = foreign_key_tables.get((row['table_name'], row['column_name']))
+        tables.setdefault(row['table_name'], []).append({
+            "column_name": str(row['column_name']),
+            "type": postgres_column_type(
+                engine_object.dialect, row['column_name'], row['format_type'], schema_name, enums, domains
+            ),
+            "comment": row['comment'],
+            "is_foreign_key": bool(targets),
+            "is_primary_key": bool(row['is_primary_key']),
+            "foreign_key_tables": targets
+        })
+    return tables
+
+
+def reflect_schema_tables_inspector(
+        schema_name: str,
+        table_names: List[str],
+        engine_object: Engine
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Reflects several tables of a schema with a single SQLAlchemy Inspector, used for the dialects without a bulk
+    catalog query. The inspector caches the catalog lookups it shares between the tables.
+
+    :param schema_name: The schema of the tables.
+    :param table_names: The names of the tables.
+    :param engine_object: A SQLAlchemy engine object.
+    :return: A dictionary with the table name as key and the information of its columns as value.
+    """
+    tables = {}
+    with get_read_engine(engine_object).connect() as conn:
+        inspector = inspect(conn)
+        for table_name in table_names:
+            # copy the list, some dialects sort the cached columns in place when reading the primary key
+            columns = list(inspector.get_columns(table_name, schema=schema_name))
+            primary_keys = inspector.get_pk_constraint(table_name, schema=schema_name).get('constrained_columns') or []
+            foreign_key_tables = {}
+            for fk in inspector.get_foreign_keys(table_name, schema=schema_name):
+                referred_schema = fk.get('referred_schema') or schema_name
+                for column_name, referred_column in zip(fk['constrained_columns'], fk['referred_columns']):
+                    foreign_key_tables.setdefault(column_name, []).append(
+                        f"{referred_schema}.{fk['referred_table']}.{referred_column}"
+                    )
+            tables[table_name] = [
+                {
+                    "column_name": str(column['name']),
+                    "type": str(column['type']),
+                    "comment": column.get('comment'),
+                    "is_foreign_key": column['name'] in foreign_key_tables,
+                    "is_primary_key": column['name'] in primary_keys,
+                    "foreign_key_tables": foreign_key_tables.get(column['name'])
+                }
+                for column in columns
+            ]
+    return tables
+
+
+def reflect_schema_tables(
+        schema_name: str,
+        table_names: List[str],
+        engine_object: Engine
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Reflects several tables of one schema in bulk, the number of catalog queries does not grow with the number of
+    tables on PostgreSQL. The columns have the same structure returned by reflect_table_columns.
+
+    :param schema_name: The schema of the tables.
+    :param table_names: The names of the tables.
+    :param engine_object: A SQLAlchemy engine object.
+    :return: A dictionary with the table name as key and the information of its columns as value.
+    :raises: NoSuchTableError if one of the tables does not exist.
     """
-    Gets information about the specified tables.
+    if engine_object.dialect.name == 'postgresql':
+        tables = reflect_schema_tables_postgres(schema_name, table_names, engine_object)
+    else:
+        tables = reflect_schema_tables_inspector(schema_name, table_names, engine_object)
+
+    missing_tables = [table_name for table_name in table_names if not tables.get(table_name)]
+    if missing_tables:
+        raise NoSuchTableError(', '.join(f'{schema_name}.{table_name}' for table_name in missing_tables))
+    return tables
+
+
+def get_table_info(
+        table_names_by_schema: Dict,
+        engine_object: Engine,
+        use_cache: bool = True,
+        bulk: bool = True
+) -> Dict[str, Any]:
+    """
+    Gets information about the specified tables. The metadata of each table is stored in a process-wide cache
+    (see metadata_cache in the config file), so the tables are only reflected when they are not cached or expired.
+    In bulk mode the missing tables of each schema are reflected together (see reflect_schema_tables).
 
     :param table_names_by_schema: A dictionary with keys for each schema and values that are lists of table names.
         for example: {'schemas': {'schema_1': ['table_1', 'table_2], 'schema_2': ['table_3', 'table_4']}}
     :param engine_object: A SQLAlchemy engine object.
+    :param use_cache: If False, the tables are always reflected and the cache is refreshed.
+    :param bulk: If False, the tables are reflected one by one with a SQLAlchemy Table.
     :return: A list of dictionaries with information about the tables.
     {'schema_name.table_name': {'table': 'schema_name.table_name', 'columns': [dict_for_column_1, dict_for_column_2]}]
     """
@@ -50,65 +414,471 @@ def get_table_info(table_names_by_schema: Dict, engine_object: Engine) -> Dict[s
     if not isinstance(engine_object, Engine):
         raise Exception("Invalid engine object, please provide a valid SQLAlchemy engine object.")
     logging.info('Retrieving table information (metadata)')
-    metadata = MetaData()
+    engine_key = get_engine_key(engine_object)
     table_info = {}
+    reflected_tables = 0
     try:
         for schema_name, table_names in table_names_by_schema['schemas'].items():
-            for table_name in table_names:
-                information_columns = []
-
-                table = Table(table_name, metadata, autoload_with=engine_object, schema=schema_name)
-                for column in table.columns.values():
-
-                    table_dict = {
-                        "column_name": str(column.name),
-                        "type": str(column.type),
-                        # "default": column.default,
-                        # "nullable": column.nullable,
-                        # "autoincrement": column.autoincrement,
-                        "comment": column.comment,
-                        "is_foreign_key": bool(column.foreign_keys),
-                        "is_primary_key": bool(column.primary_key),
-                        "foreign_key_tables": [
-                            fk.target_fullname for fk in column.foreign_keys
-                        ] if column.foreign_keys else None
-                    }
+            schema_tables = {}
+            if use_cache:
+                for table_name in table_names:
+                    information_columns = get_metadata_cache().get((engine_key, schema_name, table_name))
+                    if information_columns is not None:
+                        schema_tables[table_name] = information_columns
 
-                    information_columns.append(table_dict)
+            missing_tables = [
+                table_name for table_name in dict.fromkeys(table_names) if table_name not in schema_tables
+            ]
+            if missing_tables:
+                if bulk:
+                    reflected = reflect_schema_tables(schema_name, missing_tables, engine_object)
+                else:
+                    reflected = {
+                        table_name: reflect_table_columns(schema_name, table_name, engine_object)
+                        for table_name in missing_tables
+                    }
+                for table_name in missing_tables:
+                    get_metadata_cache().set((engine_key, schema_name, table_name), reflected[table_name])
+                    schema_tables[table_name] = reflected[table_name]
+                reflected_tables += len(missing_tables)
 
+            for table_name in table_names:
+                information_columns = schema_tables[table_name]
                 table_info[f"{schema_name + '.' + table_name}"] = {
                     'table': schema_name + '.' + table_name,
-                    'columns': information_columns
+                    'columns': copy.deepcopy(information_columns)
                 }
-        logging.info('Table information retrieved successfully')
+        if reflected_tables:
+            get_metadata_cache().save()
+        logging.info(f'Table information retrieved successfully, {reflected_tables} tables reflected')
         return table_info
     except SQLAlchemyError as e:
         logging.error(f"Error retrieving table information: {str(e)}")
         raise e
 
 
-def get_data(info_extractor: dict, database: Engine, top_k: int = 10) -> Dict[str, DataFrame]:
+# functions called by invalidate_table_info with the same arguments, for the caches built on the metadata
+invalidation_listeners: List[Callable[[Optional[Engine], Optional[str], Optional[str]], Any]] = []
+
+
+def add_invalidation_listener(listener: Callable[[Optional[Engine], Optional[str], Optional[str]], Any]) -> None:
     """
-    Get data from database to be used in the CommentCreator
+    Register a function called when tables are removed from the metadata cache (see invalidate_table_info)
+    Args:
+        listener: function that receives the engine, the schema name and the table name
+    """
+    if listener not in invalidation_listeners:
+        invalidation_listeners.append(listener)
+
+
+def invalidate_table_info(engine_object: Engine = None, schema_name: str = None, table_name: str = None) -> int:
+    """
+    Removes tables from the metadata cache, for example after running DDL or COMMENT statements. The functions
+    registered with add_invalidation_listener are called too.
+
+    :param engine_object: Only remove the tables of this database, all the databases if None.
+    :param schema_name: Only remove the tables of this schema, all the schemas if None.
+    :param table_name: Only remove this table, all the tables if None.
+    :return: The number of tables removed from the cache.
+    """
+    engine_key = get_engine_key(engine_object) if engine_object is not None else None
+
+    def matches(cache_key: tuple) -> bool:
+        key_engine, key_schema, key_table = cache_key
+        return (
+            (engine_key is None or key_engine == engine_key)
+            and (schema_name is None or key_schema == schema_name)
+            and (table_name is None or key_table == table_name)
+        )
+
+    removed = get_metadata_cache().invalidate(matches)
+    get_metadata_cache().save()
+    logging.info(f'{removed} tables removed from the metadata cache')
+    for listener in invalidation_listeners:
+        try:
+            listener(engine_object, schema_name, table_name)
+        except Exception as e:
+            logging.warning(f'Error invalidating the caches built on the metadata: {e}')
+    return removed
+
+
+@contextmanager
+def connect_with_timeout(database: Engine, timeout_seconds: Optional[float] = None) -> Iterator[Connection]:
+    """
+    Opens a connection whose statements are cancelled by the database after the timeout. On PostgreSQL the
+    timeout is set with SET LOCAL inside a transaction that is rolled back at the end, so the pooled connection
+    keeps its defaults. On MySQL the session timeout is restored when the block ends. Other dialects ignore it.
+    Args:
+        database: database connection object
+        timeout_seconds: maximum time of each statement, None to disable the timeout
+
+    Returns: iterator that yields the connection
+    """
+    with database.connect() as conn:
+        timeout_ms = int(timeout_seconds * 1000) if timeout_seconds else None
+        dialect = database.dialect.name
+        if timeout_ms and dialect == 'postgresql':
+            with conn.begin() as transaction:
+                conn.exec_driver_sql(f'SET LOCAL statement_timeout = {timeout_ms}')
+                yield conn
+                transaction.rollback()
+        elif timeout_ms and dialect == 'mysql':
+            conn.exec_driver_sql(f'SET SESSION MAX_EXECUTION_TIME = {timeout_ms}')
+            try:
+                yield conn
+            finally:
+                conn.exec_driver_sql('SET SESSION MAX_EXECUTION_TIME = DEFAULT')
+        else:
+            yield conn
+
+
+def get_column_kind(column_type: str, max_text_length: int = None) -> str:
+    """
+    Classify a column type of the metadata collected by get_table_info
+    Args:
+        column_type: type of the column, for example 'VARCHAR(50)' or 'BYTEA'
+        max_text_length: text columns with a declared length up to this value are not considered large
+
+    Returns: 'binary', 'text' for text columns that can hold large values, or 'scalar' for the rest
+
+    """
+    column_type = column_type.upper()
+    if any(keyword in column_type for keyword in BINARY_TYPE_KEYWORDS):
+        return 'binary'
+    if any(keyword in column_type for keyword in TEXT_TYPE_KEYWORDS):
+        declared_length = re.search(r'CHAR[A-Z ]*\((\d+)\)', column_type)
+        if declared_length and max_text_length and int(declared_length.group(1)) <= max_text_length:
+            return 'scalar'
+        return 'text'
+    return 'scalar'
+
+
+def build_sample_query(
+        schema: str,
+        table: str,
+        columns_info: List[Dict[str, Any]] = None,
+        columns: List[str] = None,
+        top_k: int = 10,
+        max_text_length: int = 200,
+        sample_percent: float = None,
+        tablesample_method: str = 'SYSTEM'
+):
+    """
+    Build a query that only selects the requested columns of a table. Large text values are truncated by the
+    database and binary values are replaced by their size, so they are never transferred. Without the metadata of
+    the columns all the columns are selected.
+    Args:
+        schema: schema of the table
+        table: name of the table
+        columns_info: metadata of the columns of the table (see get_table_info)
+        columns: names of the columns to select, all the columns in columns_info if None
+        top_k: number of rows to be retrieved from the database
+        max_text_length: maximum number of characters retrieved for each text value
+        sample_percent: if given, the table is read with TABLESAMPLE using this percentage of the table
+        tablesample_method: SYSTEM (random pages) or BERNOULLI (random rows, reads the whole table)
+
+    Returns: SQLAlchemy select statement
+
+    """
+    selected_columns = []
+    for column_info in columns_info or []:
+        column_name = column_info['column_name']
+        if columns is not None and column_name not in columns:
+            continue
+        column = sql_column(column_name)
+        kind = get_column_kind(column_info['type'], max_text_length)
+        if kind == 'binary':
+            column = literal('<binary ') + cast(func.length(column), String) + literal(' bytes>')
+        elif kind == 'text':
+            column = func.substr(cast(column, String), 1, max_text_length)
+        selected_columns.append(column.label(column_name))
+    if columns_info is None:
+        selected_columns.append(literal_column('*'))
+    if not selected_columns:
+        raise ValueError(f'None of the columns {columns} exist in the table {schema}.{table}')
+
+    query = select(*selected_columns).select_from(sql_table(table, schema=schema)).limit(top_k)
+    if sample_percent is not None:
+        sampling_method = getattr(func, tablesample_method.lower())
+        sampled_table = tablesample(sql_table(table, schema=schema), sampling_method(sample_percent))
+        # only the rows of the sample are sorted, so the rows are not taken from the first pages sampled
+        query = select(*selected_columns).select_from(sampled_table).order_by(func.random()).limit(top_k)
+    return query
+
+
+def get_keyset_column(columns_info: List[Dict[str, Any]] = None) -> Optional[str]:
+    """
+    Get the column used to probe random ranges of a table, the table must have a single integer primary key
+    Args:
+        columns_info: metadata of the columns of the table (see get_table_info)
+
+    Returns: name of the primary key column or None
+
+    """
+    primary_keys = [column for column in columns_info or [] if column['is_primary_key']]
+    if len(primary_keys) == 1 and any(word in primary_keys[0]['type'].upper() for word in ('INT', 'SERIAL')):
+        return primary_keys[0]['column_name']
+    return None
+
+
+def choose_sampling_strategy(dialect: str, columns_info: List[Dict[str, Any]] = None, strategy: str = 'auto') -> str:
+    """
+    Choose how a table is sampled. TABLESAMPLE is used on the dialects that support it, random keyset probes on
+    tables with a single integer primary key, and LIMIT as a fallback.
+    Args:
+        dialect: name of the dialect of the engine (engine.dialect.name)
+        columns_info: metadata of the columns of the table (see get_table_info)
+        strategy: requested strategy, one of SAMPLING_STRATEGIES
+
+    Returns: the strategy that can be used for the table
+
+    """
+    if strategy not in SAMPLING_STRATEGIES:
+        raise ValueError(f'Invalid sampling strategy {strategy}, use one of {SAMPLING_STRATEGIES}')
+    if strategy in ('auto', 'tablesample') and dialect in TABLESAMPLE_DIALECTS:
+        return 'tablesample'
+    if strategy in ('auto', 'tablesample', 'keyset') and get_keyset_column(columns_info):
+        return 'keyset'
+    return 'limit'
+
+
+def estimate_row_count(conn: Connection, schema: str, table: str) -> Optional[float]:
+    """
+    Get the number of rows of a table estimated by the planner statistics, without reading the table
+    Args:
+        conn: database connection
+        schema: schema of the table
+        table: name of the table
+
+    Returns: estimated number of rows, None if there are no statistics or the dialect is not supported
+
+    """
+    if conn.dialect.name != 'postgresql':
+        return None
+    estimate = conn.execute(
+        text("SELECT reltuples FROM pg_catalog.pg_class WHERE oid = to_regclass(:table_name)"),
+        {'table_name': f'{schema}.{table}'}
+    ).scalar()
+    return estimate if estimate is not None and estimate > 0 else None
+
+
+def sample_rows_keyset(
+        conn: Connection,
+        query,
+        keyset_column: str,
+        top_k: int,
+        probes: int
+) -> DataFrame:
+    """
+    Sample a table reading short ranges of its primary key that start at random values. Each probe is an index
+    range scan, so the cost does not depend on the size of the table.
+    Args:
+        conn: database connection
+        query: select statement of the table (see build_sample_query)
+        keyset_column: integer primary key of the table
+        top_k: number of rows to be retrieved
+        probes: number of random ranges read
+
+    Returns: dataframe with the rows sampled
+
+    """
+    key = sql_column(keyset_column)
+    from_clause = query.get_final_froms()[0]
+    min_key, max_key = conn.execute(select(func.min(key), func.max(key)).select_from(from_clause)).one()
+    if min_key is None or max_key - min_key < top_k:
+        return pd.read_sql_query(query, conn)
+
+    probes = max(1, min(probes, top_k))
+    rows_per_probe = math.ceil(top_k / probes)
+    samples = []
+    seen_keys = set()
+    sampled_rows = 0
+    # a probe can overlap a previous one or start in a gap of the keys, extra probes fill the missing rows
+    for _ in range(probes * 3):
+        if sampled_rows >= top_k:
+            break
+        start = random.randint(min_key, max_key - rows_per_probe + 1)
+        probe = query.where(key >= start).order_by(key).limit(rows_per_probe)
+        rows = pd.read_sql_query(probe, conn)
+        if keyset_column in rows.columns:
+            rows = rows[~rows[keyset_column].isin(seen_keys)]
+            seen_keys.update(rows[keyset_column])
+        samples.append(rows)
+        sampled_rows += len(rows)
+    return pd.concat(samples, ignore_index=True).head(top_k)
+
+
+def sample_table(
+        schema: str,
+        table: str,
+        database: Engine,
+        top_k: int = 10,
+        timeout_seconds: Optional[float] = None,
+        columns_info: List[Dict[str, Any]] = None,
+        columns: List[str] = None,
+        max_text_length: int = None,
+        strategy: str = None
+) -> DataFrame:
+    """
+    Get sample rows of one table. When the metadata of the columns is given only the requested columns are
+    selected and large values are truncated (see build_sample_query), otherwise all the columns are selected.
+    The rows are spread over the table with TABLESAMPLE or random keyset probes when possible
+    (see choose_sampling_strategy), instead of the first physical rows returned by LIMIT.
+    Args:
+        schema: schema of the table
+        table: name of the table
+        database: database connection object
+        top_k: number of rows to be retrieved from the database
+        timeout_seconds: maximum time of the query
+        columns_info: metadata of the columns of the table (see get_table_info)
+        columns: names of the columns to select
+        max_text_length: maximum number of characters retrieved for each text value
+        strategy: sampling strategy, one of SAMPLING_STRATEGIES (sampling.strategy in the config)
+
+    Returns: dataframe with the rows of the table
+
+    """
+    max_text_length = max_text_length or sampling_config.get('max_text_length', 200)
+    strategy = choose_sampling_strategy(
+        database.dialect.name, columns_info, strategy or sampling_config.get('strategy', 'auto')
+    )
+    query = build_sample_query(schema, table, columns_info, columns, top_k, max_text_length)
+    with connect_with_timeout(get_read_engine(database), timeout_seconds) as conn:
+        if strategy == 'tablesample':
+            row_count = estimate_row_count(conn, schema, table)
+            oversampling = sampling_config.get('tablesample_oversampling', 10)
+            # small tables are read with LIMIT, the oversampling makes up for the pages skipped by SYSTEM
+            if row_count and row_count > top_k * oversampling:
+                methods = [sampling_config.get('tablesample_method', 'SYSTEM')]
+                # SYSTEM can miss every page of a small table, BERNOULLI is exact but reads the whole table
+                if row_count <= sampling_config.get('bernoulli_max_rows', 1000000) and 'BERNOULLI' not in methods:
+                    methods.append('BERNOULLI')
+                for method in methods:
+                    sampled_query = build_sample_query(
+                        schema, table, columns_info, columns, top_k, max_text_length,
+                        sample_percent=min(100.0, 100.0 * top_k * oversampling / row_count),
+                        tablesample_method=method
+                    )
+                    result = pd.read_sql_query(sampled_query, conn)
+                    if len(result) >= top_k:
+                        return result
+        elif strategy == 'keyset':
+            return sample_rows_keyset(
+                conn, query, get_keyset_column(columns_info), top_k, sampling_config.get('keyset_probes', 5)
+            )
+        return pd.read_sql_query(query, conn)
+
+
+def sample_tables(
+        info_extractor: dict,
+        database: Engine,
+        top_k: int = 10,
+        max_workers: int = None,
+        timeout_seconds: float = None,
+        table_metadata: Dict[str, Any] = None,
+        columns: Dict[str, List[str]] = None,
+        max_text_length: int = None
+) -> Tuple[Dict[str, DataFrame], Dict[str, str]]:
+    """
+    Sample the tables concurrently, each table is queried in a thread that takes its own connection from the
+    engine pool, so the total time is close to the time of the slowest table.
+    Args:
+        info_extractor: info extractor dictionary, contains the schemas and tables to be used
+        database: database connection object
+        top_k: number of rows to be retrieved from each table
+        max_workers: maximum number of tables sampled at the same time (sampling.max_workers in the config)
+        timeout_seconds: timeout of each query (sampling.timeout_seconds in the config)
+        table_metadata: result of get_table_info, used to project and truncate the columns (see sample_table)
+        columns: names of the columns to select for each table, using the 'schema.table' name as key
+        max_text_length: maximum number of characters retrieved for each text value
+
+    Returns: a tuple with the dataframes of the tables that were sampled and the errors of the ones that failed,
+    both dictionaries use the 'schema.table' name as key
+
+    """
+    max_workers = max_workers or sampling_config.get('max_workers', 8)
+    timeout_seconds = timeout_seconds or sampling_config.get('timeout_seconds')
+    tables = [
+        (schema, table) for schema, table_names in info_extractor['schemas'].items() for table in table_names
+    ]
+    table_metadata = table_metadata or {}
+    columns = columns or {}
+    table_data = {}
+    failed_tables = {}
+    if not tables:
+        return table_data, failed_tables
+
+    workers = min(max_workers, len(tables))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sampler')
+    futures = {
+        executor.submit(
+            sample_table,
+            schema,
+            table,
+            database,
+            top_k,
+            timeout_seconds,
+            table_metadata.get(f'{schema}.{table}', {}).get('columns'),
+            columns.get(f'{schema}.{table}'),
+            max_text_length
+        ): f'{schema}.{table}'
+        for schema, table in tables
+    }
+    # the database cancels the queries after the timeout, the margin covers the connection checkout. The tables queued
+    # behind the first ones start later, so the deadline grows with the number of rounds of workers
+    rounds = math.ceil(len(tables) / workers)
+    done, not_done = wait(futures, timeout=rounds * (timeout_seconds + 5) if timeout_seconds else None)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future in done:
+        try:
+            table_data[futures[future]] = future.result()
+        except Exception as e:
+            failed_tables[futures[future]] = str(e)
+    for future in not_done:
+        failed_tables[futures[future]] = f'Timed out after {timeout_seconds} seconds'
+
+    # keep the order of the tables requested
+    table_data = {name: table_data[name] for name in futures.values() if name in table_data}
+    return table_data, failed_tables
+
+
+def get_data(
+        info_extractor: dict,
+        database: Engine,
+        top_k: int = 10,
+        max_workers: int = None,
+        timeout_seconds: float = None,
+        table_metadata: Dict[str, Any] = None,
+        columns: Dict[str, List[str]] = None
+) -> Dict[str, DataFrame]:
+    """
+    Get data from database to be used in the CommentCreator, the tables are sampled concurrently (see sample_tables).
+    The tables that could not be sampled are reported in the logs and returned as empty dataframes.
     Args:
         info_extractor: infor extractor dictionary, contains the schemas and tables to be used
         database: database connection object
         top_k: number of rows to be retrieved from the database
+        max_workers: maximum number of tables sampled at the same time
+        timeout_seconds: timeout of each query
+        table_metadata: result of get_table_info, when given only the columns in the metadata (or in columns) are
+            selected, large text values are truncated and binary values are summarized
+        columns: names of the columns to select for each table, using the 'schema.table' name as key
 
     Returns: dictionary with the table name as key and a dataframe as value
 
     """
     logging.info('Getting data from database')
-    try:
-        table_data = {}
-        for schema, tables in info_extractor['schemas'].items():
-            for table in tables:
-                query = f"SELECT * FROM {schema}.{table} LIMIT {top_k};"
-                with database.connect() as conn:
-                    result = pd.read_sql_query(query, conn)
-                table_data[f'{schema}.{table}'] = result
-        logging.info('Data retrieved successfully')
-        return table_data
-    except SQLAlchemyError as e:
-        logging.error(f"Error retrieving data from database: {str(e)}")
-        raise e
+    table_data, failed_tables = sample_tables(
+        info_extractor, database, top_k, max_workers, timeout_seconds, table_metadata, columns
+    )
+    for table_name, error in failed_tables.items():
+        logging.error(f"Error retrieving data from table {table_name}: {error}")
+    if failed_tables and not table_data:
+        raise SQLAlchemyError(f"Error retrieving data from database: {failed_tables}")
+
+    logging.info(f'Data retrieved successfully from {len(table_data)} tables, {len(failed_tables)} failed')
+    return {
+        f'{schema}.{table}': table_data.get(f'{schema}.{table}', DataFrame())
+        for schema, tables in info_extractor['schemas'].items() for table in tables
+    }
@@ -0,0 +1,127 @@
+import logging
+import threading
+from typing import List, Optional
+
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
+
+from utils.cache import SQLiteCache, TTLCache
+from utils.config_loaders import get_config, get_secrets
+
+config = get_config()
+embedding_cache_config = config.get('embedding_cache', {})
+
+query_embedding_cache: Optional[TTLCache] = None
+query_embedding_cache_lock = threading.Lock()
+
+
+def get_query_embedding_cache() -> TTLCache:
+    """
+    Get the in memory cache of the embeddings of the questions (embedding_cache in the config), created on the
+    first use and shared by the process
+    Returns: the cache
+    """
+    global query_embedding_cache
+    with query_embedding_cache_lock:
+        if query_embedding_cache is None:
+            query_embedding_cache = TTLCache(
+                ttl_seconds=embedding_cache_config.get('ttl_seconds', 86400),
+                max_entries=embedding_cache_config.get('max_entries', 1024)
+            )
+        return query_embedding_cache
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize a query before it is used as a cache key, the case and the spaces are ignored
+    Args:
+        text: query
+
+    Returns: the normalized query
+    """
+    return ' '.join(text.lower().split())
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings model that caches the embeddings of the queries, keyed by the name of the model and the normalized
+    query. The entries live in a bounded LRU in memory and optionally in a SQLite file shared by the processes. The
+    documents are not cached, they are embedded once by the indexes that use them.
+    """
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            model_name: str,
+            cache: TTLCache = None,
+            disk_cache: Optional[SQLiteCache] = None
+    ):
+        """
+        Args:
+            embeddings: embeddings model that computes the missing embeddings
+            model_name: name of the embeddings model, part of the key
+            cache: in memory cache, the one shared by the process by default
+            disk_cache: optional cache shared with other processes
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = get_query_embedding_cache() if cache is None else cache
+        self.disk_cache = disk_cache
+
+    def _get_cached(self, key: tuple) -> Optional[List[float]]:
+        vector = self.cache.get(key)
+        if vector is None and self.disk_cache is not None:
+            vector = self.disk_cache.get(key)
+            if vector is not None:
+                self.cache.set(key, vector)
+        return vector
+
+    def _set_cached(self, key: tuple, vector: List[float]) -> None:
+        self.cache.set(key, vector)
+        if self.disk_cache is not None:
+            self.disk_cache.set(key, vector)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model_name, normalize_query(text))
+        vector = self._get_cached(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._set_cached(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = (self.model_name, normalize_query(text))
+        vector = self._get_cached(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self._set_cached(key, vector)
+        return vector
+
+
+def create_embeddings() -> CachedEmbeddings:
+    """
+    Create the OpenAI embeddings model with the query cache configured in embedding_cache
+    Returns: the embeddings model
+    """
+    secrets = get_secrets(config)
+    embeddings = OpenAIEmbeddings(
+        openai_api_key=secrets['openai_api']['token'],
+        openai_organization=secrets['openai_api']['organization']
+    )
+    disk_cache = None
+    if embedding_cache_config.get('persist_path'):
+        try:
+            disk_cache = SQLiteCache(
+                embedding_cache_config['persist_path'],
+                ttl_seconds=embedding_cache_config.get('ttl_seconds', 86400),
+                table='query_embeddings'
+            )
+        except Exception as e:
+            logging.warning(f'The embeddings cache file can not be opened, using only the memory cache: {e}')
+    return CachedEmbeddings(embeddings, embeddings.model, disk_cache=disk_cache)
@@ -0,0 +1,440 @@
+import asyncio
+import contextvars
+import copy
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import openai
+import tiktoken
+import tqdm
+from langchain.chat_models.base import BaseChatModel
+from langchain.output_parsers import PydanticOutputParser
+from langchain.schema import BaseMessage
+
+from utils.cache import create_cache
+from utils.config_loaders import get_config
+
+config = get_config()
+llm_concurrency_config = config.get('llm_concurrency', {})
+llm_cache_config = config.get('llm_cache', {})
+
+T = TypeVar('T')
+
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError)
+
+# set while a request runs inside call_with_retry, the retries of the model client are disabled so every attempt
+# goes through the rate limiter
+retries_handled = contextvars.ContextVar('retries_handled', default=False)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> Optional[tiktoken.Encoding]:
+    """
+    Get the tokenizer of a model, loaded once per process
+    Args:
+        model_name: name of the model
+
+    Returns: the tokenizer, or None if it can not be loaded (for example without network access)
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logging.warning(f'Tokenizer not available for {model_name}, the tokens will be estimated: {e}')
+        return None
+
+
+def count_tokens(text: str, model_name: str = 'gpt-3.5-turbo') -> int:
+    """
+    Count the tokens of a text with the tokenizer of the model. If the tokenizer can not be loaded the count is
+    estimated as one token every four characters.
+    Args:
+        text: text to be counted
+        model_name: name of the model that will receive the text
+
+    Returns: number of tokens of the text
+    """
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+# maximum tokens of the prompt plus the answer of each model, the longest matching prefix of the name is used
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+
+
+def get_context_window(model_name: str) -> int:
+    """
+    Get the context window of a model
+    Args:
+        model_name: name of the model, for example gpt-3.5-turbo-16k-0613
+
+    Returns: maximum number of tokens of the prompt plus the answer, 4096 for unknown models
+    """
+    prefixes = [prefix for prefix in CONTEXT_WINDOWS if model_name.startswith(prefix)]
+    return CONTEXT_WINDOWS[max(prefixes, key=len)] if prefixes else 4096
+
+
+def count_messages_tokens(messages: List[BaseMessage], model_name: str = 'gpt-3.5-turbo') -> int:
+    """
+    Count the tokens of the messages of a prompt, including a few tokens of overhead for each message
+    Args:
+        messages: formatted messages of the prompt
+        model_name: name of the model that will receive the messages
+
+    Returns: number of tokens of the prompt
+    """
+    return sum(count_tokens(message.content, model_name) + 4 for message in messages) + 3
+
+
+def without_client_retries(model: BaseChatModel) -> BaseChatModel:
+    """
+    Copy of the model without the retries of the OpenAI client when the request is already retried by
+    call_with_retry, otherwise each attempt of call_with_retry would retry again inside the client
+    Args:
+        model: chat model
+
+    Returns: the model to use for the request
+    """
+    if retries_handled.get() and getattr(model, 'max_retries', 0):
+        # a new model instead of model.copy, the copy of pydantic drops the excluded fields (callbacks, tags, metadata)
+        return model.__class__(**{**{name: getattr(model, name) for name in model.__fields__}, 'max_retries': 0})
+    return model
+
+
+def predict_messages(model: BaseChatModel, messages: List[BaseMessage]) -> str:
+    """
+    Send the messages to the chat model and return the content of the answer
+    Args:
+        model: chat model
+        messages: formatted messages of the prompt
+
+    Returns: content of the message generated by the model
+    """
+    return without_client_retries(model)(messages).content
+
+
+async def apredict_messages(model: BaseChatModel, messages: List[BaseMessage]) -> str:
+    """
+    Async version of predict_messages, the event loop is not blocked while the model answers
+    Args:
+        model: chat model
+        messages: formatted messages of the prompt
+
+    Returns: content of the message generated by the model
+    """
+    result = await without_client_retries(model).agenerate([messages])
+    return result.generations[0][0].text
+
+
+llm_cache = None
+llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """
+    Get the cache of the answers of the model (llm_cache in the config), created on the first use. The creation is
+    guarded by a lock, the first calls can come from several worker threads of run_llm_tasks at the same time.
+    Returns: the cache, or None if it is disabled
+    """
+    global llm_cache
+    if llm_cache is not None or not llm_cache_config.get('enabled', False):
+        return llm_cache
+    with llm_cache_lock:
+        if llm_cache is None:
+            llm_cache = create_cache(
+                backend=llm_cache_config.get('backend', 'memory'),
+                ttl_seconds=llm_cache_config.get('ttl_seconds'),
+                max_entries=llm_cache_config.get('max_entries', 2048),
+                path=llm_cache_config.get('path'),
+                url=llm_cache_config.get('url'),
+                namespace='llm_answers'
+            )
+    return llm_cache
+
+
+def get_llm_cache_key(model: BaseChatModel, messages: List[BaseMessage]) -> Optional[tuple]:
+    """
+    Key of the answer of the model to some messages: the model name, the temperature and the hash of the messages.
+    Only the models with a temperature up to llm_cache.max_temperature are cached, their answers are deterministic.
+    Args:
+        model: chat model
+        messages: formatted messages of the prompt
+
+    Returns: the key, or None if the answer must not be cached
+    """
+    model_name = getattr(model, 'model_name', None)
+    temperature = getattr(model, 'temperature', None)
+    if model_name is None or temperature is None or temperature > llm_cache_config.get('max_temperature', 0):
+        return None
+    content = json.dumps([[message.type, message.content] for message in messages])
+    return model_name, temperature, hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def predict_and_parse(model: BaseChatModel, messages: List[BaseMessage], parser: PydanticOutputParser) -> Dict:
+    """
+    Send the messages to the chat model and parse the answer. The parsed answers are cached (see get_llm_cache_key),
+    so an identical prompt does not call the model again. The answers that can not be parsed are not cached.
+    Args:
+        model: chat model
+        messages: formatted messages of the prompt
+        parser: parser of the answer
+
+    Returns: the parsed answer as a dictionary
+    """
+    cache = get_llm_cache()
+    key = get_llm_cache_key(model, messages) if cache is not None else None
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info(f'Answer of {key[0]} read from the cache')
+            # the memory backend returns the stored object, a caller changing the answer would change the cache
+            return copy.deepcopy(cached)
+    result = parser.parse(predict_messages(model, messages)).dict()
+    if key is not None:
+        cache.set(key, copy.deepcopy(result))
+    return result
+
+
+async def apredict_and_parse(
+        model: BaseChatModel,
+        messages: List[BaseMessage],
+        parser: PydanticOutputParser
+) -> Dict:
+    """
+    Async version of predict_and_parse
+    Args:
+        model: chat model
+        messages: formatted messages of the prompt
+        parser: parser of the answer
+
+    Returns: the parsed answer as a dictionary
+    """
+    cache = get_llm_cache()
+    key = get_llm_cache_key(model, messages) if cache is not None else None
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info(f'Answer of {key[0]} read from the cache')
+            # the memory backend returns the stored object, a caller changing the answer would change the cache
+            return copy.deepcopy(cached)
+    result = parser.parse(await apredict_messages(model, messages)).dict()
+    if key is not None:
+        cache.set(key, copy.deepcopy(result))
+    return result
+
+
+class RateLimiter:
+    """
+    Limits the requests and the tokens sent to the model in any window of one minute. The limiter is shared by
+    all the threads of the process, a call to acquire blocks until the request fits in both budgets.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        """
+        Args:
+            requests_per_minute: maximum number of requests per minute, None for no limit
+            tokens_per_minute: maximum number of tokens per minute, None for no limit
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._window = deque()
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float) -> None:
+        while self._window and now - self._window[0][0] >= 60:
+            _, tokens = self._window.popleft()
+            self._tokens_in_window -= tokens
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        Wait until a request with the given number of tokens can be sent.
+        Args:
+            tokens: estimated tokens of the request, a request bigger than the budget waits for an empty window
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._purge(now)
+                fits_requests = self.requests_per_minute is None or len(self._window) < self.requests_per_minute
+                fits_tokens = (
+                    self.tokens_per_minute is None
+                    or self._tokens_in_window + tokens <= self.tokens_per_minute
+                    or not self._window
+                )
+                if fits_requests and fits_tokens:
+                    self._window.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                wait_seconds = 60 - (now - self._window[0][0])
+            time.sleep(max(wait_seconds, 0.01))
+
+
+rate_limiter: Optional[RateLimiter] = None
+rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    Get the rate limiter shared by the requests of the process (llm_concurrency in the config), created on the
+    first use
+    Returns: the rate limiter
+    """
+    global rate_limiter
+    with rate_limiter_lock:
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(
+                requests_per_minute=llm_concurrency_config.get('requests_per_minute'),
+                tokens_per_minute=llm_concurrency_config.get('tokens_per_minute')
+            )
+        return rate_limiter
+
+
+def call_with_retry(
+        function: Callable[[], T],
+        tokens: int = 0,
+        max_retries: int = None,
+        limiter: RateLimiter = None
+) -> T:
+    """
+    Call a function that requests the model, waiting for the rate limiter before each attempt and retrying with
+    exponential backoff and jitter when the API answers with a rate limit (429) or service unavailable error. The
+    retries of the OpenAI client are disabled during the call (see without_client_retries).
+    Args:
+        function: function without arguments that calls the model
+        tokens: estimated tokens of the request
+        max_retries: number of retries (llm_concurrency.max_retries in the config)
+        limiter: rate limiter to use, the one shared by the process by default
+
+    Returns: the result of the function
+    """
+    max_retries = llm_concurrency_config.get('max_retries', 5) if max_retries is None else max_retries
+    limiter = limiter or get_rate_limiter()
+    token = retries_handled.set(True)
+    try:
+        for attempt in range(max_retries + 1):
+            limiter.acquire(tokens)
+            try:
+                return function()
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                delay = min(60, 2 ** attempt) * (1 + random.random())
+                logging.warning(f'Model request failed ({e}), retrying in {delay:.1f} seconds')
+                time.sleep(delay)
+    finally:
+        retries_handled.reset(token)
+
+
+def run_llm_tasks(
+        tasks: List[Callable[[], T]],
+        tokens: List[int] = None,
+        max_in_flight: int = None,
+        progress: bool = False
+) -> List[T]:
+    """
+    Run functions that call the model concurrently, with at most max_in_flight requests at the same time. Every
+    request goes through the rate limiter and is retried on rate limit errors (see call_with_retry).
+    Args:
+        tasks: functions without arguments that call the model
+        tokens: estimated tokens of each task
+        max_in_flight: maximum number of concurrent requests (llm_concurrency.max_in_flight in the config)
+        progress: show a progress bar
+
+    Returns: the results of the tasks, in the same order as the tasks
+    """
+    if not tasks:
+        return []
+    tokens = tokens or [0] * len(tasks)
+    max_in_flight = max_in_flight or llm_concurrency_config.get('max_in_flight', 4)
+    results = [None] * len(tasks)
+    with ThreadPoolExecutor(max_workers=min(max_in_flight, len(tasks)), thread_name_prefix='llm') as executor:
+        # each thread runs in a copy of the context, so the tasks report to the progress listener of the request
+        futures = {
+            executor.submit(contextvars.copy_context().run, call_with_retry, task, task_tokens): i
+            for i, (task, task_tokens) in enumerate(zip(tasks, tokens))
+        }
+        completed = as_completed(futures)
+        try:
+            for future in tqdm.tqdm(completed, total=len(futures)) if progress else completed:
+                results[futures[future]] = future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+async def acall_with_retry(
+        function: Callable[[], Awaitable[T]],
+        tokens: int = 0,
+        max_retries: int = None,
+        limiter: RateLimiter = None
+) -> T:
+    """
+    Async version of call_with_retry, the rate limiter is awaited in a thread so the event loop is not blocked
+    Args:
+        function: function without arguments that returns the coroutine that calls the model
+        tokens: estimated tokens of the request
+        max_retries: number of retries (llm_concurrency.max_retries in the config)
+        limiter: rate limiter to use, the one shared by the process by default
+
+    Returns: the result of the coroutine
+    """
+    max_retries = llm_concurrency_config.get('max_retries', 5) if max_retries is None else max_retries
+    limiter = limiter or get_rate_limiter()
+    token = retries_handled.set(True)
+    try:
+        for attempt in range(max_retries + 1):
+            await asyncio.to_thread(limiter.acquire, tokens)
+            try:
+                return await function()
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                delay = min(60, 2 ** attempt) * (1 + random.random())
+                logging.warning(f'Model request failed ({e}), retrying in {delay:.1f} seconds')
+                await asyncio.sleep(delay)
+    finally:
+        retries_handled.reset(token)
+
+
+async def arun_llm_tasks(
+        tasks: List[Callable[[], Awaitable[T]]],
+        tokens: List[int] = None,
+        max_in_flight: int = None
+) -> List[T]:
+    """
+    Async version of run_llm_tasks, at most max_in_flight coroutines call the model at the same time
+    Args:
+        tasks: functions without arguments that return the coroutines that call the model
+        tokens: estimated tokens of each task
+        max_in_flight: maximum number of concurrent requests (llm_concurrency.max_in_flight in the config)
+
+    Returns: the results of the tasks, in the same order as the tasks
+    """
+    tokens = tokens or [0] * len(tasks)
+    semaphore = asyncio.Semaphore(max_in_flight or llm_concurrency_config.get('max_in_flight', 4))
+
+    async def run(task: Callable[[], Awaitable[T]], task_tokens: int) -> T:
+        async with semaphore:
+            return await acall_with_retry(task, task_tokens)
+
+    return list(await asyncio.gather(*[run(task, task_tokens) for task, task_tokens in zip(tasks, tokens)]))
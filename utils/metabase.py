@@ -1,3 +1,4 @@
+import copy
 import logging
 import os
 from typing import Dict
@@ -5,7 +6,7 @@ from typing import Dict
 import httpx
 import requests
 
-from prompts.metabase_graphs import MetabaseGraph
+from prompts.metabase_graphs import BarChart, LineChart, MetabaseGraph, NumericIndicator, Table
 
 base_numeric_indicator = {
     "name": "Card title",
@@ -208,6 +209,122 @@ def create_metabase_dashboard(
     return response.json()
 
 
+def build_numeric_indicator(
+        graph_info: Dict,
+        database_id: int,
+        collection_id: int,
+        numeric_indicator_structure: Dict) -> Dict:
+    """
+    Fill the structure of a numeric indicator card with the answer of the model
+    Args:
+        graph_info: settings of the card generated by MetabaseGraph
+        database_id: id of the database in Metabase
+        collection_id: id of the collection of the card
+        numeric_indicator_structure: structure of the card, updated in place
+
+    Returns: the structure of the card
+    """
+    numeric_indicator_structure['name'] = graph_info['name']
+    numeric_indicator_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
+    numeric_indicator_structure['dataset_query']['database'] = database_id
+    numeric_indicator_structure['description'] = graph_info['description']
+    vs_tmp = {
+        'column_settings': {
+            '[\"name\", \"' + graph_info['visualization_settings_columns_name'] + '\"]': {
+                'number_style': graph_info['visualization_settings_column_settings_number_style'],
+                'decimals': graph_info['visualization_settings_column_settings_decimals'],
+                'scale': graph_info['visualization_settings_column_settings_scale'],
+                'prefix': graph_info['visualization_settings_column_settings_prefix'],
+                'suffix': graph_info['visualization_settings_column_settings_suffix']
+            }
+        }
+    }
+    numeric_indicator_structure['visualization_settings'] = vs_tmp
+    numeric_indicator_structure['collection_id'] = collection_id
+    return numeric_indicator_structure
+
+
+def build_barchart(graph_info: Dict, database_id: int, collection_id: int, barchart_structure: Dict) -> Dict:
+    """
+    Fill the structure of a bar chart card with the answer of the model
+    Args:
+        graph_info: settings of the card generated by MetabaseGraph
+        database_id: id of the database in Metabase
+        collection_id: id of the collection of the card
+        barchart_structure: structure of the card, updated in place
+
+    Returns: the structure of the card
+    """
+    barchart_structure['name'] = graph_info['name']
+    barchart_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
+    barchart_structure['dataset_query']['database'] = database_id
+    barchart_structure['description'] = graph_info['description']
+    barchart_structure['visualization_settings'] = {
+        "graph.dimensions": graph_info['visualization_settings_graph_dimensions'],
+        "graph.metrics": graph_info['visualization_settings_graph_metrics'],
+    }
+    barchart_structure['collection_id'] = collection_id
+    return barchart_structure
+
+
+def build_linechart(graph_info: Dict, database_id: int, collection_id: int, linechart_structure: Dict) -> Dict:
+    """
+    Fill the structure of a line chart card with the answer of the model
+    Args:
+        graph_info: settings of the card generated by MetabaseGraph
+        database_id: id of the database in Metabase
+        collection_id: id of the collection of the card
+        linechart_structure: structure of the card, updated in place
+
+    Returns: the structure of the card
+    """
+    linechart_structure['name'] = graph_info['name']
+    linechart_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
+    linechart_structure['dataset_query']['database'] = database_id
+    linechart_structure['description'] = graph_info['description']
+    linechart_structure['visualization_settings'] = {
+        "graph.show_goal": False,
+        "graph.show_trendline": graph_info['visualization_settings_graph_show_trendline'],
+        "graph.show_values": graph_info['visualization_settings_graph_show_values'],
+        "graph.label_value_frequency": "fit",
+        "graph.dimensions": graph_info['visualization_settings_graph_dimensions'],
+        "graph.metrics": graph_info['visualization_settings_graph_metrics']
+    }
+    linechart_structure['collection_id'] = collection_id
+    return linechart_structure
+
+
+def build_table(graph_info: Dict, database_id: int, collection_id: int, table_structure: Dict) -> Dict:
+    """
+    Fill the structure of a table card with the answer of the model
+    Args:
+        graph_info: settings of the card generated by MetabaseGraph
+        database_id: id of the database in Metabase
+        collection_id: id of the collection of the card
+        table_structure: structure of the card, updated in place
+
+    Returns: the structure of the card
+    """
+    table_structure['name'] = graph_info['name']
+    table_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
+    table_structure['dataset_query']['database'] = database_id
+    table_structure['description'] = graph_info['description']
+    tpm = {'[\"name\", \"' + key + '\"]': val for key, val in
+           graph_info['visualization_settings_column_formatting_style'].items()}
+    table_structure['visualization_settings'] = {
+        "table.column_formatting": [
+            {
+                "columns": graph_info['visualization_settings_column_formatting_columns'],
+                "type": "range",
+                "colors": graph_info['visualization_settings_column_formatting_colors']
+            }
+        ],
+        "column_settings": tpm
+    }
+    table_structure['collection_id'] = collection_id
+    return table_structure
+
+
 def create_numeric_indicator(
         metabase_url: str,
         database_id: int,
@@ -217,23 +334,7 @@ def create_numeric_indicator(
         numeric_indicator_structure: Dict) -> Dict:
     try:
         graph_info = MetabaseGraph().numeric_indicator(card_info=card_info)
-        numeric_indicator_structure['name'] = graph_info['name']
-        numeric_indicator_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
-        numeric_indicator_structure['dataset_query']['database'] = database_id
-        numeric_indicator_structure['description'] = graph_info['description']
-        vs_tmp = {
-            'column_settings': {
-                '[\"name\", \"' + graph_info['visualization_settings_columns_name'] + '\"]': {
-                    'number_style': graph_info['visualization_settings_column_settings_number_style'],
-                    'decimals': graph_info['visualization_settings_column_settings_decimals'],
-                    'scale': graph_info['visualization_settings_column_settings_scale'],
-                    'prefix': graph_info['visualization_settings_column_settings_prefix'],
-                    'suffix': graph_info['visualization_settings_column_settings_suffix']
-                }
-            }
-        }
-        numeric_indicator_structure['visualization_settings'] = vs_tmp
-        numeric_indicator_structure['collection_id'] = collection_id
+        build_numeric_indicator(graph_info, database_id, collection_id, numeric_indicator_structure)
 
         response = requests.post(
             os.path.join(metabase_url, 'api', 'card/'),
@@ -263,15 +364,7 @@ def create_barchart(
         barchart_structure: Dict) -> Dict:
     try:
         graph_info = MetabaseGraph().bar_chart(card_info=card_info)
-        barchart_structure['name'] = graph_info['name']
-        barchart_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
-        barchart_structure['dataset_query']['database'] = database_id
-        barchart_structure['description'] = graph_info['description']
-        barchart_structure['visualization_settings'] = {
-            "graph.dimensions": graph_info['visualization_settings_graph_dimensions'],
-            "graph.metrics": graph_info['visualization_settings_graph_metrics'],
-        }
-        base_bar_chart['collection_id'] = collection_id
+        build_barchart(graph_info, database_id, collection_id, barchart_structure)
         response = requests.post(
             os.path.join(metabase_url, 'api', 'card/'),
             headers=headers,
@@ -300,19 +393,7 @@ def create_linechart(
         linechart_structure: Dict) -> Dict:
     try:
         graph_info = MetabaseGraph().line_chart(card_info=card_info)
-        linechart_structure['name'] = graph_info['name']
-        linechart_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
-        linechart_structure['dataset_query']['database'] = database_id
-        linechart_structure['description'] = graph_info['description']
-        linechart_structure['visualization_settings'] = {
-            "graph.show_goal": False,
-            "graph.show_trendline": graph_info['visualization_settings_graph_show_trendline'],
-            "graph.show_values": graph_info['visualization_settings_graph_show_values'],
-            "graph.label_value_frequency": "fit",
-            "graph.dimensions": graph_info['visualization_settings_graph_dimensions'],
-            "graph.metrics": graph_info['visualization_settings_graph_metrics']
-        }
-        linechart_structure['collection_id'] = collection_id
+        build_linechart(graph_info, database_id, collection_id, linechart_structure)
         response = requests.post(
             os.path.join(metabase_url, 'api', 'card/'),
             headers=headers,
@@ -341,23 +422,7 @@ def create_table(
         table_structure: Dict) -> Dict:
     try:
         graph_info = MetabaseGraph().table(card_info=card_info)
-        table_structure['name'] = graph_info['name']
-        table_structure['dataset_query']['native']['query'] = graph_info['dataset_query_native_query']
-        table_structure['dataset_query']['database'] = database_id
-        table_structure['description'] = graph_info['description']
-        tpm = {'[\"name\", \"' + key + '\"]': val for key, val in
-            graph_info['visualization_settings_column_formatting_style'].items()}
-        table_structure['visualization_settings'] = {
-            "table.column_formatting": [
-                {
-                    "columns": graph_info['visualization_settings_column_formatting_columns'],
-                    "type": "range",
-                    "colors": graph_info['visualization_settings_column_formatting_colors']
-                }
-            ],
-            "column_settings": tpm
-        }
-        base_table['collection_id'] = collection_id
+        build_table(graph_info, database_id, collection_id, table_structure)
         response = requests.post(
             os.path.join(metabase_url, 'api', 'card/'),
             headers=headers,
@@ -375,3 +440,149 @@ def create_table(
         logging.info('Table Created!')
 
     return response.json()
+
+
+# pydantic object of the answer of the model, function that fills the card and base structure of each card type
+CARD_TYPES = {
+    'Numeric Indicator': (NumericIndicator, build_numeric_indicator, base_numeric_indicator),
+    'Bar Chart': (BarChart, build_barchart, base_bar_chart),
+    'Line Chart': (LineChart, build_linechart, base_line_chart),
+    'Table': (Table, build_table, base_table),
+}
+
+
+def create_card(
+        metabase_url: str,
+        database_id: int,
+        collection_id: int,
+        card_info: Dict,
+        headers: Dict) -> Dict:
+    """
+    Create a card of any type, the type of the card is read from card_info['classify'] (see CARD_TYPES).
+    Args:
+        metabase_url: url of Metabase
+        database_id: id of the database in Metabase
+        collection_id: id of the collection of the card
+        card_info: query generated by MetabaseCreator
+        headers: headers of the request
+
+    Returns: the card created
+    """
+    pydantic_object, build_card, base_structure = CARD_TYPES[card_info['classify']]
+    graph_info = MetabaseGraph().get_result(pydantic_object=pydantic_object, card_info=card_info)
+    # every card gets its own copy, the base structures are shared by the cards created at the same time
+    card_structure = build_card(graph_info, database_id, collection_id, copy.deepcopy(base_structure))
+    try:
+        response = requests.post(os.path.join(metabase_url, 'api', 'card/'), headers=headers, json=card_structure)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as err:
+        logging.error(f'HTTP error occurred: {err}')
+        raise
+    logging.info(f'Created {card_info["classify"]} Card: {graph_info["name"]}')
+    return response.json()
+
+
+async def apost(client: httpx.AsyncClient, url: str, headers: Dict, payload) -> Dict:
+    """
+    Send a POST request to the Metabase API without blocking the event loop.
+    Args:
+        client: async http client, shared by the requests of the same chain
+        url: url of the endpoint
+        headers: headers of the request, with the Metabase session
+        payload: json body of the request
+
+    Returns: json of the response
+    """
+    try:
+        response = await client.post(url, headers=headers, json=payload)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as http_err:
+        logging.error(f'HTTP error occurred: {http_err}')
+        raise
+    except Exception as err:
+        logging.error(f'Other error occurred: {err}')
+        raise
+    return response.json()
+
+
+async def acreate_metabase_collection(
+        client: httpx.AsyncClient,
+        parent_id: int,
+        dashboard_name: str,
+        metabase_url: str,
+        headers: Dict
+) -> Dict:
+    """
+    Async version of create_metabase_collection.
+    Args:
+        client: async http client
+        parent_id: id of the parent collection
+        dashboard_name: name of the collection
+        metabase_url: url of Metabase
+        headers: headers of the request
+
+    Returns: the collection created
+    """
+    payload_collection = {
+        "parent_id": parent_id,
+        "color": "#509EE3",
+        "name": dashboard_name,
+    }
+    collection = await apost(client, os.path.join(metabase_url, 'api', 'collection/'), headers, payload_collection)
+    logging.info(f'Created collection in Metabase: {dashboard_name}')
+    return collection
+
+
+async def acreate_metabase_dashboard(
+        client: httpx.AsyncClient,
+        collection_id: int,
+        dashboard_name: str,
+        metabase_url: str,
+        headers: Dict
+) -> Dict:
+    """
+    Async version of create_metabase_dashboard.
+    Args:
+        client: async http client
+        collection_id: id of the collection of the dashboard
+        dashboard_name: name of the dashboard
+        metabase_url: url of Metabase
+        headers: headers of the request
+
+    Returns: the dashboard created
+    """
+    payload_dashboard = {
+        "collection_id": collection_id,
+        "name": dashboard_name
+    }
+    dashboard = await apost(client, os.path.join(metabase_url, 'api', 'dashboard/'), headers, payload_dashboard)
+    logging.info(f'Created dashboard in Metabase: {dashboard_name}')
+    return dashboard
+
+
+async def acreate_card(
+        client: httpx.AsyncClient,
+        metabase_url: str,
+        database_id: int,
+        collection_id: int,
+        card_info: Dict,
+        headers: Dict) -> Dict:
+    """
+    Async version of the create_* card functions, the type of the card is read from card_info['classify'].
+    Args:
+        client: async http client
+        metabase_url: url of Metabase
+        database_id: id of the database in Metabase
+        collection_id: id of the collection of the card
+        card_info: query generated by MetabaseCreator
+        headers: headers of the request
+
+    Returns: the card created
+    """
+    pydantic_object, build_card, base_structure = CARD_TYPES[card_info['classify']]
+    graph_info = await MetabaseGraph().aget_result(pydantic_object=pydantic_object, card_info=card_info)
+    # every card gets its own copy, the base structures are shared by the requests in flight
+    card_structure = build_card(graph_info, database_id, collection_id, copy.deepcopy(base_structure))
+    card = await apost(client, os.path.join(metabase_url, 'api', 'card/'), headers, card_structure)
+    logging.info(f'Created {card_info["classify"]} Card: {graph_info["name"]}')
+    return card
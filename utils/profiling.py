@@ -0,0 +1,352 @@
+import logging
+import math
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from pandas import DataFrame
+from sqlalchemy import String, cast, column as sql_column, func, select, table as sql_table, tablesample, text
+from sqlalchemy.engine import Connection, Engine
+
+from utils.config_loaders import get_config
+from utils.database import (
+    choose_sampling_strategy,
+    connect_with_timeout,
+    estimate_row_count,
+    get_column_kind,
+    get_keyset_column,
+    get_read_engine
+)
+
+config = get_config()
+profiling_config = config.get('profiling', {})
+sampling_config = config.get('sampling', {})
+
+# first word of the column types that support min and max on every dialect, the rest (UUID, geometric, network,
+# JSON, arrays...) are left out because some databases do not define min and max for them
+ORDERABLE_TYPES = {
+    'SMALLINT', 'INTEGER', 'INT', 'BIGINT', 'TINYINT', 'MEDIUMINT', 'INT2', 'INT4', 'INT8', 'SERIAL', 'SMALLSERIAL',
+    'BIGSERIAL', 'NUMERIC', 'DECIMAL', 'NUMBER', 'REAL', 'FLOAT', 'FLOAT4', 'FLOAT8', 'DOUBLE', 'MONEY',
+    'DATE', 'TIME', 'TIMESTAMP', 'TIMESTAMPTZ', 'TIMETZ', 'DATETIME', 'DATETIME2', 'SMALLDATETIME', 'YEAR',
+}
+CHARACTER_TYPES = {'CHAR', 'CHARACTER', 'VARCHAR', 'NCHAR', 'NVARCHAR', 'VARCHAR2', 'NVARCHAR2'}
+
+PG_STATS_QUERY = text("""
+SELECT
+    attname AS column_name,
+    null_frac,
+    n_distinct,
+    avg_width,
+    array_to_json((most_common_vals::text)::text[]) AS most_common_vals,
+    array_to_json(most_common_freqs) AS most_common_freqs,
+    array_to_json((histogram_bounds::text)::text[]) AS histogram_bounds
+FROM pg_catalog.pg_stats
+WHERE schemaname = :schema_name AND tablename = :table_name
+""")
+
+
+def is_orderable(column_type: str) -> bool:
+    """
+    Check if min and max can be computed for a column type, only numeric, date and time, and bounded character
+    types are accepted
+    Args:
+        column_type: type of the column reported by get_table_info
+
+    Returns: True if the column supports min and max
+    """
+    column_type = column_type.upper()
+    first_word = re.match(r'\s*([A-Z0-9_]*)', column_type).group(1)
+    if '[]' in column_type or 'ARRAY' in column_type:
+        return False
+    return first_word in ORDERABLE_TYPES or first_word in CHARACTER_TYPES
+
+
+def build_profile_source(
+        conn: Connection,
+        schema: str,
+        table: str,
+        columns_info: List[Dict[str, Any]],
+        sample_rows: int
+):
+    """
+    Build the subquery with the rows read by the profile of a table. The rows are spread over the table with the
+    same strategy as sample_table: TABLESAMPLE, ranges of the primary key starting at random values in equal
+    slices of the keys, or LIMIT as a fallback.
+    Args:
+        conn: database connection
+        schema: schema of the table
+        table: name of the table
+        columns_info: metadata of the columns of the table (see get_table_info)
+        sample_rows: maximum number of rows read
+
+    Returns: SQLAlchemy subquery with the columns of the table
+    """
+    columns = [sql_column(column['column_name']) for column in columns_info]
+    source_table = sql_table(table, schema=schema)
+    strategy = choose_sampling_strategy(conn.dialect.name, columns_info, sampling_config.get('strategy', 'auto'))
+
+    if strategy == 'tablesample':
+        row_count = estimate_row_count(conn, schema, table)
+        if row_count and row_count > sample_rows:
+            sampling_method = getattr(func, sampling_config.get('tablesample_method', 'SYSTEM').lower())
+            sampled_table = tablesample(source_table, sampling_method(100.0 * sample_rows / row_count))
+            return select(*columns).select_from(sampled_table).limit(sample_rows).subquery('sampled')
+    elif strategy == 'keyset':
+        key = sql_column(get_keyset_column(columns_info))
+        min_key, max_key = conn.execute(select(func.min(key), func.max(key)).select_from(source_table)).one()
+        probes = sampling_config.get('keyset_probes', 5)
+        if min_key is not None and max_key - min_key >= sample_rows:
+            rows_per_probe = math.ceil(sample_rows / probes)
+            slice_size = (max_key - min_key + 1) / probes
+            ranges = []
+            # one probe in each slice of the keys, the probes never overlap so no row is counted twice
+            for i in range(probes):
+                slice_start = min_key + int(i * slice_size)
+                slice_end = min_key + int((i + 1) * slice_size)
+                start = random.randint(slice_start, max(slice_start, slice_end - rows_per_probe))
+                ranges.append(
+                    select(*columns).select_from(source_table).where(key >= start, key < slice_end)
+                    .order_by(key).limit(rows_per_probe).subquery(f'probe{i}')
+                )
+            probe_rows = [select(*[probe.c[column.name] for column in columns]) for probe in ranges]
+            return probe_rows[0].union_all(*probe_rows[1:]).subquery('sampled')
+
+    return select(*columns).select_from(source_table).limit(sample_rows).subquery('sampled')
+
+
+def profile_table_scan(
+        schema: str,
+        table: str,
+        columns_info: List[Dict[str, Any]],
+        database: Engine,
+        sample_rows: int = 10000,
+        timeout_seconds: Optional[float] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Compute the statistics of every column of a table with a single aggregate query. The query reads at most
+    sample_rows rows spread over the table (see build_profile_source), so the cost is bounded on large tables.
+    Args:
+        schema: schema of the table
+        table: name of the table
+        columns_info: metadata of the columns of the table (see get_table_info)
+        database: database connection object
+        sample_rows: maximum number of rows read
+        timeout_seconds: maximum time of the query
+
+    Returns: dictionary with the column name as key and its statistics as value
+    """
+    with connect_with_timeout(get_read_engine(database), timeout_seconds) as conn:
+        source = build_profile_source(conn, schema, table, columns_info, sample_rows)
+        aggregates = [func.count().label('row_count')]
+        for i, column_info in enumerate(columns_info):
+            column = source.c[column_info['column_name']]
+            as_text = cast(column, String)
+            aggregates += [
+                func.count(column).label(f'c{i}_non_null'),
+                func.count(as_text.distinct()).label(f'c{i}_distinct'),
+                func.avg(func.length(as_text)).label(f'c{i}_avg_length'),
+            ]
+            if is_orderable(column_info['type']):
+                aggregates += [
+                    cast(func.min(column), String).label(f'c{i}_min'),
+                    cast(func.max(column), String).label(f'c{i}_max'),
+                ]
+        row = conn.execute(select(*aggregates)).mappings().one()
+
+    row_count = row['row_count']
+    profile = {}
+    for i, column_info in enumerate(columns_info):
+        non_null = row[f'c{i}_non_null']
+        profile[column_info['column_name']] = {
+            'null_fraction': 1 - non_null / row_count if row_count else None,
+            'distinct': row[f'c{i}_distinct'],
+            'distinct_is_estimate': row_count >= sample_rows,
+            'min': row.get(f'c{i}_min'),
+            'max': row.get(f'c{i}_max'),
+            'avg_length': float(row[f'c{i}_avg_length']) if row[f'c{i}_avg_length'] is not None else None,
+            'top_values': None,
+        }
+    return profile
+
+
+def profile_table_pg_stats(schema: str, table: str, database: Engine) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the statistics of a table collected by ANALYZE from pg_stats, the table is not scanned
+    Args:
+        schema: schema of the table
+        table: name of the table
+        database: database connection object
+
+    Returns: dictionary with the column name as key and its statistics as value, empty if the table was never
+    analyzed
+    """
+    with get_read_engine(database).connect() as conn:
+        rows = conn.execute(PG_STATS_QUERY, {'schema_name': schema, 'table_name': table}).mappings().all()
+
+    profile = {}
+    for row in rows:
+        histogram = row['histogram_bounds'] or []
+        common_values = row['most_common_vals'] or []
+        frequencies = row['most_common_freqs'] or []
+        profile[row['column_name']] = {
+            'null_fraction': row['null_frac'],
+            # a negative n_distinct is the fraction of the rows that are distinct
+            'distinct': row['n_distinct'] if row['n_distinct'] >= 0 else f'{-row["n_distinct"]:.0%} of the rows',
+            'distinct_is_estimate': True,
+            'min': histogram[0] if histogram else None,
+            'max': histogram[-1] if histogram else None,
+            'avg_length': row['avg_width'],
+            'top_values': [(value, frequency) for value, frequency in zip(common_values, frequencies)] or None,
+        }
+    return profile
+
+
+def add_top_values(profile: Dict[str, Dict[str, Any]], table_data: DataFrame, top_values: int = 5) -> None:
+    """
+    Add the most common values of each column, computed from the rows already sampled, to the profile
+    Args:
+        profile: profile of the table, updated in place
+        table_data: rows sampled from the table
+        top_values: number of values kept for each column
+    """
+    for column_name, statistics in profile.items():
+        if statistics.get('top_values') or column_name not in table_data.columns:
+            continue
+        values = table_data[column_name].dropna().astype(str)
+        counts = values.value_counts().head(top_values)
+        # values that appear only once in the sample are not common values
+        counts = counts[counts > 1]
+        statistics['top_values'] = [(value, count / len(values)) for value, count in counts.items()] or None
+
+
+def profile_table(
+        schema: str,
+        table: str,
+        columns_info: List[Dict[str, Any]],
+        database: Engine,
+        table_data: DataFrame = None,
+        use_pg_stats: bool = None,
+        sample_rows: int = None,
+        top_values: int = None,
+        timeout_seconds: Optional[float] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Profile the columns of a table: null fraction, distinct values, min, max, average length and most common
+    values. The statistics are read from pg_stats when use_pg_stats is enabled and the table was analyzed,
+    otherwise they are computed with one aggregate query (see profile_table_scan).
+    Args:
+        schema: schema of the table
+        table: name of the table
+        columns_info: metadata of the columns of the table (see get_table_info)
+        database: database connection object
+        table_data: rows sampled from the table, used for the most common values
+        use_pg_stats: read pg_stats instead of scanning the table (profiling.use_pg_stats in the config)
+        sample_rows: maximum number of rows read by the aggregate query (profiling.sample_rows in the config)
+        top_values: number of most common values kept for each column (profiling.top_values in the config)
+        timeout_seconds: maximum time of the aggregate query
+
+    Returns: dictionary with the column name as key and its statistics as value
+    """
+    use_pg_stats = profiling_config.get('use_pg_stats', False) if use_pg_stats is None else use_pg_stats
+    profile = {}
+    if use_pg_stats and database.dialect.name == 'postgresql':
+        profile = profile_table_pg_stats(schema, table, database)
+    if not profile:
+        profile = profile_table_scan(
+            schema, table, columns_info, database, sample_rows or profiling_config.get('sample_rows', 10000),
+            timeout_seconds
+        )
+    if table_data is not None:
+        add_top_values(profile, table_data, top_values or profiling_config.get('top_values', 5))
+    return profile
+
+
+def profile_tables(
+        info_extractor: dict,
+        database: Engine,
+        table_metadata: Dict[str, Any],
+        table_data: Dict[str, DataFrame] = None,
+        max_workers: int = None,
+        timeout_seconds: Optional[float] = None
+) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Profile several tables concurrently (see profile_table). The tables that fail are logged and left out.
+    Args:
+        info_extractor: info extractor dictionary, contains the schemas and tables to be used
+        database: database connection object
+        table_metadata: result of get_table_info
+        table_data: rows sampled from each table (see get_data)
+        max_workers: maximum number of tables profiled at the same time (sampling.max_workers in the config)
+        timeout_seconds: timeout of each query (sampling.timeout_seconds in the config)
+
+    Returns: dictionary with the 'schema.table' name as key and the profile of the table as value
+    """
+    max_workers = max_workers or sampling_config.get('max_workers', 8)
+    timeout_seconds = timeout_seconds or sampling_config.get('timeout_seconds')
+    table_data = table_data or {}
+    tables = [
+        (schema, table) for schema, table_names in info_extractor['schemas'].items() for table in table_names
+    ]
+    profiles = {}
+    if not tables:
+        return profiles
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tables)), thread_name_prefix='profiler') as executor:
+        futures = {
+            f'{schema}.{table}': executor.submit(
+                profile_table,
+                schema,
+                table,
+                table_metadata[f'{schema}.{table}']['columns'],
+                database,
+                table_data.get(f'{schema}.{table}'),
+                timeout_seconds=timeout_seconds
+            )
+            for schema, table in tables
+        }
+        for table_name, future in futures.items():
+            try:
+                profiles[table_name] = future.result()
+            except Exception as e:
+                logging.error(f'Error profiling the table {table_name}: {e}')
+    return profiles
+
+
+def render_profile(profile: Dict[str, Dict[str, Any]], columns: List[str] = None, max_value_length: int = 40) -> str:
+    """
+    Render the profile of a table as compact text to be used in the prompts, one line for each column
+    Args:
+        profile: profile of the table (see profile_table)
+        columns: columns to include, all the columns of the profile if None
+        max_value_length: values longer than this are truncated
+
+    Returns: text with the statistics of the columns
+    """
+    def short(value: Any) -> str:
+        value = str(value)
+        return value if len(value) <= max_value_length else value[:max_value_length] + '...'
+
+    lines = []
+    for column_name in columns if columns is not None else profile.keys():
+        statistics = profile.get(column_name)
+        if not statistics:
+            continue
+        parts = []
+        if statistics['null_fraction'] is not None:
+            parts.append(f"nulls {statistics['null_fraction']:.0%}")
+        distinct = statistics['distinct']
+        if isinstance(distinct, (int, float)):
+            parts.append(f"{'~' if statistics['distinct_is_estimate'] else ''}{int(distinct)} distinct")
+        elif distinct is not None:
+            parts.append(f"{distinct} distinct")
+        if statistics['min'] is not None:
+            parts.append(f"min {short(statistics['min'])}, max {short(statistics['max'])}")
+        if statistics['avg_length'] is not None:
+            parts.append(f"avg length {statistics['avg_length']:.0f}")
+        if statistics['top_values']:
+            parts.append('top values ' + ', '.join(
+                f"{short(value)!r} ({frequency:.0%})" for value, frequency in statistics['top_values']
+            ))
+        lines.append(f"{column_name}: {'; '.join(parts)}")
+    return '\n'.join(lines)
@@ -0,0 +1,43 @@
+import contextvars
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+# function that receives the stages reported by the chains of the current request, see listen_progress. The context
+# is copied to the asyncio tasks and to asyncio.to_thread, so the steps of a chain report to the request that runs it
+progress_listener: contextvars.ContextVar[Optional[Callable[[str], Any]]] = contextvars.ContextVar(
+    'progress_listener', default=None
+)
+
+
+def report_progress(stage: str) -> None:
+    """
+    Report the stage of a long running chain to the listener of the current request, if any. The errors of the
+    listener are logged, progress never stops a chain.
+    Args:
+        stage: short description of the work that starts, for example "Writing the SQL query"
+    """
+    listener = progress_listener.get()
+    if listener is None:
+        return
+    try:
+        listener(stage)
+    except Exception as e:
+        logging.warning(f'Error reporting the progress "{stage}": {e}')
+
+
+@contextmanager
+def listen_progress(listener: Callable[[str], Any]) -> Iterator[None]:
+    """
+    Send the stages reported inside the block to the listener. The listener can be called from a worker thread
+    when the chain runs synchronously.
+    Args:
+        listener: function that receives each stage
+
+    Returns: iterator used by the with statement
+    """
+    token = progress_listener.set(listener)
+    try:
+        yield
+    finally:
+        progress_listener.reset(token)
@@ -0,0 +1,209 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+# words that change the answer of a question without changing much its embedding
+DATE_WORDS = {
+    'today', 'yesterday', 'tomorrow', 'now', 'current', 'this', 'last', 'next', 'previous', 'past', 'ago',
+    'day', 'days', 'daily', 'week', 'weeks', 'weekly', 'month', 'months', 'monthly', 'quarter', 'quarters',
+    'quarterly', 'year', 'years', 'yearly', 'annual', 'hour', 'hours', 'hourly', 'ytd', 'mtd',
+    'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+    'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november',
+    'december',
+}
+NUMBER_WORDS = {
+    'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten', 'eleven', 'twelve', 'twenty',
+    'fifty', 'hundred', 'thousand', 'first', 'second', 'third', 'top', 'bottom',
+}
+
+
+def extract_literals(question: str) -> Tuple[str, ...]:
+    """
+    Get the literals of a question that two similar questions must share to have the same answer: the numbers, the
+    quoted values and the words about dates and positions. "top 5 customers" and "top 10 customers" are very similar
+    for the embeddings but have different literals.
+    Args:
+        question: user question
+
+    Returns: the literals of the question, sorted
+    """
+    text = question.lower()
+    literals = re.findall(r'\d+(?:[.,:/-]\d+)*', text) + re.findall(r'["\']([^"\']+)["\']', text)
+    literals += [word for word in re.findall(r'[a-z]+', text) if word in DATE_WORDS or word in NUMBER_WORDS]
+    return tuple(sorted(literals))
+
+
+class SemanticCache:
+    """
+    Cache of answers indexed by the embedding of the question. A lookup returns the answer of the most similar
+    stored question when its cosine similarity is above the threshold, so rephrased questions hit the same entry.
+    The two questions must also have the same literals (see extract_literals), the numbers and the dates change the
+    answer but barely change the embedding.
+
+    Every entry records the database and the tables it was built from, so the answers of a schema or a table can be
+    invalidated when it changes. The cache keeps hit and miss counters.
+    """
+
+    def __init__(
+            self,
+            embeddings_factory: Callable[[], Embeddings],
+            similarity_threshold: float = 0.97,
+            ttl_seconds: Optional[float] = 86400,
+            max_entries: int = 512,
+            match_literals: bool = True
+    ):
+        """
+        Args:
+            embeddings_factory: function that creates the embeddings model, called on the first use
+            similarity_threshold: minimum cosine similarity between two questions to reuse an answer
+            ttl_seconds: seconds an answer stays valid, None means the answers never expire
+            max_entries: maximum number of answers, the least recently used answer goes first
+            match_literals: only reuse the answers of questions with the same literals
+        """
+        self.embeddings_factory = embeddings_factory
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.match_literals = match_literals
+        self._embeddings: Optional[Embeddings] = None
+        self._entries: OrderedDict = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        if self._embeddings is None:
+            self._embeddings = self.embeddings_factory()
+        return self._embeddings
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def _is_expired(self, entry: Dict[str, Any]) -> bool:
+        return self.ttl_seconds is not None and time.time() - entry['stored_at'] > self.ttl_seconds
+
+    def lookup(self, question: str, database_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Find the answer of the most similar question asked on the same database
+        Args:
+            question: user question
+            database_key: key of the database (see get_engine_key)
+
+        Returns: the stored answer, with the similarity of the questions, or None if there is no similar question
+        """
+        vector = self._embed(question)
+        literals = extract_literals(question)
+        with self._lock:
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if self._is_expired(entry)]:
+                del self._entries[entry_id]
+            candidates = [
+                (entry_id, entry) for entry_id, entry in self._entries.items()
+                if entry['database_key'] == database_key and (not self.match_literals or entry['literals'] == literals)
+            ]
+            if candidates:
+                similarities = np.stack([entry['vector'] for _, entry in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    logging.info(
+                        f'Answer cache hit, similarity {similarities[best]:.3f} with "{entry["question"]}" '
+                        f'({self.hits} hits, {self.misses} misses)'
+                    )
+                    return {**entry['answer'], 'question': entry['question'], 'similarity': float(similarities[best])}
+            self.misses += 1
+            logging.info(f'Answer cache miss ({self.hits} hits, {self.misses} misses)')
+            return None
+
+    def store(self, question: str, database_key: str, tables: Dict[str, List[str]], answer: Dict[str, Any]) -> None:
+        """
+        Store the answer of a question
+        Args:
+            question: user question
+            database_key: key of the database (see get_engine_key)
+            tables: tables used by the answer, by schema, for example {"sales": ["store", "customer"]}
+            answer: answer to be reused
+        """
+        vector = self._embed(question)
+        with self._lock:
+            self._entries[self._next_id] = {
+                'question': question,
+                'literals': extract_literals(question),
+                'vector': vector,
+                'database_key': database_key,
+                'tables': {schema: list(table_names) for schema, table_names in tables.items()},
+                'answer': answer,
+                'stored_at': time.time(),
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, database_key: str = None, schema_name: str = None, table_name: str = None) -> int:
+        """
+        Remove the answers built from a database, a schema or a table. With no arguments every answer is removed.
+        Args:
+            database_key: key of the database, None for every database
+            schema_name: schema name, None for every schema
+            table_name: table name, None for every table of the schema
+
+        Returns: Number of answers removed.
+        """
+        def matches(entry: Dict[str, Any]) -> bool:
+            if database_key is not None and entry['database_key'] != database_key:
+                return False
+            if schema_name is None:
+                return table_name is None or any(table_name in tables for tables in entry['tables'].values())
+            return schema_name in entry['tables'] and (table_name is None or table_name in entry['tables'][schema_name])
+
+        with self._lock:
+            entry_ids = [entry_id for entry_id, entry in self._entries.items() if matches(entry)]
+            for entry_id in entry_ids:
+                del self._entries[entry_id]
+            return len(entry_ids)
+
+    def discard(self, question: str, database_key: str) -> int:
+        """
+        Remove the answers stored for a question, for example when its SQL does not run anymore
+        Args:
+            question: stored question, as returned by lookup
+            database_key: key of the database (see get_engine_key)
+
+        Returns: Number of answers removed.
+        """
+        with self._lock:
+            entry_ids = [
+                entry_id for entry_id, entry in self._entries.items()
+                if entry['question'] == question and entry['database_key'] == database_key
+            ]
+            for entry_id in entry_ids:
+                del self._entries[entry_id]
+            return len(entry_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Metrics of the cache
+        Returns: hits, misses, hit rate and number of answers stored
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._entries),
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
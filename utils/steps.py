@@ -0,0 +1,87 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Generator, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class Step:
+    """
+    A blocking call (model, database or HTTP request) of a chain. The chains are written once as generators that
+    yield their steps and receive the results, run_steps runs the steps in the calling thread and arun_steps awaits
+    the async version of each step, so the sync and the async paths share the same body.
+    """
+
+    def __init__(self, function: Callable[..., Any], *args, afunction: Callable[..., Awaitable[Any]] = None, **kwargs):
+        """
+        Args:
+            function: function called by run_steps
+            *args: positional arguments of both functions
+            afunction: coroutine function called by arun_steps, by default function runs in a worker thread
+            **kwargs: keyword arguments of both functions
+        """
+        self.function = function
+        self.afunction = afunction
+        self.args = args
+        self.kwargs = kwargs
+
+    @classmethod
+    def predict(cls, prompt: Any) -> 'Step':
+        """
+        Step that gets the result of a prompt class, with get_result or aget_result
+        Args:
+            prompt: prompt class with get_result and aget_result methods
+
+        Returns: the step
+        """
+        return cls(prompt.get_result, afunction=prompt.aget_result)
+
+    def run(self) -> Any:
+        return self.function(*self.args, **self.kwargs)
+
+    async def arun(self) -> Any:
+        if self.afunction is None:
+            return await asyncio.to_thread(self.function, *self.args, **self.kwargs)
+        return await self.afunction(*self.args, **self.kwargs)
+
+
+def run_steps(steps: Generator[Step, Any, T]) -> T:
+    """
+    Run a chain written as a generator of steps, each step is called in the current thread. The exceptions of a
+    step are raised inside the generator, so the chain handles them with a normal try/except.
+    Args:
+        steps: generator that yields the steps and returns the result of the chain
+
+    Returns: the result of the chain
+    """
+    value: Any = None
+    error: Optional[Exception] = None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = step.run(), None
+        except Exception as e:
+            value, error = None, e
+
+
+async def arun_steps(steps: Generator[Step, Any, T]) -> T:
+    """
+    Async version of run_steps, the steps are awaited so the event loop is not blocked
+    Args:
+        steps: generator that yields the steps and returns the result of the chain
+
+    Returns: the result of the chain
+    """
+    value: Any = None
+    error: Optional[Exception] = None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, error = await step.arun(), None
+        except Exception as e:
+            value, error = None, e
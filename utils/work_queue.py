@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+
+class Job:
+    """
+    A job of the work queue, with its cost class, its owners and its tag of the fair queue
+    """
+
+    def __init__(self, function: Callable[[], Awaitable[Any]], cost_class: str, owners: Dict[str, str], tag: float):
+        self.function = function
+        self.cost_class = cost_class
+        self.owners = owners
+        self.tag = tag
+        self.submitted_at = time.monotonic()
+
+
+class WorkQueue:
+    """
+    Bounded queue of jobs run in the background by a fixed number of worker tasks. The jobs are coroutine functions
+    without arguments, submit returns at once so the caller answers its request (for example the ack of a Slack
+    event) before the job runs. The workers are started by the first submit, inside the running event loop.
+
+    The jobs are scheduled with a weighted fair queue: each cost class gets a share of the workers proportional to
+    its weight, so the cheap jobs are not stuck behind a burst of expensive ones. The jobs of an owner (for example
+    a user or a channel) above its limit of running jobs wait, and the other jobs go first.
+    """
+
+    def __init__(
+            self,
+            workers: int = 4,
+            max_size: int = 100,
+            weights: Dict[str, float] = None,
+            limits: Dict[str, int] = None
+    ):
+        """
+        Args:
+            workers: jobs run at the same time
+            max_size: jobs waiting for a worker, submit rejects the jobs above it
+            weights: share of each cost class, 1 for the classes not listed
+            limits: maximum running jobs of each owner, by kind of owner, for example {'user': 2}
+        """
+        self.workers = workers
+        self.max_size = max_size
+        self.weights = weights or {}
+        self.limits = limits or {}
+        self._pending: Dict[str, Deque[Job]] = {}
+        self._last_tag: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._running: Counter = Counter()
+        self._running_jobs = 0
+        self._rejected = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _start(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._idle = asyncio.Event()
+            self._idle.set()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _is_allowed(self, job: Job) -> bool:
+        return all(
+            self._running[(kind, owner)] < self.limits[kind]
+            for kind, owner in job.owners.items() if kind in self.limits and owner is not None
+        )
+
+    def _next_job(self) -> Optional[Job]:
+        """
+        Take the allowed job with the smallest tag, the first allowed job of each class is a candidate
+        """
+        candidates = []
+        for jobs in self._pending.values():
+            job = next((job for job in jobs if self._is_allowed(job)), None)
+            if job is not None:
+                candidates.append(job)
+        if not candidates:
+            return None
+        job = min(candidates, key=lambda candidate: candidate.tag)
+        self._pending[job.cost_class].remove(job)
+        self._virtual_time = max(self._virtual_time, job.tag)
+        self._running_jobs += 1
+        for kind, owner in job.owners.items():
+            self._running[(kind, owner)] += 1
+        return job
+
+    def _release(self, job: Job) -> None:
+        self._running_jobs -= 1
+        for kind, owner in job.owners.items():
+            self._running[(kind, owner)] -= 1
+            if not self._running[(kind, owner)]:
+                del self._running[(kind, owner)]
+        if not self._running_jobs and not self.depth():
+            self._idle.set()
+        self._wakeup.set()
+
+    async def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                await job.function()
+            except Exception as e:
+                logging.error(f'Error running a job of the work queue: {e}')
+            finally:
+                self._release(job)
+
+    def submit(
+            self,
+            job: Callable[[], Awaitable[Any]],
+            cost_class: str = 'default',
+            owners: Dict[str, str] = None
+    ) -> bool:
+        """
+        Add a job to the queue, it runs when a worker is free and its owners are below their limits
+        Args:
+            job: coroutine function without arguments
+            cost_class: class of the job, the classes share the workers by their weights
+            owners: owner of the job by kind of owner, for example {'user': 'U1', 'channel': 'C1'}
+
+        Returns: False if the queue is full and the job was rejected
+        """
+        self._start()
+        if self.depth() >= self.max_size:
+            self._rejected += 1
+            logging.warning(f'The work queue is full ({self.max_size} jobs), the job was rejected')
+            return False
+        # the tag of a job is the virtual time when it would finish if each class got its share of the workers
+        tag = max(self._virtual_time, self._last_tag.get(cost_class, 0.0)) + 1 / self.weights.get(cost_class, 1)
+        self._last_tag[cost_class] = tag
+        self._pending.setdefault(cost_class, deque()).append(Job(job, cost_class, owners or {}, tag))
+        self._idle.clear()
+        self._wakeup.set()
+        return True
+
+    def depth(self) -> int:
+        """
+        Returns: number of jobs waiting for a worker
+        """
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Metrics of the queue
+        Returns: the jobs waiting by cost class, the running jobs, the rejected jobs and the longest wait in seconds
+        """
+        now = time.monotonic()
+        waiting = [job for jobs in self._pending.values() for job in jobs]
+        return {
+            'waiting': {cost_class: len(jobs) for cost_class, jobs in self._pending.items()},
+            'depth': len(waiting),
+            'running': self._running_jobs,
+            'workers': self.workers,
+            'rejected': self._rejected,
+            'max_wait_seconds': max((now - job.submitted_at for job in waiting), default=0.0)
+        }
+
+    async def join(self) -> None:
+        """
+        Wait until every submitted job is done
+        """
+        if self._idle is not None:
+            await self._idle.wait()
+
+    async def close(self) -> None:
+        """
+        Stop the workers, the jobs still waiting are dropped
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._pending = {}
+        self._running.clear()
+        self._running_jobs = 0
+        self._wakeup = None
+        self._idle = None
+        self._tasks = []